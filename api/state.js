@@ -6,6 +6,43 @@ function allowCors(res) {
   res.setHeader('Access-Control-Allow-Headers', 'Content-Type, Authorization, X-Client-Stage, X-Admin-Reset, X-Client-Aborted');
 }
 
+const SESSION_COLUMNS = 'current_state,twofa_verified,linking_code,last_updated_at,last_actor_tg_id,last_actor_chat_id,tg_username,tg_display_name,tg_photo_url,send_test_at,send_abort_at';
+const MAX_BULK_SESSIONS = 100;
+
+function sessionBody(data) {
+  const ts = (data.last_updated_at ? Math.floor(new Date(data.last_updated_at).getTime() / 1000) : Math.floor(Date.now()/1000));
+  return {
+    stage: Number(data.current_state || 1),
+    twofa_verified: !!data.twofa_verified,
+    linking_code: data.linking_code || null,
+    updated_at: ts,
+    actor_tg_user_id: data.last_actor_tg_id || null,
+    actor_chat_id: data.last_actor_chat_id || null,
+    tg_username: data.tg_username || null,
+    tg_display_name: data.tg_display_name || null,
+    tg_photo_url: data.tg_photo_url || null,
+    send_test_at: data.send_test_at || null,
+    send_abort_at: data.send_abort_at || null
+  };
+}
+
+// Push the upserted session row to the bot's /xrex/events route so it reacts without waiting for a poll.
+// Best effort: if the bot is unreachable it still picks the change up on its reconcile poll.
+// Never rejects; callers start it before responding and await it only after the response is sent.
+function notifyBot(sessionId, data) {
+  const url = process.env.BOT_EVENTS_URL || '';
+  const token = process.env.STATE_EVENT_TOKEN || '';
+  if (!url || !token || !data) return Promise.resolve();
+  const ctrl = new AbortController();
+  const timer = setTimeout(() => ctrl.abort(), 1500);
+  return fetch(url, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json', 'Authorization': `Bearer ${token}` },
+    body: JSON.stringify({ session_id: sessionId, record: sessionBody(data) }),
+    signal: ctrl.signal
+  }).catch(() => { /* ignore */ }).finally(() => clearTimeout(timer));
+}
+
 module.exports = async (req, res) => {
   allowCors(res);
   if (req.method === 'OPTIONS') {
@@ -33,6 +70,30 @@ module.exports = async (req, res) => {
     const sessionId = session || 'default';
 
       if (req.method === 'GET') {
+      // Bulk lookup for the bot's multiplexed poller: ?sessions=a,b,c -> { sessions: { a: {...}, b: {} } }
+      const sessionsParam = req.query && req.query.sessions;
+      if (sessionsParam !== undefined && sessionsParam !== null) {
+        const ids = Array.from(new Set(String(sessionsParam).split(',')
+          .map((s) => s.trim())
+          .filter((s) => /^[A-Za-z0-9_-]{1,64}$/.test(s)))).slice(0, MAX_BULK_SESSIONS);
+        const out = {};
+        ids.forEach((id) => { out[id] = {}; });
+        if (ids.length) {
+          const { data: rows, error: errRows } = await supabase
+            .from('xrex_session')
+            .select('session_id,' + SESSION_COLUMNS)
+            .in('session_id', ids);
+          if (errRows) {
+            res.status(500).json({ error: 'DB read error', detail: errRows.message });
+            return;
+          }
+          (rows || []).forEach((row) => { out[row.session_id] = sessionBody(row); });
+        }
+        res.setHeader('Content-Type', 'application/json');
+        res.status(200).send(JSON.stringify({ sessions: out }));
+        return;
+      }
+
       // Optional: lookup by Telegram user id for quick status checks
       try {
         const tgParam = (req.query && (req.query.tg || req.query.tg_user_id));
@@ -78,7 +139,7 @@ module.exports = async (req, res) => {
       // Default: lookup by session id
       const { data, error, status } = await supabase
         .from('xrex_session')
-        .select('current_state,twofa_verified,linking_code,last_updated_at,last_actor_tg_id,last_actor_chat_id,tg_username,tg_display_name,tg_photo_url,send_test_at,send_abort_at')
+        .select(SESSION_COLUMNS)
         .eq('session_id', sessionId)
         .single();
       if (error && status !== 406) {
@@ -92,20 +153,7 @@ module.exports = async (req, res) => {
       }
       let bodyObj = {};
       if (data) {
-        const ts = (data.last_updated_at ? Math.floor(new Date(data.last_updated_at).getTime() / 1000) : Math.floor(Date.now()/1000));
-        bodyObj = {
-          stage: Number(data.current_state || 1),
-          twofa_verified: !!data.twofa_verified,
-          linking_code: data.linking_code || null,
-          updated_at: ts,
-          actor_tg_user_id: data.last_actor_tg_id || null,
-          actor_chat_id: data.last_actor_chat_id || null,
-          tg_username: data.tg_username || null,
-          tg_display_name: data.tg_display_name || null,
-          tg_photo_url: data.tg_photo_url || null,
-          send_test_at: data.send_test_at || null,
-          send_abort_at: data.send_abort_at || null
-        };
+        bodyObj = sessionBody(data);
       }
       // No KV usage in reverted version
       const body = JSON.stringify(bodyObj);
@@ -169,13 +217,16 @@ module.exports = async (req, res) => {
         const row = { session_id: sessionId, last_updated_at: nowIso };
         if (Object.prototype.hasOwnProperty.call(payload, 'send_test_at')) row.send_test_at = (payload.send_test_at ?? null);
         if (Object.prototype.hasOwnProperty.call(payload, 'send_abort_at')) row.send_abort_at = (payload.send_abort_at ?? null);
-        const up = await supabase.from('xrex_session').upsert(row, { onConflict: 'session_id' });
+        const up = await supabase.from('xrex_session').upsert(row, { onConflict: 'session_id' }).select(SESSION_COLUMNS).single();
         if (up.error) {
           res.status(500).json({ error: 'DB write error', detail: up.error.message });
           return;
         }
+        const notified = notifyBot(sessionId, up.data);
         res.setHeader('Content-Type', 'application/json');
         res.status(200).send(JSON.stringify({ ok: true }));
+        // Keep the function alive until the event is delivered, without holding up the response
+        await notified;
         return;
       }
       // Admin reset path: only allow lowering to <=3, clear verification/linking
@@ -211,7 +262,7 @@ module.exports = async (req, res) => {
           send_test_at: null,
           send_abort_at: isAbortedHeader ? nowIso : null
         };
-        const up1 = await supabase.from('xrex_session').upsert(row, { onConflict: 'session_id' });
+        const up1 = await supabase.from('xrex_session').upsert(row, { onConflict: 'session_id' }).select(SESSION_COLUMNS).single();
         if (up1.error) {
           res.status(500).json({ error: 'DB write error', detail: up1.error.message });
           return;
@@ -230,8 +281,10 @@ module.exports = async (req, res) => {
             }
           }
         } catch(_) { /* ignore */ }
+        const notified = notifyBot(sessionId, up1.data);
         res.setHeader('Content-Type', 'application/json');
         res.status(200).send(JSON.stringify({ ok: true }));
+        await notified;
         return;
       }
       // Authenticated path OR limited client finalize
@@ -325,13 +378,15 @@ module.exports = async (req, res) => {
           last_updated_at: nowIso
         };
       }
-      const upsert = await supabase.from('xrex_session').upsert(row, { onConflict: 'session_id' });
+      const upsert = await supabase.from('xrex_session').upsert(row, { onConflict: 'session_id' }).select(SESSION_COLUMNS).single();
       if (upsert.error) {
         res.status(500).json({ error: 'DB write error', detail: upsert.error.message });
         return;
       }
+      const notified = notifyBot(sessionId, upsert.data);
       res.setHeader('Content-Type', 'application/json');
       res.status(200).send(JSON.stringify({ ok: true }));
+      await notified;
       return;
     }
 
@@ -1,10 +1,18 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo, BotCommand, BotCommandScopeChat
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, CallbackQueryHandler,
-    MessageHandler, filters, ContextTypes
+    MessageHandler, TypeHandler, filters, ContextTypes, BaseRateLimiter
 )
+from telegram.error import RetryAfter
 import logging
+import logging.handlers
+import queue
+import atexit
 from io import BytesIO
+from collections import OrderedDict, namedtuple
+import contextvars
+import heapq
+import itertools
 import asyncio
 import random
 import string
@@ -12,6 +20,20 @@ import json
 import traceback
 import time
 import os
+import sys
+import sqlite3
+import re
+import hmac
+import math
+import mmap
+import struct
+import functools
+import html
+import tempfile
+import concurrent.futures
+import hashlib
+import zlib
+import argparse
 
 try:
     from aiohttp import web
@@ -22,19 +44,533 @@ try:
 except Exception:
     httpx = None
 
-# Configure detailed logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.DEBUG
-)
+# Logging: records are queued on the calling thread and formatted/written by a background
+# listener thread, so stdout I/O never blocks the event loop.
+#   LOG_LEVEL          default level (INFO)
+#   LOG_LEVELS         per-logger overrides, e.g. "httpx=WARNING,otc_bot.poller=DEBUG"
+#   LOG_FORMAT         json (default) or text (the old "asctime - name - level - message" lines)
+#   LOG_SAMPLE_RATE    sampled events (extra={'sample': key}) allowed per second per key
+#   LOG_SAMPLE_BURST   and their burst size
+LOG_DEFAULT_LEVELS = {
+    # Connection-level chatter from the HTTP stacks drowns everything else at DEBUG
+    'httpcore': 'WARNING',
+    'httpx': 'WARNING',
+    'hpack': 'WARNING',
+    'telegram': 'INFO',
+    'telegram.ext.ExtBot': 'INFO',
+    'aiohttp.access': 'WARNING',
+    'asyncio': 'WARNING',
+}
+# Attributes every LogRecord has; anything else was passed via extra= and goes into the JSON body
+_LOG_RECORD_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, msg, any extra= fields, exc."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        out = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _LOG_RECORD_ATTRS and not key.startswith('_'):
+                out[key] = value
+        if record.exc_text:
+            out['exc'] = record.exc_text
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+
+class LogSampler(logging.Filter):
+    """Token-bucket sampling for records tagged extra={'sample': key}.
+
+    Each key gets `rate` records per second (bursts up to `burst`); the rest are dropped before
+    they are queued, and the next record let through for that key carries `sampled_out`, the
+    number dropped since the previous one. Untagged records always pass.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        super().__init__()
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self._buckets = {}
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, 'sample', None)
+        if key is None:
+            return True
+        now = time.monotonic()
+        tokens, last, skipped = self._buckets.get(key, (self.burst, now, 0))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1.0:
+            self._buckets[key] = (tokens, now, skipped + 1)
+            self.dropped += 1
+            return False
+        self._buckets[key] = (tokens - 1.0, now, 0)
+        if skipped:
+            record.sampled_out = skipped
+        return True
+
+
+class _LogQueueHandler(logging.handlers.QueueHandler):
+    # Resolve the message and traceback on the caller (args/exc_info may not survive the thread
+    # hop intact) but leave extra= fields on the record for the formatter.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def parse_log_levels(spec: str) -> dict:
+    """'a=DEBUG,b.c=WARNING' -> {'a': 'DEBUG', 'b.c': 'WARNING'}; malformed entries are ignored."""
+    levels = {}
+    for item in (spec or '').split(','):
+        name, sep, level = item.partition('=')
+        level = level.strip().upper()
+        if sep and name.strip() and isinstance(logging.getLevelName(level), int):
+            levels[name.strip()] = level
+    return levels
+
+
+def setup_logging():
+    """Install the queue pipeline on the root logger; returns (listener, sampler)."""
+    stream = logging.StreamHandler(sys.stdout)
+    if os.getenv('LOG_FORMAT', 'json').strip().lower() == 'text':
+        stream.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    else:
+        stream.setFormatter(JsonLogFormatter())
+    log_queue = queue.SimpleQueue()
+    handler = _LogQueueHandler(log_queue)
+    sampler = LogSampler(float(os.getenv('LOG_SAMPLE_RATE', '1')), float(os.getenv('LOG_SAMPLE_BURST', '5')))
+    handler.addFilter(sampler)
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO').strip().upper() or 'INFO')
+    for name, level in {**LOG_DEFAULT_LEVELS, **parse_log_levels(os.getenv('LOG_LEVELS', ''))}.items():
+        logging.getLogger(name).setLevel(level)
+    listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+    listener.start()
+    # Drain whatever is still queued when the interpreter exits
+    atexit.register(listener.stop)
+    return listener, sampler
+
+
+log_listener, log_sampler = setup_logging()
 logger = logging.getLogger(__name__)
+# Subsystem loggers so LOG_LEVELS can turn them up or down independently. otc_bot.updates and
+# otc_bot.outbound write one INFO record per update / Bot API call, which is what
+# tools/workload_trace.py extract reads; set them to WARNING to drop that volume.
+poller_logger = logging.getLogger(f"{__name__}.poller")
+updates_logger = logging.getLogger(f"{__name__}.updates")
+outbound_logger = logging.getLogger(f"{__name__}.outbound")
+PROCESS_START = time.perf_counter()
 
 # Bot token: prefer environment variable for deployment; fall back to test token
 BOT_TOKEN = (os.getenv("BOT_TOKEN", "").strip() or "8052956286:AAHDCvxEzQej-xvR0TUyLNwf0bzPlgcn3dY")
 
 # Using Redis-backed Vercel API for state
 
-user_state = {}
+USER_SESSION_FIELDS = (
+    'chat_id', 'session_id', 'verify_token', 'verification_code', 'linking_code',
+    'awaiting_verification', 'awaiting_2fa', 'awaiting_wallet_address', 'awaiting_amount',
+    'pinned_instruction_message_id', 'final_pinned_message_id', 'previous_message_id',
+    'last_start_ts', 'last_start_had_args',
+    'stage6_notified', 'stage6_inflight', 'stage7_notified',
+    'tg_username', 'tg_display_name', 'tg_photo_url', 'tg_photo_file_uid',
+    'initiator_id', 'direction', 'mode', 'action', 'amount', 'amount_type',
+)
+_USER_SESSION_FIELD_SET = frozenset(USER_SESSION_FIELDS)
+# Fields mirrored into UserSessionStore secondary indexes
+_USER_SESSION_INDEXED = frozenset(('session_id',))
+
+class UserSession:
+    """Per-user bot state as a fixed-slot record.
+
+    Keeps the dict-style access (get / [] / pop / in) the handlers already use; a field
+    holding None counts as absent. Unknown keys raise KeyError instead of growing the record.
+    """
+    __slots__ = USER_SESSION_FIELDS + ('last_active', '_owner', '_uid')
+
+    def __init__(self, **fields):
+        for name in USER_SESSION_FIELDS:
+            setattr(self, name, None)
+        self.last_active = time.monotonic()
+        self._owner = None
+        self._uid = None
+        for key, value in fields.items():
+            self[key] = value
+
+    def get(self, key, default=None):
+        value = getattr(self, key) if key in _USER_SESSION_FIELD_SET else None
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in _USER_SESSION_FIELD_SET:
+            raise KeyError(f"unknown UserSession field: {key}")
+        old = getattr(self, key)
+        setattr(self, key, value)
+        if self._owner is not None and old != value:
+            self._owner._field_changed(self._uid, key, old, value)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def pop(self, key, default=None):
+        value = self.get(key)
+        if key in _USER_SESSION_FIELD_SET:
+            self[key] = None
+        return default if value is None else value
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in USER_SESSION_FIELDS if getattr(self, name) is not None}
+
+class UserSessionStore:
+    """Bounded uid -> UserSession map: LRU order, idle-TTL expiry and a hard entry cap.
+
+    on_evict(uid, session) runs for every expired/evicted entry so callers can release
+    per-user locks, watcher tasks and subscriptions alongside it. A session_id -> uid index
+    is kept in step with every insert, field write and removal, so poller lookups are O(1).
+    on_change(uid), if set, is called after any insert, field write or removal (persistence).
+    """
+
+    def __init__(self, max_entries: int, idle_ttl: float, on_evict=None):
+        self.max_entries = int(max_entries)
+        self.idle_ttl = float(idle_ttl)
+        self.on_evict = on_evict
+        self.on_change = None
+        self.evicted_idle = 0
+        self.evicted_lru = 0
+        self._items = OrderedDict()
+        self._by_session = {}
+
+    @staticmethod
+    def _coerce(value):
+        if isinstance(value, UserSession):
+            return value
+        return UserSession(**dict(value or {}))
+
+    def get(self, uid, default=None):
+        sess = self._items.get(uid)
+        if sess is None:
+            return default
+        sess.last_active = time.monotonic()
+        self._items.move_to_end(uid)
+        return sess
+
+    def peek(self, uid, default=None):
+        """Like get() but without refreshing LRU position (for background scans)."""
+        return self._items.get(uid, default)
+
+    def __getitem__(self, uid):
+        sess = self.get(uid)
+        if sess is None:
+            raise KeyError(uid)
+        return sess
+
+    def __setitem__(self, uid, value):
+        sess = self._coerce(value)
+        sess.last_active = time.monotonic()
+        prev = self._items.get(uid)
+        if prev is None:
+            self.sweep()
+        elif prev is not sess:
+            self._detach(uid, prev)
+        self._items[uid] = sess
+        self._items.move_to_end(uid)
+        if sess._owner is not self:
+            if sess._owner is not None:
+                sess._owner._detach(sess._uid, sess)
+            sess._owner = self
+            sess._uid = uid
+            self._reindex(uid, 'session_id', None, sess.session_id)
+        self._changed(uid)
+        if prev is None:
+            while len(self._items) > self.max_entries:
+                old_uid, old_sess = self._items.popitem(last=False)
+                self._detach(old_uid, old_sess)
+                self.evicted_lru += 1
+                self._evicted(old_uid, old_sess)
+
+    def __contains__(self, uid):
+        return uid in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(list(self._items))
+
+    def pop(self, uid, default=None):
+        sess = self._items.pop(uid, None)
+        if sess is None:
+            return default
+        self._detach(uid, sess)
+        self._changed(uid)
+        return sess
+
+    def user_for_session(self, session_id):
+        """uid of the user whose session is session_id, or None."""
+        if not session_id:
+            return None
+        return self._by_session.get(session_id)
+
+    def chat_for_user(self, uid):
+        """Last known chat id for a user, or None (no LRU refresh)."""
+        sess = self._items.get(uid)
+        return sess.chat_id if sess is not None else None
+
+    def _field_changed(self, uid, key, old, new):
+        if key in _USER_SESSION_INDEXED:
+            self._reindex(uid, key, old, new)
+        self._changed(uid)
+
+    def _changed(self, uid):
+        if self.on_change is not None:
+            self.on_change(uid)
+
+    def _reindex(self, uid, key, old, new):
+        if old is not None and self._by_session.get(old) == uid:
+            self._by_session.pop(old, None)
+        if new is not None:
+            self._by_session[new] = uid
+
+    def _detach(self, uid, sess):
+        if sess._owner is self:
+            self._reindex(uid, 'session_id', sess.session_id, None)
+            sess._owner = None
+            sess._uid = None
+
+    def items(self):
+        return list(self._items.items())
+
+    def sweep(self) -> int:
+        """Drop sessions idle longer than idle_ttl. Oldest entries sit at the front, so this is O(expired)."""
+        cutoff = time.monotonic() - self.idle_ttl
+        expired = 0
+        while self._items:
+            uid, sess = next(iter(self._items.items()))
+            if sess.last_active > cutoff:
+                break
+            self._items.popitem(last=False)
+            self._detach(uid, sess)
+            self.evicted_idle += 1
+            expired += 1
+            self._evicted(uid, sess)
+        return expired
+
+    def _evicted(self, uid, sess):
+        self._changed(uid)
+        if self.on_evict is None:
+            return
+        try:
+            self.on_evict(uid, sess)
+        except Exception as e:
+            logger.debug(f"user session eviction hook failed for {uid}: {str(e)}")
+
+    def memory_usage(self, sample: int = 1000) -> int:
+        """Approximate bytes held by the store (container + records + field values).
+        Large stores are estimated from an evenly spaced sample of records.
+        """
+        n = len(self._items)
+        if n == 0:
+            return sys.getsizeof(self._items)
+        step = max(1, n // max(1, sample))
+        measured = 0
+        counted = 0
+        for i, (uid, sess) in enumerate(self._items.items()):
+            if i % step:
+                continue
+            measured += sys.getsizeof(uid) + sys.getsizeof(sess)
+            for name in USER_SESSION_FIELDS:
+                value = getattr(sess, name)
+                if value is not None and not isinstance(value, bool):
+                    measured += sys.getsizeof(value)
+            counted += 1
+        return sys.getsizeof(self._items) + int(measured * n / counted)
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._items),
+            'indexed_sessions': len(self._by_session),
+            'max_entries': self.max_entries,
+            'evicted_idle': self.evicted_idle,
+            'evicted_lru': self.evicted_lru,
+            'approx_bytes': self.memory_usage(),
+        }
+
+def _release_user_resources(uid, sess):
+    """Eviction hook: drop the per-user entries kept in the other module-level maps."""
+    lock = notify_locks.get(uid)
+    if lock is not None and not lock.locked():
+        notify_locks.pop(uid, None)
+    task = finalize_watch_tasks.pop(uid, None)
+    if task is not None and not task.done():
+        task.cancel()
+    sid = sess.get('session_id')
+    if sid and session_subscriptions.get(sid, {}).get('user_id') == uid:
+        session_subscriptions.pop(sid, None)
+    link_cache.pop(uid, None)
+    link_cache_gen.pop(uid, None)
+    avatar_profile_sent.pop(uid, None)
+    chat_id = sess.get('chat_id')
+    if chat_id is not None and chat_command_scopes.pop(int(chat_id), None) is not None:
+        persist_chat_commands(chat_id)
+
+user_state = UserSessionStore(
+    max_entries=int(os.getenv('USER_SESSION_MAX', '100000')),
+    idle_ttl=float(os.getenv('USER_SESSION_IDLE_TTL', str(24 * 3600))),
+    on_evict=_release_user_resources,
+)
+
+class StatePersistence:
+    """Optional SQLite (WAL) mirror of user sessions, watched linking sessions and per-chat command sets.
+
+    Handlers only mark keys dirty; a background task flushes them in batches on a worker
+    thread, so the event loop never waits on disk. load() rehydrates everything at startup.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 0.5):
+        self.path = path
+        self.flush_interval = float(flush_interval)
+        self.dirty_users = set()
+        self.dirty_sessions = set()
+        self.dirty_chats = set()
+        self.flushes = 0
+        self.rows_written = 0
+        self._task = None
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS user_sessions ('
+            'uid INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)'
+        )
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS session_watches ('
+            'session_id TEXT PRIMARY KEY, watch TEXT, subscription TEXT, updated_at REAL NOT NULL)'
+        )
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS chat_commands ('
+            'chat_id INTEGER PRIMARY KEY, tag TEXT NOT NULL, updated_at REAL NOT NULL)'
+        )
+        self._conn.commit()
+
+    def mark_user(self, uid):
+        self.dirty_users.add(uid)
+
+    def mark_session(self, session_id):
+        if session_id:
+            self.dirty_sessions.add(str(session_id))
+
+    def mark_chat(self, chat_id):
+        self.dirty_chats.add(int(chat_id))
+
+    def _snapshot(self):
+        """Serialize dirty entries on the loop thread (cheap) so the writer thread never touches live state."""
+        now = time.time()
+        user_rows, user_deletes, session_rows, session_deletes, chat_rows, chat_deletes = [], [], [], [], [], []
+        users, self.dirty_users = self.dirty_users, set()
+        sessions, self.dirty_sessions = self.dirty_sessions, set()
+        chats, self.dirty_chats = self.dirty_chats, set()
+        for uid in users:
+            sess = user_state.peek(uid)
+            if sess is None:
+                user_deletes.append((uid,))
+            else:
+                user_rows.append((uid, json.dumps(sess.to_dict()), now - (time.monotonic() - sess.last_active)))
+        for sid in sessions:
+            watch = session_watches.get(sid)
+            sub = session_subscriptions.get(sid)
+            if watch is None and sub is None:
+                session_deletes.append((sid,))
+            else:
+                session_rows.append((sid, json.dumps(watch) if watch is not None else None, json.dumps(sub) if sub is not None else None, now))
+        for chat_id in chats:
+            tag = chat_command_scopes.get(chat_id)
+            if tag is None:
+                chat_deletes.append((chat_id,))
+            else:
+                chat_rows.append((chat_id, tag, now))
+        return user_rows, user_deletes, session_rows, session_deletes, chat_rows, chat_deletes
+
+    def _write(self, user_rows, user_deletes, session_rows, session_deletes, chat_rows=(), chat_deletes=()):
+        with self._conn:
+            if user_rows:
+                self._conn.executemany('INSERT OR REPLACE INTO user_sessions (uid, data, updated_at) VALUES (?, ?, ?)', user_rows)
+            if user_deletes:
+                self._conn.executemany('DELETE FROM user_sessions WHERE uid = ?', user_deletes)
+            if session_rows:
+                self._conn.executemany('INSERT OR REPLACE INTO session_watches (session_id, watch, subscription, updated_at) VALUES (?, ?, ?, ?)', session_rows)
+            if session_deletes:
+                self._conn.executemany('DELETE FROM session_watches WHERE session_id = ?', session_deletes)
+            if chat_rows:
+                self._conn.executemany('INSERT OR REPLACE INTO chat_commands (chat_id, tag, updated_at) VALUES (?, ?, ?)', chat_rows)
+            if chat_deletes:
+                self._conn.executemany('DELETE FROM chat_commands WHERE chat_id = ?', chat_deletes)
+
+    async def flush(self):
+        if not self.dirty_users and not self.dirty_sessions and not self.dirty_chats:
+            return
+        batch = self._snapshot()
+        await asyncio.to_thread(self._write, *batch)
+        self.flushes += 1
+        self.rows_written += sum(len(part) for part in batch)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"state persistence flush failed: {str(e)}")
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+
+    async def close(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"state persistence final flush failed: {str(e)}")
+        await asyncio.to_thread(self._conn.close)
+
+    def load(self):
+        """Return (users, sessions, chats) rows: [(uid, dict, updated_at)], [(session_id, watch, subscription)], [(chat_id, tag)]."""
+        users = [(int(uid), json.loads(data), float(ts)) for uid, data, ts in
+                 self._conn.execute('SELECT uid, data, updated_at FROM user_sessions')]
+        sessions = [(sid, json.loads(w) if w else None, json.loads(sub) if sub else None) for sid, w, sub in
+                    self._conn.execute('SELECT session_id, watch, subscription FROM session_watches')]
+        chats = [(int(chat_id), tag) for chat_id, tag in self._conn.execute('SELECT chat_id, tag FROM chat_commands')]
+        return users, sessions, chats
+
+# Set in main() when STATE_DB_PATH is configured
+state_store = None
+
+def persist_session(session_id):
+    if state_store is not None:
+        state_store.mark_session(session_id)
+
+def persist_chat_commands(chat_id):
+    if state_store is not None:
+        state_store.mark_chat(chat_id)
 
 # Safety warning shown at the top of /start responses
 SAFETY_WARNING_TEXT = (
@@ -80,11 +616,422 @@ def set_sync_state(stage: int = None, twofa_verified: bool = None, linking_code:
 
 # Global bot reference for background tasks
 bot_for_notifications = None
-session_poll_tasks = {}
 session_subscriptions = {}
 finalize_watch_tasks = {}
 notify_locks = {}
 
+# In-process metrics, served as Prometheus text by GET /metrics on the sync server
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class MetricsRegistry:
+    """Counters, fixed-bucket histograms and scrape-time gauges, keyed by metric name and labels.
+
+    Everything is updated from the event loop, so plain dicts suffice. Gauges are callables
+    evaluated at scrape time (a number, or {labels_dict_items_tuple: number}).
+    """
+
+    def __init__(self, buckets=METRICS_LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._meta = OrderedDict()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._meta[name] = (kind, help_text)
+
+    @staticmethod
+    def _key(labels: dict) -> tuple:
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, /, **labels):
+        series = self._counters.setdefault(name, {})
+        key = self._key(labels)
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, /, **labels):
+        series = self._histograms.setdefault(name, {})
+        key = self._key(labels)
+        h = series.get(key)
+        if h is None:
+            # Per-bucket counts, then sum and count
+            h = series[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                h[i] += 1
+                break
+        h[-2] += value
+        h[-1] += 1
+
+    def gauge(self, name: str, fn, help_text: str = ''):
+        self.describe(name, 'gauge', help_text)
+        self._gauges[name] = fn
+
+    @staticmethod
+    def _labels(key: tuple, extra: tuple = ()) -> str:
+        items = key + extra
+        if not items:
+            return ''
+        return '{' + ','.join(f'{k}="' + v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for k, v in items) + '}'
+
+    def render(self) -> str:
+        lines = []
+        names = list(self._meta) + [n for n in (*self._counters, *self._histograms) if n not in self._meta]
+        for name in names:
+            kind, help_text = self._meta.get(name, ('counter' if name in self._counters else 'histogram', ''))
+            if help_text:
+                lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'counter':
+                for key, value in self._counters.get(name, {}).items():
+                    lines.append(f"{name}{self._labels(key)} {value}")
+            elif kind == 'histogram':
+                for key, h in self._histograms.get(name, {}).items():
+                    cumulative = 0
+                    for bound, count in zip(self.buckets, h):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{self._labels(key, (('le', repr(bound)),))} {cumulative}")
+                    lines.append(f"{name}_bucket{self._labels(key, (('le', '+Inf'),))} {h[-1]}")
+                    lines.append(f"{name}_sum{self._labels(key)} {h[-2]:.6f}")
+                    lines.append(f"{name}_count{self._labels(key)} {h[-1]}")
+            else:
+                try:
+                    value = self._gauges[name]()
+                except Exception:
+                    continue
+                if isinstance(value, dict):
+                    for key, v in value.items():
+                        lines.append(f"{name}{self._labels(key)} {v}")
+                else:
+                    lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+metrics.describe('otc_handler_seconds', 'histogram', "Update handler latency by handler kind and command/callback name")
+metrics.describe('otc_handler_errors_total', 'counter', "Update handlers that raised")
+metrics.describe('otc_outbound_seconds', 'histogram', "Outbound request latency (to response headers) by target")
+metrics.describe('otc_outbound_errors_total', 'counter', "Outbound requests that failed or returned 5xx, by target")
+metrics.describe('otc_notifications_total', 'counter', "Session notifications sent, by stage")
+metrics.describe('otc_event_loop_lag_seconds', 'histogram', "Event-loop scheduling lag")
+metrics.gauge('otc_watched_sessions', lambda: len(session_watches), "Sessions tracked by the multiplexed poller")
+metrics.gauge('otc_session_watches', lambda: {(('state', k),): v for k, v in session_watch_stats().items() if k in ('active', 'idle', 'terminal')}, "Watched sessions by lifecycle state")
+metrics.describe('otc_session_watches_reaped_total', 'counter', "Session watches torn down, by reason")
+metrics.gauge('otc_poll_wheel_sessions', lambda: {(('level', str(i)),): n for i, n in enumerate(poll_wheel.stats()['levels'])}, "Sessions waiting in each level of the poll timing wheel")
+metrics.gauge('otc_finalize_watch_tasks', lambda: sum(1 for t in finalize_watch_tasks.values() if not t.done()), "Running stage-6 finalize watchers")
+metrics.gauge('otc_user_sessions', lambda: len(user_state), "Entries in the user session store")
+metrics.gauge('otc_outbound_queue_depth', lambda: {(('priority', p),): n for p, n in outbound_scheduler.stats()['queue_depth'].items()}, "Bot API calls waiting in the outbound scheduler")
+metrics.gauge('otc_event_loop_lag_last_seconds', lambda: event_loop_lag_last, "Most recent event-loop lag sample")
+
+# Callback names become label values; cap how many distinct ones a client can create
+_CALLBACK_METRIC_RE = re.compile(r'^[A-Za-z_]{1,40}')
+_callback_metric_names = set()
+CALLBACK_METRIC_NAMES_MAX = 64
+
+def _callback_metric_name(data) -> str:
+    m = _CALLBACK_METRIC_RE.match(str(data or ''))
+    name = m.group(0).rstrip('_') if m else ''
+    if name and (name in _callback_metric_names or len(_callback_metric_names) < CALLBACK_METRIC_NAMES_MAX):
+        _callback_metric_names.add(name)
+        return name
+    return 'other'
+
+def timed_handler(kind: str, name: str, callback):
+    """Wrap a PTB handler callback so its latency lands in otc_handler_seconds.
+
+    For kind='callback' the name is taken from each query's callback data instead.
+    """
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        label = name
+        if kind == 'callback':
+            label = _callback_metric_name(getattr(update.callback_query, 'data', None))
+        t0 = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            metrics.inc('otc_handler_errors_total', kind=kind, name=label)
+            raise
+        finally:
+            metrics.observe('otc_handler_seconds', time.perf_counter() - t0, kind=kind, name=label)
+    return wrapper
+
+async def timed_outbound(target: str, callback, *args, **kwargs):
+    t0 = time.perf_counter()
+    try:
+        return await callback(*args, **kwargs)
+    except Exception:
+        metrics.inc('otc_outbound_errors_total', target=target)
+        raise
+    finally:
+        metrics.observe('otc_outbound_seconds', time.perf_counter() - t0, target=target)
+
+def record_notification(stage):
+    metrics.inc('otc_notifications_total', stage=stage)
+
+event_loop_lag_last = 0.0
+
+async def monitor_event_loop_lag(interval: float = 0.5):
+    """Sleep `interval` repeatedly and record how late each wake-up was."""
+    global event_loop_lag_last
+    loop = asyncio.get_running_loop()
+    while True:
+        t0 = loop.time()
+        await asyncio.sleep(interval)
+        event_loop_lag_last = max(0.0, loop.time() - t0 - interval)
+        metrics.observe('otc_event_loop_lag_seconds', event_loop_lag_last)
+
+class _TimedTransport(httpx.AsyncBaseTransport if httpx is not None else object):
+    """Times every request on a shared client into otc_outbound_seconds{target=...}."""
+
+    def __init__(self, target: str, inner):
+        self.target = target
+        self._inner = inner
+
+    async def handle_async_request(self, request):
+        t0 = time.perf_counter()
+        try:
+            response = await self._inner.handle_async_request(request)
+        except Exception:
+            metrics.inc('otc_outbound_errors_total', target=self.target)
+            raise
+        finally:
+            metrics.observe('otc_outbound_seconds', time.perf_counter() - t0, target=self.target)
+        if response.status_code >= 500:
+            metrics.inc('otc_outbound_errors_total', target=self.target)
+        return response
+
+    async def aclose(self):
+        await self._inner.aclose()
+
+# Shared outbound HTTP clients, one pool per upstream ('state' API, 'supabase' storage).
+# Opened in main() and closed at shutdown so every helper reuses warm keep-alive connections
+# (and HTTP/2 multiplexing when the h2 package is available) instead of paying DNS+TCP+TLS per call.
+http_clients = {}
+HTTP_CLIENT_TIMEOUTS = {
+    'state': 10.0,
+    'supabase': 20.0,
+    'telegram': 30.0,
+}
+
+def _make_http_client(name: str):
+    limits = httpx.Limits(
+        max_connections=int(os.getenv('HTTP_MAX_CONNECTIONS', '32')),
+        max_keepalive_connections=int(os.getenv('HTTP_MAX_KEEPALIVE', '16')),
+        keepalive_expiry=float(os.getenv('HTTP_KEEPALIVE_EXPIRY', '90')),
+    )
+    timeout = HTTP_CLIENT_TIMEOUTS.get(name, 10.0)
+    try:
+        transport = httpx.AsyncHTTPTransport(http2=True, limits=limits)
+    except ImportError:
+        # h2 not installed: keep pooled HTTP/1.1 keep-alive connections
+        transport = httpx.AsyncHTTPTransport(limits=limits)
+    return httpx.AsyncClient(transport=_TimedTransport(name, transport), timeout=timeout)
+
+def get_http_client(name: str = 'state'):
+    """Return the shared client for an upstream, creating it lazily if main() has not yet."""
+    if httpx is None:
+        return None
+    client = http_clients.get(name)
+    if client is None or client.is_closed:
+        client = _make_http_client(name)
+        http_clients[name] = client
+    return client
+
+def open_http_clients():
+    if httpx is None:
+        return
+    for name in HTTP_CLIENT_TIMEOUTS:
+        get_http_client(name)
+
+async def close_http_clients():
+    for name, client in list(http_clients.items()):
+        try:
+            await client.aclose()
+        except Exception:
+            pass
+        http_clients.pop(name, None)
+
+# Outbound Bot API scheduling. Every bot.* call goes through the Application's rate limiter;
+# calls are classed by priority so interactive replies overtake notification bursts.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NOTIFICATION = 1
+PRIORITY_COMMANDS = 2
+PRIORITY_NAMES = ('interactive', 'notification', 'commands')
+# Background tasks (pollers, watchers, pushed events) set this so their sends queue as notifications
+bot_call_priority = contextvars.ContextVar('bot_call_priority', default=PRIORITY_INTERACTIVE)
+# Endpoints that post into a chat count against Telegram's global and per-chat message budgets
+_MESSAGE_ENDPOINTS = frozenset((
+    'sendMessage', 'editMessageText', 'editMessageReplyMarkup', 'sendPhoto', 'sendDocument',
+    'sendMediaGroup', 'forwardMessage', 'copyMessage', 'pinChatMessage', 'unpinChatMessage',
+))
+
+class OutboundScheduler(BaseRateLimiter):
+    """Global ~30 msg/s and per-chat ~1 msg/s budgets with priority classes and retry_after handling.
+
+    Per-chat pacing is a small token bucket (short bursts like a /start reply pair stay instant);
+    the global budget is handed out by one dispatcher in (priority, arrival) order.
+    """
+
+    def __init__(self, global_rate: float = 30.0, chat_rate: float = 1.0, chat_burst: float = 3.0,
+                 group_rate: float = 20.0 / 60.0, max_retries: int = 3):
+        self.global_rate = float(global_rate)
+        self.chat_rate = float(chat_rate)
+        self.chat_burst = float(chat_burst)
+        self.group_rate = float(group_rate)
+        self.max_retries = int(max_retries)
+        self._waiters = []
+        self._seq = itertools.count()
+        self._tokens = self.global_rate
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._chat_buckets = {}
+        self._recent_flood_waits = {}   # chat_id -> monotonic time of its last RetryAfter
+        self._wakeup = None
+        self._dispatcher = None
+        self.queued = [0, 0, 0]
+        self.sent = [0, 0, 0]
+        self.retry_after_hits = 0
+        self.global_pauses = 0
+        self.max_queue_depth = 0
+
+    async def initialize(self) -> None:
+        # ExtBot.initialize() runs for the Application and again for its Updater; the dispatcher
+        # may already be waiting on the first Event, so never swap it out from under it
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None and not self._dispatcher.done():
+            self._dispatcher.cancel()
+        while self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                fut.cancel()
+
+    def _chat_delay(self, chat_id) -> float:
+        """Reserve one message slot for a chat; returns how long the caller must wait for it."""
+        rate = self.group_rate if str(chat_id).startswith('-') else self.chat_rate
+        now = time.monotonic()
+        tokens, last = self._chat_buckets.get(chat_id, (self.chat_burst, now))
+        tokens = min(self.chat_burst, tokens + (now - last) * rate) - 1.0
+        self._chat_buckets[chat_id] = (tokens, now)
+        if len(self._chat_buckets) > 50000:
+            # Drop chats whose buckets have fully refilled
+            for cid, (t, at) in list(self._chat_buckets.items()):
+                if t + (now - at) * rate >= self.chat_burst:
+                    self._chat_buckets.pop(cid, None)
+        return 0.0 if tokens >= 0 else -tokens / rate
+
+    def _penalize(self, chat_id, delay: float):
+        now = time.monotonic()
+        if chat_id is None:
+            self._paused_until = max(self._paused_until, now + delay)
+            return
+        rate = self.group_rate if str(chat_id).startswith('-') else self.chat_rate
+        # A chat that had only just started using its burst can't have tripped its own limit, and
+        # flood waits hitting several chats at once point the same way: the global ~30 msg/s
+        # limit was hit, so every chat has to back off, not just this one
+        tokens, last = self._chat_buckets.get(chat_id, (self.chat_burst, now))
+        within_budget = min(self.chat_burst, tokens + (now - last) * rate) >= self.chat_burst - 1.0
+        window = max(1.0, delay)
+        for cid, at in list(self._recent_flood_waits.items()):
+            if now - at > window:
+                self._recent_flood_waits.pop(cid, None)
+        self._recent_flood_waits[chat_id] = now
+        if within_budget or len(self._recent_flood_waits) > 1:
+            if self._paused_until < now + delay:
+                self.global_pauses += 1
+            self._paused_until = max(self._paused_until, now + delay)
+        # Next reservation for this chat lands exactly retry_after from now
+        self._chat_buckets[chat_id] = (1.0 - delay * rate, now)
+
+    async def _acquire(self, priority: int):
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        self.queued[priority] += 1
+        self.max_queue_depth = max(self.max_queue_depth, len(self._waiters))
+        if self._wakeup is not None:
+            self._wakeup.set()
+        try:
+            await fut
+        finally:
+            self.queued[priority] -= 1
+
+    async def _dispatch(self):
+        while True:
+            if not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._tokens = min(self.global_rate, self._tokens + (now - self._refilled_at) * self.global_rate)
+            self._refilled_at = now
+            if self._tokens < 1.0:
+                await asyncio.sleep((1.0 - self._tokens) / self.global_rate)
+                continue
+            _, _, fut = heapq.heappop(self._waiters)
+            if fut.done():
+                continue
+            self._tokens -= 1.0
+            fut.set_result(None)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint == 'setMyCommands':
+            priority = PRIORITY_COMMANDS
+        elif endpoint in _MESSAGE_ENDPOINTS:
+            priority = bot_call_priority.get()
+        else:
+            # Reads, getUpdates, answerCallbackQuery, file downloads: not message-budgeted
+            if endpoint == 'getUpdates':
+                # Long-poll: its latency is the poll timeout, not Telegram's
+                return await callback(*args, **kwargs)
+            outbound_logger.info(f"bot api {endpoint}", extra={'endpoint': endpoint})
+            return await timed_outbound('telegram', callback, *args, **kwargs)
+        outbound_logger.info(f"bot api {endpoint}", extra={'endpoint': endpoint})
+        if isinstance(rate_limit_args, dict) and rate_limit_args.get('priority') in (0, 1, 2):
+            priority = rate_limit_args['priority']
+        chat_id = (data or {}).get('chat_id')
+        attempt = 0
+        while True:
+            if chat_id is not None:
+                delay = self._chat_delay(chat_id)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if self._dispatcher is not None:
+                await self._acquire(priority)
+            try:
+                result = await timed_outbound('telegram', callback, *args, **kwargs)
+                self.sent[priority] += 1
+                return result
+            except RetryAfter as e:
+                attempt += 1
+                self.retry_after_hits += 1
+                retry_after = e.retry_after
+                delay = float(retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else retry_after)
+                logger.warning(f"Bot API flood wait on {endpoint} (chat {chat_id}): retry in {delay}s (attempt {attempt})")
+                if attempt > self.max_retries:
+                    raise
+                # Per-chat waits happen in _chat_delay on the next pass; global pauses in the dispatcher
+                self._penalize(chat_id, delay)
+
+    def stats(self) -> dict:
+        return {
+            'queue_depth': {PRIORITY_NAMES[i]: self.queued[i] for i in range(3)},
+            'sent': {PRIORITY_NAMES[i]: self.sent[i] for i in range(3)},
+            'retry_after_hits': self.retry_after_hits,
+            'global_pauses': self.global_pauses,
+            'max_queue_depth': self.max_queue_depth,
+            'tracked_chats': len(self._chat_buckets),
+        }
+
+# Set in main(); None when running without an Application (tests/tools)
+outbound_scheduler = None
+
 async def begin_stage6_notify(user_id: int) -> bool:
     try:
         uid = int(user_id)
@@ -115,6 +1062,7 @@ async def end_stage6_notify(user_id: int, success: bool):
         st.pop('stage6_inflight', None)
         if success:
             st['stage6_notified'] = True
+            record_notification(6)
         user_state[uid] = st
         lock = notify_locks.get(uid)
         if lock and lock.locked():
@@ -125,59 +1073,378 @@ async def end_stage6_notify(user_id: int, success: bool):
     except Exception:
         pass
 
-async def upload_avatar_to_supabase(image_bytes: bytes, ext_hint: str, user_id: int) -> str:
+class AvatarCache:
+    """Content-addressed map of already-uploaded avatars.
+
+    Keyed by Telegram's file_unique_id (stable for the same file across bots and time) and by
+    the SHA-256 of the downloaded bytes, both pointing at the public Supabase URL. A file id hit
+    skips get_file, the download and the upload; a content hit (checked before uploading) skips
+    the upload and keeps the URL already on the profile, so the profile PUT is skipped too.
+    """
+
+    def __init__(self, max_entries: int = 50000):
+        self.max_entries = int(max_entries)
+        self._by_file = OrderedDict()
+        self._by_hash = OrderedDict()
+        self.hits = 0
+        self.content_hits = 0
+        self.misses = 0
+        self.uploads = 0
+        self.puts_skipped = 0
+
+    @staticmethod
+    def _lookup(table: OrderedDict, key):
+        url = table.get(key)
+        if url is not None:
+            table.move_to_end(key)
+        return url
+
+    def _store(self, table: OrderedDict, key, url: str):
+        table[key] = url
+        table.move_to_end(key)
+        while len(table) > self.max_entries:
+            table.popitem(last=False)
+
+    def by_file(self, file_unique_id):
+        return self._lookup(self._by_file, file_unique_id) if file_unique_id else None
+
+    def by_content(self, digest):
+        return self._lookup(self._by_hash, digest) if digest else None
+
+    def remember(self, file_unique_id, digest, url: str):
+        if not url:
+            return
+        if file_unique_id:
+            self._store(self._by_file, file_unique_id, url)
+        if digest:
+            self._store(self._by_hash, digest, url)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.content_hits + self.misses
+        return {
+            'hits': self.hits,
+            'content_hits': self.content_hits,
+            'misses': self.misses,
+            'hit_rate': round((self.hits + self.content_hits) / lookups, 3) if lookups else 0.0,
+            'uploads': self.uploads,
+            'puts_skipped': self.puts_skipped,
+            'entries': len(self._by_file),
+        }
+
+avatar_cache = AvatarCache(max_entries=int(os.getenv('AVATAR_CACHE_MAX', '50000')))
+# uid -> (session_id, username, display_name, photo_url) last written by the profile-only PUT
+avatar_profile_sent = {}
+
+# Image work (decode, resize, encode) runs in an executor so Pillow never blocks the event loop.
+# AVATAR_TRANSCODE_POOL=process uses worker processes instead of threads.
+AVATAR_THUMB_SIZES = tuple(int(x) for x in os.getenv('AVATAR_THUMB_SIZES', '64,160,320').split(',') if x.strip().isdigit())
+avatar_pool = None
+
+def get_avatar_pool():
+    global avatar_pool
+    if avatar_pool is None:
+        workers = int(os.getenv('AVATAR_TRANSCODE_WORKERS', '2'))
+        if os.getenv('AVATAR_TRANSCODE_POOL', 'thread').strip().lower() == 'process':
+            avatar_pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        else:
+            avatar_pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='avatar')
+    return avatar_pool
+
+def shutdown_avatar_pool():
+    global avatar_pool
+    if avatar_pool is not None:
+        avatar_pool.shutdown(wait=False, cancel_futures=True)
+        avatar_pool = None
+
+# Avatar bytes move in AVATAR_STREAM_CHUNK pieces; AVATAR_SPOOL_MAX bounds how much of the image a
+# job keeps in memory for the thumbnail/transcode pass before spilling to a temp file.
+AVATAR_STREAM_CHUNK = int(os.getenv('AVATAR_STREAM_CHUNK', str(64 * 1024)))
+AVATAR_SPOOL_MAX = int(os.getenv('AVATAR_SPOOL_MAX', str(256 * 1024)))
+
+def _avatar_ext(ext_hint: str) -> str:
+    eh = (ext_hint or '').lower()
+    if '.png' in eh or eh == 'png':
+        return 'png'
+    if '.webp' in eh or eh == 'webp':
+        return 'webp'
+    if '.jpeg' in eh or eh == 'jpeg':
+        return 'jpeg'
+    return 'jpg'
+
+def _supabase_storage():
+    """(base_url, service_key, bucket) for avatar uploads, or None when storage is not configured."""
+    base = os.getenv('SUPABASE_URL', '').strip() or os.getenv('NEXT_PUBLIC_SUPABASE_URL', '').strip()
+    service_key = os.getenv('SUPABASE_SERVICE_ROLE_KEY', '').strip() or os.getenv('SUPABASE_ANON_KEY', '').strip()
+    bucket = os.getenv('SUPABASE_AVATAR_BUCKET', 'tg-avatars').strip()
+    if not base or not service_key or httpx is None:
+        return None
+    return base.rstrip('/'), service_key, bucket
+
+def _source_bytes(source) -> bytes:
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source)
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            return f.read()
+    source.seek(0)
+    return source.read()
+
+def _avatar_spool():
+    """Spool for the thumbnail pass: in memory up to AVATAR_SPOOL_MAX, or for process pools a named
+    temp file, which workers reopen by path instead of receiving the image through the pipe."""
+    if isinstance(get_avatar_pool(), concurrent.futures.ProcessPoolExecutor):
+        return tempfile.NamedTemporaryFile(prefix='avatar-')
+    return tempfile.SpooledTemporaryFile(max_size=AVATAR_SPOOL_MAX)
+
+def render_avatar(source, ext: str, thumb_sizes=(), include_full: bool = True) -> list:
+    """Decode once and produce renditions: [(suffix, ext, bytes)], the full-size image first.
+
+    source is bytes, a seekable binary file or a file path. WebP is transcoded to JPEG for bucket policy
+    compliance; thumbnails are JPEGs bounded to each size (never upscaled). Thumbnail-only runs
+    (include_full=False) let JPEG decode at reduced scale. Runs in the avatar pool.
+    """
+    if include_full and ext != 'webp' and not thumb_sizes:
+        return [('', ext, _source_bytes(source))]
+    try:
+        from PIL import Image
+        if not isinstance(source, (bytes, bytearray, memoryview, str)):
+            source.seek(0)
+        img = Image.open(BytesIO(source) if isinstance(source, (bytes, bytearray, memoryview)) else source)
+        if not include_full and thumb_sizes:
+            img.draft('RGB', (max(thumb_sizes), max(thumb_sizes)))
+        img = img.convert('RGB')
+    except Exception:
+        # Fallback: just mark as jpeg; many clients accept it regardless
+        return [('', 'jpg' if ext == 'webp' else ext, _source_bytes(source))] if include_full else []
+    renditions = []
+    if include_full:
+        if ext == 'webp':
+            bio_out = BytesIO()
+            img.save(bio_out, format='JPEG', quality=88)
+            renditions.append(('', 'jpg', bio_out.getvalue()))
+        else:
+            renditions.append(('', ext, _source_bytes(source)))
+    # Largest first, each thumbnail resized from the previous one
+    current = img
+    for size in sorted(set(thumb_sizes), reverse=True):
+        current = current.copy()
+        current.thumbnail((size, size))
+        bio_out = BytesIO()
+        current.save(bio_out, format='JPEG', quality=85)
+        renditions.append((f"_{size}", 'jpg', bio_out.getvalue()))
+    return renditions
+
+async def _render_in_pool(source, ext: str, thumb_sizes=(), include_full: bool = True) -> list:
+    pool = get_avatar_pool()
+    if isinstance(pool, concurrent.futures.ProcessPoolExecutor) and not isinstance(source, (bytes, bytearray, str)):
+        # File objects do not cross process boundaries; a named spool is reopened by path
+        if isinstance(getattr(source, 'name', None), str):
+            source.flush()
+            source = source.name
+        else:
+            source = _source_bytes(source)
+    return await asyncio.get_running_loop().run_in_executor(pool, render_avatar, source, ext, thumb_sizes, include_full)
+
+async def _put_storage_object(storage, key: str, ext: str, content, length: int = None) -> str:
+    """PUT one object (bytes or an async byte iterator) into the avatar bucket; returns its public URL or ''."""
+    base, service_key, bucket = storage
+    headers = {
+        'Authorization': f"Bearer {service_key}",
+        'apikey': service_key,
+        'Content-Type': f"image/{ext if ext != 'jpg' else 'jpeg'}",
+        'x-upsert': 'true'
+    }
+    if length:
+        headers['Content-Length'] = str(int(length))
+    client = get_http_client('supabase')
+    resp = await client.put(base + f"/storage/v1/object/{bucket}/{key}", headers=headers, content=content)
+    if 200 <= resp.status_code < 300:
+        return base + f"/storage/v1/object/public/{bucket}/{key}"
+    logger.warning(f"Supabase avatar upload failed ({key}): {resp.status_code} {resp.text}")
+    return ''
+
+async def _put_renditions(storage, stem: str, renditions: list) -> list:
+    results = await asyncio.gather(
+        *(_put_storage_object(storage, f"{stem}{suffix}.{ext}", ext, body) for suffix, ext, body in renditions),
+        return_exceptions=True
+    )
+    return [r if isinstance(r, str) else '' for r in results]
+
+async def upload_avatar_to_supabase(image_bytes: bytes, ext_hint: str, user_id: int, content_key: str = None) -> str:
+    """Upload an in-memory avatar and its thumbnails (<key>_<size>.jpg); returns the full-size public URL."""
     try:
-        base = os.getenv('SUPABASE_URL', '').strip() or os.getenv('NEXT_PUBLIC_SUPABASE_URL', '').strip()
-        service_key = os.getenv('SUPABASE_SERVICE_ROLE_KEY', '').strip() or os.getenv('SUPABASE_ANON_KEY', '').strip()
-        bucket = os.getenv('SUPABASE_AVATAR_BUCKET', 'tg-avatars').strip()
-        if not base or not service_key or httpx is None:
+        storage = _supabase_storage()
+        if storage is None:
             return ''
-        ext = 'jpg'
-        try:
-            eh = (ext_hint or '').lower()
-            if '.png' in eh or eh == 'png':
-                ext = 'png'
-            elif '.webp' in eh or eh == 'webp':
-                ext = 'webp'
-            elif '.jpeg' in eh or eh == 'jpeg':
-                ext = 'jpeg'
-        except Exception:
-            pass
-        # Transcode unsupported formats (e.g., webp) to jpeg for bucket policy compliance
-        try:
-            if ext == 'webp':
-                try:
-                    from PIL import Image
-                    bio_in = BytesIO(image_bytes)
-                    img = Image.open(bio_in).convert('RGB')
-                    bio_out = BytesIO()
-                    img.save(bio_out, format='JPEG', quality=88)
-                    image_bytes = bio_out.getvalue()
-                    ext = 'jpg'
-                except Exception:
-                    # Fallback: just mark as jpeg; many clients accept it regardless
-                    ext = 'jpg'
-        except Exception:
-            pass
-        key = f"tg/{int(user_id)}/{int(time.time())}.{ext}"
-        url = base.rstrip('/') + f"/storage/v1/object/{bucket}/{key}"
-        headers = {
-            'Authorization': f"Bearer {service_key}",
-            'apikey': service_key,
-            'Content-Type': f"image/{ext if ext != 'jpg' else 'jpeg'}"
-        }
-        async with httpx.AsyncClient(timeout=20.0) as client:
-            resp = await client.put(url, headers=headers, content=image_bytes)
-            if 200 <= resp.status_code < 300:
-                public_url = base.rstrip('/') + f"/storage/v1/object/public/{bucket}/{key}"
-                return public_url
-            else:
-                logger.warning(f"Supabase avatar upload failed: {resp.status_code} {resp.text}")
-                return ''
+        renditions = await _render_in_pool(image_bytes, _avatar_ext(ext_hint), AVATAR_THUMB_SIZES)
+        # Content-addressed keys make re-uploads of the same image idempotent
+        urls = await _put_renditions(storage, f"tg/{int(user_id)}/{content_key or int(time.time())}", renditions)
+        return urls[0] if urls else ''
     except Exception as e:
         logger.error(f"upload_avatar_to_supabase error: {str(e)}")
         return ''
 
+async def iter_telegram_file(tg_file, chunk_size: int = AVATAR_STREAM_CHUNK):
+    """Yield a Telegram file's bytes as memoryview chunks as they arrive from the Bot API file endpoint."""
+    path = getattr(tg_file, 'file_path', '') or ''
+    if not path.startswith(('http://', 'https://')):
+        # Local Bot API server mode: file_path is on disk, nothing to stream over the network
+        bio = BytesIO()
+        await tg_file.download_to_memory(out=bio)
+        view = bio.getbuffer()
+        for i in range(0, len(view), chunk_size):
+            yield view[i:i + chunk_size]
+        return
+    client = get_http_client('telegram')
+    async with client.stream('GET', path) as resp:
+        resp.raise_for_status()
+        async for chunk in resp.aiter_bytes(chunk_size):
+            yield memoryview(chunk)
+
+async def stream_avatar_to_supabase(tg_file, user_id: int, file_key: str = None, known=None) -> tuple:
+    """Spool and hash a Telegram file, then upload it to Supabase storage in chunks; returns
+    (public_url, sha256 hex, reused).
+
+    The hash is taken before anything is written to storage: when known(digest) returns a URL
+    (the same picture under a new file id) that URL comes back with reused=True and the upload
+    and thumbnail pass are skipped. Memory per job is bounded by the chunk size plus
+    AVATAR_SPOOL_MAX whatever the image size.
+    """
+    storage = _supabase_storage()
+    if storage is None:
+        return '', None, False
+    ext = _avatar_ext(getattr(tg_file, 'file_path', '') or '')
+    stem = f"tg/{int(user_id)}/{file_key or int(time.time())}"
+    hasher = hashlib.sha256()
+    with _avatar_spool() as spool:
+        size = 0
+        async for chunk in iter_telegram_file(tg_file):
+            hasher.update(chunk)
+            spool.write(chunk)
+            size += len(chunk)
+        digest = hasher.hexdigest()
+        canonical = known(digest) if known is not None else None
+        if canonical:
+            return canonical, digest, True
+        if ext == 'webp':
+            urls = await _put_renditions(storage, stem, await _render_in_pool(spool, ext, AVATAR_THUMB_SIZES))
+            return (urls[0] if urls else ''), digest, False
+
+        async def body():
+            spool.seek(0)
+            while True:
+                chunk = spool.read(AVATAR_STREAM_CHUNK)
+                if not chunk:
+                    return
+                yield chunk
+
+        public_url = await _put_storage_object(storage, f"{stem}.{ext}", ext, body(), size)
+        if public_url and AVATAR_THUMB_SIZES:
+            await _put_renditions(storage, stem, await _render_in_pool(spool, ext, AVATAR_THUMB_SIZES, include_full=False))
+        return public_url, digest, False
+
+class AvatarJobQueue:
+    """Bounded background queue for capture_and_cache_tg_profile.
+
+    At most one job per user is pending (a newer /start replaces the queued update); when the
+    queue is full new users are rejected instead of spawning unbounded downloads and uploads.
+    """
+
+    def __init__(self, workers: int = 4, max_pending: int = 1000):
+        self.workers = max(1, int(workers))
+        self.max_pending = max(1, int(max_pending))
+        self._queue = None
+        self._pending = {}
+        self._running = set()
+        self._deferred = set()   # users whose pending job waits for their running one to finish
+        self._tasks = []
+        self.submitted = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+
+    def start(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._tasks = [t for t in self._tasks if not t.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, update, context) -> bool:
+        """Queue a profile capture for the update's user; returns False when rejected for backpressure."""
+        user = update.effective_user if update else None
+        if user is None:
+            return False
+        if not self._tasks:
+            self.start()
+        uid = int(user.id)
+        self.submitted += 1
+        if uid in self._pending:
+            self._pending[uid] = (update, context)
+            self.coalesced += 1
+            return True
+        try:
+            self._queue.put_nowait(uid)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self._pending[uid] = (update, context)
+        return True
+
+    async def _worker(self):
+        while True:
+            uid = await self._queue.get()
+            job = self._pending.pop(uid, None)
+            if job is None:
+                continue
+            if uid in self._running:
+                # Another worker owns this user right now; it re-enqueues the newest job when done
+                self._pending[uid] = job
+                self._deferred.add(uid)
+                continue
+            while job is not None:
+                self._running.add(uid)
+                try:
+                    await capture_and_cache_tg_profile(*job)
+                    self.completed += 1
+                except Exception as e:
+                    self.failed += 1
+                    logger.debug(f"avatar job failed for user {uid}: {str(e)}")
+                finally:
+                    self._running.discard(uid)
+                    job = None
+                    if uid in self._deferred:
+                        self._deferred.discard(uid)
+                        try:
+                            self._queue.put_nowait(uid)
+                        except asyncio.QueueFull:
+                            # No room: run the user's newest job on this worker rather than drop it
+                            job = self._pending.pop(uid, None)
+
+    def stats(self) -> dict:
+        return {
+            'pending': len(self._pending),
+            'running': len(self._running),
+            'deferred': len(self._deferred),
+            'submitted': self.submitted,
+            'coalesced': self.coalesced,
+            'rejected': self.rejected,
+            'completed': self.completed,
+            'failed': self.failed,
+        }
+
+avatar_jobs = AvatarJobQueue(
+    workers=int(os.getenv('AVATAR_JOB_WORKERS', '4')),
+    max_pending=int(os.getenv('AVATAR_JOB_QUEUE', '1000')),
+)
+
 async def capture_and_cache_tg_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> dict:
     profile = {
         'tg_username': None,
@@ -199,28 +1466,45 @@ async def capture_and_cache_tg_profile(update: Update, context: ContextTypes.DEF
         try:
             photos = await context.bot.get_user_profile_photos(uid, limit=1)
             file_id = None
+            file_uid = None
             if photos and photos.total_count and photos.photos:
                 first = photos.photos[0]
                 size = first[-1] if isinstance(first, (list, tuple)) else first
                 file_id = getattr(size, 'file_id', None)
+                file_uid = getattr(size, 'file_unique_id', None)
             # Fallback to chat photo if profile_photos missing
             if not file_id:
                 try:
                     chat = await context.bot.get_chat(uid)
                     if chat and getattr(chat, 'photo', None):
                         file_id = chat.photo.big_file_id or chat.photo.small_file_id
+                        file_uid = chat.photo.big_file_unique_id if chat.photo.big_file_id else chat.photo.small_file_unique_id
                 except Exception:
                     pass
             if file_id:
-                tg_file = await context.bot.get_file(file_id)
-                bio = BytesIO()
-                await tg_file.download_to_memory(out=bio)
-                bio.seek(0)
-                data = bio.getvalue()
-                ext_hint = getattr(tg_file, 'file_path', '') or ''
-                public_url = await upload_avatar_to_supabase(data, ext_hint, uid)
+                public_url = avatar_cache.by_file(file_uid)
+                if public_url is None and file_uid:
+                    # Survives restarts via the persisted user session
+                    prev = user_state.peek(uid)
+                    if prev is not None and prev.get('tg_photo_file_uid') == file_uid and prev.get('tg_photo_url'):
+                        public_url = prev.get('tg_photo_url')
+                        avatar_cache.remember(file_uid, None, public_url)
+                if public_url is not None:
+                    avatar_cache.hits += 1
+                else:
+                    tg_file = await context.bot.get_file(file_id)
+                    # Same picture under a new file id: nothing is uploaded, the URL already on the profile is kept
+                    public_url, digest, reused = await stream_avatar_to_supabase(tg_file, uid, file_uid, known=avatar_cache.by_content)
+                    if reused:
+                        avatar_cache.content_hits += 1
+                    else:
+                        avatar_cache.misses += 1
+                        if public_url:
+                            avatar_cache.uploads += 1
+                    avatar_cache.remember(file_uid, digest, public_url)
                 if public_url:
                     profile['tg_photo_url'] = public_url
+                    profile['tg_photo_file_uid'] = file_uid
                     # Profile-only backfill (does not change stage)
                     try:
                         if httpx is not None:
@@ -234,19 +1518,24 @@ async def capture_and_cache_tg_profile(update: Update, context: ContextTypes.DEF
                                         _, sess = await is_linked_for_user(uid)
                                     except Exception:
                                         sess = None
-                                if sess:
+                                sent_key = (sess, uname, dname, public_url)
+                                if sess and avatar_profile_sent.get(uid) == sent_key:
+                                    avatar_cache.puts_skipped += 1
+                                elif sess:
                                     url = base.rstrip('/') + f"/api/state?session={sess}"
                                     body = {"tg_username": uname, "tg_display_name": dname, "tg_photo_url": public_url}
-                                    async with httpx.AsyncClient(timeout=10.0) as client:
-                                        await client.put(
-                                            url,
-                                            headers={
-                                                "Content-Type": "application/json",
-                                                "Authorization": f"Bearer {token}",
-                                                "X-Profile-Only": "1"
-                                            },
-                                            json=body
-                                        )
+                                    client = get_http_client('state')
+                                    resp = await client.put(
+                                        url,
+                                        headers={
+                                            "Content-Type": "application/json",
+                                            "Authorization": f"Bearer {token}",
+                                            "X-Profile-Only": "1"
+                                        },
+                                        json=body
+                                    )
+                                    if 200 <= resp.status_code < 300:
+                                        avatar_profile_sent[uid] = sent_key
                     except Exception as ee:
                         logger.debug(f"Avatar profile-only PUT failed for user {uid}: {str(ee)}")
         except Exception as e:
@@ -256,6 +1545,7 @@ async def capture_and_cache_tg_profile(update: Update, context: ContextTypes.DEF
         st['tg_username'] = profile['tg_username']
         st['tg_display_name'] = profile['tg_display_name']
         st['tg_photo_url'] = profile['tg_photo_url']
+        st['tg_photo_file_uid'] = profile.get('tg_photo_file_uid')
         user_state[uid] = st
         return profile
     except Exception:
@@ -286,87 +1576,185 @@ async def guard_midflow_and_remind(update: Update, context: ContextTypes.DEFAULT
         pass
     return False
 
+# Per-chat command menus. Each set is tagged with a digest of its contents; chat_command_scopes
+# remembers the tag Telegram last acknowledged per chat, so setMyCommands only goes out on change.
+COMMAND_SETS = {
+    'linked': (
+        ("start", "Intro to XREX Pay Bot"),
+        ("check_wallet", "Check any wallet address"),
+        # ("otc_quote", "Request a quote"),
+        ("unlink_account", "Unlink from XREX Pay"),
+        ("help", "We’re here to help!"),
+    ),
+    'unlinked': (
+        ("start", "Intro to XREX Pay Bot"),
+        ("link_account", "Link with XREX Pay"),
+        ("help", "We’re here to help!"),
+    ),
+}
+COMMAND_SET_TAGS = {name: f"{name}:{zlib.crc32(repr(cmds).encode('utf-8')):08x}" for name, cmds in COMMAND_SETS.items()}
+COMMAND_RESYNC_CONCURRENCY = int(os.getenv('COMMAND_RESYNC_CONCURRENCY', '20'))
+chat_command_scopes = {}
+command_scope_locks = {}
+command_scope_stats = {'sent': 0, 'suppressed': 0, 'failed': 0, 'resynced': 0}
+
+async def apply_chat_commands(bot, chat_id: int, name: str, force: bool = False) -> bool:
+    """Give a chat the named command set; returns True if a setMyCommands call was made."""
+    chat_id = int(chat_id)
+    tag = COMMAND_SET_TAGS[name]
+    lock = command_scope_locks.get(chat_id)
+    if lock is None:
+        lock = command_scope_locks[chat_id] = asyncio.Lock()
+    async with lock:
+        if not force and chat_command_scopes.get(chat_id) == tag:
+            command_scope_stats['suppressed'] += 1
+            return False
+        try:
+            await bot.set_my_commands(commands=[BotCommand(c, d) for c, d in COMMAND_SETS[name]], scope=BotCommandScopeChat(chat_id))
+        except Exception as e:
+            command_scope_stats['failed'] += 1
+            # Server-side menu is unknown now: the next call must go out
+            if chat_command_scopes.pop(chat_id, None) is not None:
+                persist_chat_commands(chat_id)
+            logger.debug(f"setMyCommands({name}) failed for chat {chat_id}: {str(e)}")
+            return False
+        chat_command_scopes[chat_id] = tag
+        command_scope_stats['sent'] += 1
+        persist_chat_commands(chat_id)
+        return True
+
 async def set_commands_linked(bot, chat_id: int):
     try:
-        cmds = [
-            BotCommand("start", "Intro to XREX Pay Bot"),
-            BotCommand("check_wallet", "Check any wallet address"),
-            # BotCommand("otc_quote", "Request a quote"),
-            BotCommand("unlink_account", "Unlink from XREX Pay"),
-            BotCommand("help", "We’re here to help!")
-        ]
-        await bot.set_my_commands(commands=cmds, scope=BotCommandScopeChat(chat_id))
+        await apply_chat_commands(bot, chat_id, 'linked')
     except Exception:
         pass
 
 async def set_commands_unlinked(bot, chat_id: int):
     try:
-        cmds = [
-            BotCommand("start", "Intro to XREX Pay Bot"),
-            BotCommand("link_account", "Link with XREX Pay"),
-            BotCommand("help", "We’re here to help!")
-        ]
-        await bot.set_my_commands(commands=cmds, scope=BotCommandScopeChat(chat_id))
+        await apply_chat_commands(bot, chat_id, 'unlinked')
     except Exception:
         pass
 
-async def is_linked_for_user(tg_user_id: int):
-    """Query server by Telegram user id to determine if user is linked.
-    Returns (linked_bool, session_id_or_None).
+async def resync_chat_commands(bot):
+    """Startup pass: re-send command sets whose definition changed since the chat last received them.
+
+    Calls queue at commands priority in the outbound scheduler, so a large resync never delays replies.
     """
-    if httpx is None:
-        return False, None
-    base = os.getenv("STATE_BASE_URL", "").strip() or "https://xrextgbot.vercel.app"
-    url = base.rstrip('/') + f"/api/state?tg={tg_user_id}"
+    t0 = time.perf_counter()
+    bot_call_priority.set(PRIORITY_COMMANDS)
+    stale = []
+    for chat_id, tag in list(chat_command_scopes.items()):
+        name = tag.split(':', 1)[0]
+        if name not in COMMAND_SET_TAGS:
+            chat_command_scopes.pop(chat_id, None)
+            persist_chat_commands(chat_id)
+        elif tag != COMMAND_SET_TAGS[name]:
+            stale.append((chat_id, name))
+    if not stale:
+        return
+    sem = asyncio.Semaphore(max(1, COMMAND_RESYNC_CONCURRENCY))
+
+    async def _one(chat_id, name):
+        async with sem:
+            if await apply_chat_commands(bot, chat_id, name, force=True):
+                command_scope_stats['resynced'] += 1
+
+    await asyncio.gather(*(_one(chat_id, name) for chat_id, name in stale), return_exceptions=True)
+    logger.info(f"command menus: resynced {command_scope_stats['resynced']}/{len(stale)} chats in {(time.perf_counter() - t0) * 1000:.0f} ms")
+
+# Per-user linkage cache: uid -> (expires_at, linked, session_id, stage). Positive and negative
+# answers get separate TTLs; entries are dropped as soon as a stage transition is seen for the user.
+LINK_CACHE_TTL = float(os.getenv('LINK_CACHE_TTL', '300'))
+LINK_CACHE_NEGATIVE_TTL = float(os.getenv('LINK_CACHE_NEGATIVE_TTL', '20'))
+link_cache = {}
+link_cache_gen = {}
+link_inflight = {}
+
+def invalidate_link_cache(user_id):
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            r = await client.get(url)
-            if r.status_code == 200:
-                d = r.json() or {}
-                try:
-                    stage = int(d.get('stage') or 0)
-                except Exception:
-                    stage = 0
-                linked = (stage >= 6 and stage != 7)
-                return linked, d.get('session_id')
+        uid = int(user_id)
+        link_cache.pop(uid, None)
+        # Bump generation so an in-flight lookup started before the transition is not cached
+        link_cache_gen[uid] = link_cache_gen.get(uid, 0) + 1
     except Exception:
         pass
-    return False, None
+
+async def _fetch_link_state(uid: int):
+    gen = link_cache_gen.get(uid, 0)
+    base = os.getenv("STATE_BASE_URL", "").strip() or "https://xrextgbot.vercel.app"
+    url = base.rstrip('/') + f"/api/state?tg={uid}"
+    client = get_http_client('state')
+    r = await client.get(url)
+    if r.status_code != 200:
+        return False, None, None
+    d = r.json() or {}
+    try:
+        stage = int(d.get('stage') or 0)
+    except Exception:
+        stage = 0
+    linked = (stage >= 6 and stage != 7)
+    sess = d.get('session_id')
+    if link_cache_gen.get(uid, 0) == gen:
+        ttl = LINK_CACHE_TTL if linked else LINK_CACHE_NEGATIVE_TTL
+        link_cache[uid] = (time.monotonic() + ttl, linked, sess, stage)
+    return linked, sess, stage
+
+async def get_link_state(tg_user_id: int):
+    """Cached (linked, session_id, stage) for a Telegram user; stage is None if the lookup failed.
+    Concurrent misses for the same user share one request.
+    """
+    if httpx is None:
+        return False, None, None
+    uid = int(tg_user_id)
+    hit = link_cache.get(uid)
+    if hit is not None:
+        if hit[0] > time.monotonic():
+            return hit[1], hit[2], hit[3]
+        link_cache.pop(uid, None)
+    fut = link_inflight.get(uid)
+    if fut is None:
+        fut = asyncio.ensure_future(_fetch_link_state(uid))
+        link_inflight[uid] = fut
+        fut.add_done_callback(lambda _f, uid=uid: link_inflight.pop(uid, None))
+    try:
+        return await asyncio.shield(fut)
+    except Exception:
+        return False, None, None
+
+async def is_linked_for_user(tg_user_id: int):
+    """Query server by Telegram user id to determine if user is linked.
+    Returns (linked_bool, session_id_or_None).
+    """
+    linked, sess, _ = await get_link_state(tg_user_id)
+    return linked, sess
 
 async def maybe_notify_link_success(user_id: int, chat_id: int):
     """Fallback: if remote shows stage 6 for this user and we haven't notified, send success now."""
     try:
         if httpx is None:
             return
-        base = os.getenv("STATE_BASE_URL", "").strip() or "https://xrextgbot.vercel.app"
-        url = base.rstrip('/') + f"/api/state?tg={user_id}"
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            r = await client.get(url)
-            if r.status_code != 200:
+        _, _, stage = await get_link_state(user_id)
+        if stage == 6:
+            st = user_state.get(user_id, {})
+            if st.get('stage6_notified'):
                 return
-            data = r.json() or {}
-            stage = int(data.get('stage') or 0)
-            if stage == 6:
-                st = user_state.get(user_id, {})
-                if st.get('stage6_notified'):
-                    return
-                if bot_for_notifications and await begin_stage6_notify(user_id):
-                    ok = False
+            if bot_for_notifications and await begin_stage6_notify(user_id):
+                ok = False
+                try:
+                    reply_markup = build_linked_keyboard()
+                    await bot_for_notifications.send_message(
+                        chat_id=chat_id,
+                        text=("🎉️ Successfully linked to XREX Pay account @AG*CH.\n\n"
+                             "👉 Tap the ‘How to use’ button to explore XREX Pay Bot features."),
+                        reply_markup=reply_markup
+                    )
                     try:
-                        reply_markup = build_linked_keyboard()
-                        await bot_for_notifications.send_message(
-                            chat_id=chat_id,
-                            text=("🎉️ Successfully linked to XREX Pay account @AG*CH.\n\n"
-                                 "👉 Tap the ‘How to use’ button to explore XREX Pay Bot features."),
-                            reply_markup=reply_markup
-                        )
-                        try:
-                            await set_commands_linked(bot_for_notifications, chat_id)
-                        except Exception:
-                            pass
-                        ok = True
-                    finally:
-                        await end_stage6_notify(user_id, ok)
+                        await set_commands_linked(bot_for_notifications, chat_id)
+                    except Exception:
+                        pass
+                    ok = True
+                finally:
+                    await end_stage6_notify(user_id, ok)
     except Exception:
         pass
 
@@ -382,6 +1770,7 @@ def ensure_finalize_watch(tg_user_id: int, chat_id: int):
 async def watch_finalize_for_user(tg_user_id: int, chat_id: int, timeout_seconds: int = 15):
     if httpx is None:
         return
+    bot_call_priority.set(PRIORITY_NOTIFICATION)
     base = os.getenv("STATE_BASE_URL", "").strip() or "https://xrextgbot.vercel.app"
     url = base.rstrip('/') + f"/api/state?tg={tg_user_id}"
     started = int(time.time())
@@ -389,63 +1778,63 @@ async def watch_finalize_for_user(tg_user_id: int, chat_id: int, timeout_seconds
     try:
         while (int(time.time()) - started) <= int(timeout_seconds):
             try:
-                async with httpx.AsyncClient(timeout=10.0) as client:
-                    r = await client.get(url)
-                    if r.status_code == 200:
-                        d = r.json() or {}
+                client = get_http_client('state')
+                r = await client.get(url)
+                if r.status_code == 200:
+                    d = r.json() or {}
+                    stage = 0
+                    try:
+                        stage = int(d.get('stage') or 0)
+                    except Exception:
                         stage = 0
-                        try:
-                            stage = int(d.get('stage') or 0)
-                        except Exception:
-                            stage = 0
-                        # Optional: if stuck at stage 5 (code submitted), we can (optionally) push finalize->6
-                        # Gate behind env FORCE_FINALIZE_STAGE5=1 and use a conservative delay to avoid premature finalize
-                        try:
-                            if os.getenv('FORCE_FINALIZE_STAGE5', '0') == '1':
-                                if stage == 5 and (d.get('twofa_verified') is True) and (d.get('linking_code')):
-                                    if stage4_seen_ts == 0:
-                                        stage4_seen_ts = int(time.time())
-                                    elif (int(time.time()) - stage4_seen_ts) >= 5:
-                                        sess_id = d.get('session_id')
-                                        if sess_id:
-                                            fin_url = (base.rstrip('/') + "/api/state") + f"?session={sess_id}"
-                                            try:
-                                                await client.put(fin_url, headers={"Content-Type": "application/json", "X-Client-Stage": "6"}, json={"stage": 6})
-                                            except Exception:
-                                                pass
-                                else:
-                                    stage4_seen_ts = 0
+                    # Optional: if stuck at stage 5 (code submitted), we can (optionally) push finalize->6
+                    # Gate behind env FORCE_FINALIZE_STAGE5=1 and use a conservative delay to avoid premature finalize
+                    try:
+                        if os.getenv('FORCE_FINALIZE_STAGE5', '0') == '1':
+                            if stage == 5 and (d.get('twofa_verified') is True) and (d.get('linking_code')):
+                                if stage4_seen_ts == 0:
+                                    stage4_seen_ts = int(time.time())
+                                elif (int(time.time()) - stage4_seen_ts) >= 5:
+                                    sess_id = d.get('session_id')
+                                    if sess_id:
+                                        fin_url = (base.rstrip('/') + "/api/state") + f"?session={sess_id}"
+                                        try:
+                                            await client.put(fin_url, headers={"Content-Type": "application/json", "X-Client-Stage": "6"}, json={"stage": 6})
+                                        except Exception:
+                                            pass
                             else:
                                 stage4_seen_ts = 0
-                        except Exception:
-                            pass
-                        if stage >= 6 and stage != 7:
-                            st = user_state.get(tg_user_id, {})
-                            if st.get('stage6_notified'):
-                                break
-                            if bot_for_notifications and await begin_stage6_notify(tg_user_id):
-                                ok = False
+                        else:
+                            stage4_seen_ts = 0
+                    except Exception:
+                        pass
+                    if stage >= 6 and stage != 7:
+                        st = user_state.get(tg_user_id, {})
+                        if st.get('stage6_notified'):
+                            break
+                        if bot_for_notifications and await begin_stage6_notify(tg_user_id):
+                            ok = False
+                            try:
+                                reply_markup = build_linked_keyboard()
                                 try:
-                                    reply_markup = build_linked_keyboard()
+                                    await bot_for_notifications.send_message(
+                                        chat_id=int(chat_id),
+                                        text=("🎉️ Successfully linked to XREX Pay account @AG*CH.\n\n"
+                                             "👉 Tap the ‘How to use’ button to explore XREX Pay Bot features."),
+                                        reply_markup=reply_markup
+                                    )
                                     try:
-                                        await bot_for_notifications.send_message(
-                                            chat_id=int(chat_id),
-                                            text=("🎉️ Successfully linked to XREX Pay account @AG*CH.\n\n"
-                                                 "👉 Tap the ‘How to use’ button to explore XREX Pay Bot features."),
-                                            reply_markup=reply_markup
-                                        )
-                                        try:
-                                            await set_commands_linked(bot_for_notifications, int(chat_id))
-                                        except Exception:
-                                            pass
-                                        st['chat_id'] = int(chat_id)
-                                        user_state[tg_user_id] = st
-                                        ok = True
+                                        await set_commands_linked(bot_for_notifications, int(chat_id))
                                     except Exception:
                                         pass
-                                finally:
-                                    await end_stage6_notify(tg_user_id, ok)
-                            break
+                                    st['chat_id'] = int(chat_id)
+                                    user_state[tg_user_id] = st
+                                    ok = True
+                                except Exception:
+                                    pass
+                            finally:
+                                await end_stage6_notify(tg_user_id, ok)
+                        break
             except Exception:
                 pass
             await asyncio.sleep(1.0)
@@ -492,55 +1881,61 @@ async def push_state(stage: int = None, twofa_verified: bool = None, linking_cod
     token = os.getenv("STATE_WRITE_TOKEN", "").strip()
     if base and token:
         try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                url = base.rstrip('/') + "/api/state"
-                if session_id:
-                    url = url + ("?session=" + session_id)
+            client = get_http_client('state')
+            url = base.rstrip('/') + "/api/state"
+            if session_id:
+                url = url + ("?session=" + session_id)
+            try:
+                logger.info(f"push_state: PUT {url} stage={payload.get('stage')} twofa={payload.get('twofa_verified')} actor_uid={actor_tg_user_id} actor_chat={actor_chat_id}")
+            except Exception:
+                pass
+            resp = await client.put(
+                url,
+                headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
+                json=payload
+            )
+            if 200 <= resp.status_code < 300:
+                logger.info(f"Pushed state to Vercel stage={payload['stage']} twofa={payload['twofa_verified']}")
+                if actor_tg_user_id is not None:
+                    invalidate_link_cache(actor_tg_user_id)
+                # Watch this session in the shared poller (so we can detect stage 6 for this visitor)
                 try:
-                    logger.info(f"push_state: PUT {url} stage={payload.get('stage')} twofa={payload.get('twofa_verified')} actor_uid={actor_tg_user_id} actor_chat={actor_chat_id}")
+                    if session_id:
+                        watch_session(session_id)
+                        # Track actor for this session for targeted notifications
+                        try:
+                            global session_subscriptions
+                            if actor_tg_user_id is not None and actor_chat_id is not None:
+                                info = session_subscriptions.get(session_id, {})
+                                info['user_id'] = int(actor_tg_user_id)
+                                info['chat_id'] = int(actor_chat_id)
+                                info['expiry_notified'] = False
+                                session_subscriptions[session_id] = info
+                                claim_session_watch(int(actor_tg_user_id), session_id)
+                                persist_session(session_id)
+                        except Exception:
+                            pass
                 except Exception:
                     pass
-                resp = await client.put(
-                    url,
-                    headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
-                    json=payload
-                )
-                if 200 <= resp.status_code < 300:
-                    logger.info(f"Pushed state to Vercel stage={payload['stage']} twofa={payload['twofa_verified']}")
-                    # Start per-session poller (so we can detect stage 6 for this visitor)
-                    try:
-                        if session_id:
-                            if session_id not in session_poll_tasks or session_poll_tasks[session_id].done():
-                                logger.info(f"push_state: starting poller for session {session_id}")
-                                session_poll_tasks[session_id] = asyncio.create_task(poll_remote_and_sync(session_id=session_id))
-                            # Track actor for this session for targeted notifications
-                            try:
-                                global session_subscriptions
-                                if actor_tg_user_id is not None and actor_chat_id is not None:
-                                    info = session_subscriptions.get(session_id, {})
-                                    info['user_id'] = int(actor_tg_user_id)
-                                    info['chat_id'] = int(actor_chat_id)
-                                    info['expiry_notified'] = False
-                                    session_subscriptions[session_id] = info
-                            except Exception:
-                                pass
-                    except Exception:
-                        pass
-                    return True
-                else:
-                    logger.error(f"Vercel state push failed: {resp.status_code} {resp.text}")
+                return True
+            else:
+                logger.error(f"Vercel state push failed: {resp.status_code} {resp.text}")
         except Exception as e:
             logger.error(f"Error pushing to Vercel state: {str(e)}")
-    # Fallback: even if we couldn't write (missing token/network), still start poller for this session
+    # Fallback: even if we couldn't write (missing token/network), still watch this session
     try:
         if session_id:
-            if session_id not in session_poll_tasks or session_poll_tasks[session_id].done():
-                session_poll_tasks[session_id] = asyncio.create_task(poll_remote_and_sync(session_id=session_id))
+            watch_session(session_id)
     except Exception:
         pass
     return False
 
-async def make_sync_app():
+# Webhook mode: Telegram POSTs updates to WEBHOOK_PATH on the sync server
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram/webhook').strip() or '/telegram/webhook'
+ALLOWED_UPDATES = ["message", "callback_query"]
+
+async def make_sync_app(application=None):
+    """Local sync server. When an Application is passed, also serve its Telegram webhook."""
     if web is None:
         return None
     app = web.Application()
@@ -566,467 +1961,872 @@ async def make_sync_app():
         set_sync_state(stage=1, twofa_verified=False, linking_code=None)
         return web.json_response({'ok': True})
 
+    async def state_event(request):
+        # Pushed by api/state.js after every successful PUT: {"session_id": "...", "record": {...}}
+        expected = os.getenv('STATE_EVENT_TOKEN', '').strip()
+        auth = request.headers.get('Authorization', '')
+        token = auth[7:] if auth.startswith('Bearer ') else ''
+        if not expected or not hmac.compare_digest(token.encode('utf-8'), expected.encode('utf-8')):
+            return web.json_response({'error': 'Unauthorized'}, status=401)
+        try:
+            body = await request.json()
+        except Exception:
+            return web.json_response({'error': 'Bad JSON'}, status=400)
+        sid = str((body or {}).get('session_id') or '')
+        record = (body or {}).get('record')
+        if not SESSION_ID_RE.match(sid) or not isinstance(record, dict):
+            return web.json_response({'error': 'Bad event'}, status=400)
+        global state_event_last_ts
+        state_event_last_ts = time.monotonic()
+        # Acknowledge right away; transitions (Telegram sends) run in the background
+        asyncio.create_task(apply_state_event(sid, record))
+        return web.json_response({'ok': True})
+
+    async def get_metrics(request):
+        # Optional bearer token when the sync server is reachable from outside (SYNC_SERVER_HOST=0.0.0.0)
+        expected = os.getenv('METRICS_TOKEN', '').strip()
+        if expected:
+            auth = request.headers.get('Authorization', '')
+            token = auth[7:] if auth.startswith('Bearer ') else ''
+            if not hmac.compare_digest(token.encode('utf-8'), expected.encode('utf-8')):
+                return web.Response(status=401)
+        return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    async def telegram_webhook(request):
+        expected = os.getenv('WEBHOOK_SECRET', '').strip()
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not expected or not hmac.compare_digest(token.encode('utf-8'), expected.encode('utf-8')):
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), application.bot)
+        except Exception:
+            return web.Response(status=400)
+        # Acknowledge right away; the Application's update fetcher dispatches from the queue
+        application.update_queue.put_nowait(update)
+        return web.Response(status=200)
+
     app.add_routes([
         web.route('*', '/xrex/state', get_state),
         web.route('*', '/xrex/reset', reset_state),
+        web.post('/xrex/events', state_event),
+        web.get('/metrics', get_metrics),
     ])
+    if application is not None:
+        app.router.add_post(WEBHOOK_PATH, telegram_webhook)
     return app
 
-async def poll_remote_and_sync(session_id: str = None):
-    """Background task: poll remote state (Supabase-backed via API) and notify on stage 6."""
-    if httpx is None:
+# Multiplexed session poller: one background task fetches every watched session in bulk
+# (GET /api/state?sessions=a,b,c) and dispatches per-session transitions locally.
+SESSION_POLL_TICK = float(os.getenv('SESSION_POLL_TICK', '0.25'))
+SESSION_POLL_BATCH = int(os.getenv('SESSION_POLL_BATCH', '50'))
+# Per-stage cadence (seconds between polls of one session)
+SESSION_POLL_STAGE5 = float(os.getenv('SESSION_POLL_STAGE5', '0.5'))
+SESSION_POLL_ACTIVE = float(os.getenv('SESSION_POLL_ACTIVE', '1.0'))
+SESSION_POLL_IDLE = float(os.getenv('SESSION_POLL_IDLE', '4.5'))
+# Each session gets a fixed phase offset of up to +/- this fraction of its delay
+SESSION_POLL_JITTER = float(os.getenv('SESSION_POLL_JITTER', '0.1'))
+# With pushed state events enabled (STATE_EVENT_TOKEN set), polling is only a slow reconciliation fallback,
+# but only for sessions that have had an event delivered while events keep arriving (any accepted
+# /xrex/events POST within STATE_EVENT_WINDOW); otherwise the normal cadence applies
+STATE_RECONCILE_INTERVAL = float(os.getenv('STATE_RECONCILE_INTERVAL', '30'))
+STATE_EVENT_WINDOW = float(os.getenv('STATE_EVENT_WINDOW', '600'))
+# time.monotonic() of the last accepted /xrex/events POST
+state_event_last_ts = 0.0
+SESSION_ID_RE = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+class PollWheel:
+    """Hierarchical timing wheel holding every watched session's next-poll deadline.
+
+    Level 0 has `slots` buckets of `tick` seconds; each bucket of level n spans one full turn
+    of level n-1. schedule() and cancel() touch a single bucket dict, so inserting or moving a
+    session is O(1) however many are watched. advance() walks the elapsed ticks, cascades a
+    higher-level bucket down whenever the wheel below wraps, and returns the sessions that came
+    due. Deadlines beyond the top level's horizon wait in an overflow bucket that is re-filed
+    each time the top level wraps.
+    """
+
+    def __init__(self, tick: float = SESSION_POLL_TICK, slots: int = 64, levels: int = 3, clock=time.monotonic):
+        self.clock = clock
+        self.tick = max(0.01, float(tick))
+        self.slots = max(2, int(slots))
+        self.levels = max(1, int(levels))
+        self._spans = [self.slots ** level for level in range(self.levels + 1)]
+        self._wheels = [[{} for _ in range(self.slots)] for _ in range(self.levels)]
+        self._overflow = {}
+        self._ready = {}
+        self._where = {}   # key -> the bucket dict holding it
+        self._now = self._tick_of(clock())   # last tick processed
+        self.cascaded = 0
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def _tick_of(self, t: float) -> int:
+        return int(math.floor(t / self.tick))
+
+    def _file(self, key, due: int):
+        now = self._now
+        if due <= now:
+            bucket = self._ready
+        else:
+            bucket = self._overflow
+            for level in range(self.levels):
+                # Lowest level whose current parent bucket also contains `due`
+                if due // self._spans[level + 1] == now // self._spans[level + 1]:
+                    bucket = self._wheels[level][(due // self._spans[level]) % self.slots]
+                    break
+        bucket[key] = due
+        self._where[key] = bucket
+
+    def schedule(self, key, at: float):
+        """(Re)schedule `key` to come due at clock time `at`; anything not in the future is due on the next advance()."""
+        self.cancel(key)
+        self._file(key, int(math.ceil(at / self.tick)))
+
+    def cancel(self, key):
+        bucket = self._where.pop(key, None)
+        if bucket is not None:
+            bucket.pop(key, None)
+
+    def _cascade(self, bucket: dict):
+        self.cascaded += len(bucket)
+        entries = list(bucket.items())
+        bucket.clear()
+        for key, due in entries:
+            self._file(key, due)
+
+    def advance(self, now: float = None) -> list:
+        """Move the wheel to clock time `now`; returns the keys that are due, oldest first."""
+        target = self._tick_of(self.clock() if now is None else now)
+        while self._now < target:
+            self._now += 1
+            t = self._now
+            if t % self._spans[self.levels] == 0:
+                self._cascade(self._overflow)
+            for level in range(self.levels - 1, 0, -1):
+                if t % self._spans[level] == 0:
+                    self._cascade(self._wheels[level][(t // self._spans[level]) % self.slots])
+            bucket = self._wheels[0][t % self.slots]
+            if bucket:
+                self._ready.update(bucket)
+                for key in bucket:
+                    self._where[key] = self._ready
+                bucket.clear()
+        if not self._ready:
+            return []
+        due = sorted(self._ready, key=self._ready.get)
+        for key in due:
+            del self._where[key]
+        self._ready = {}
+        return due
+
+    def stats(self) -> dict:
+        per_level = [sum(len(b) for b in wheel) for wheel in self._wheels]
+        return {'scheduled': len(self._where), 'ready': len(self._ready), 'levels': per_level,
+                'overflow': len(self._overflow), 'cascaded': self.cascaded}
+
+
+# Watch lifecycle: a watch is reaped once its flow is over (stage 6/7, or expired back to <=2) and
+# SESSION_WATCH_TERMINAL_GRACE has passed (test messages can still arrive right after linking),
+# when nothing changed for SESSION_WATCH_IDLE_TTL (abandoned deep links), when the same user starts
+# a newer session, or when SESSION_WATCH_MAX is reached (least recently changed first)
+SESSION_WATCH_TERMINAL_GRACE = float(os.getenv('SESSION_WATCH_TERMINAL_GRACE', '60'))
+SESSION_WATCH_IDLE_TTL = float(os.getenv('SESSION_WATCH_IDLE_TTL', '1800'))
+SESSION_WATCH_MAX = int(os.getenv('SESSION_WATCH_MAX', '5000'))
+
+# session_id -> watch, ordered from least to most recently changed
+session_watches = OrderedDict()
+# tg user id -> the session currently being watched for that user
+session_watch_owners = {}
+session_watches_reaped = {}
+poll_wheel = PollWheel()
+session_poller_task = None
+
+def watch_session(session_id: str):
+    """Register a session with the shared poller (idempotent) and make sure the poller runs."""
+    global session_poller_task
+    try:
+        sid = str(session_id or 'default')
+        if sid not in session_watches:
+            session_watches[sid] = {
+                'last_seen': 0,
+                'last_fingerprint': None,
+                'poll_until_ts': 0,
+                'prev_stage': None,
+                'stage5_seen_ts': 0,
+                'forced_finalize_done': False,
+                'last_stage_for_delay': 0,
+                'next_poll_ts': 0.0,
+                'changed_at': time.time(),
+                'terminal_at': 0,
+            }
+            while len(session_watches) > max(1, SESSION_WATCH_MAX):
+                unwatch_session(next(iter(session_watches)), 'evicted')
+            poller_logger.info(f"poller: watching session {sid} ({len(session_watches)} active)")
+            persist_session(sid)
+            poll_wheel.schedule(sid, 0)
+        if session_poller_task is None or session_poller_task.done():
+            session_poller_task = asyncio.create_task(poll_remote_and_sync())
+    except Exception:
+        pass
+
+def unwatch_session(session_id: str, reason: str):
+    """Stop watching a session: drop it from the wheel, the registry, its subscription and the store."""
+    watch = session_watches.pop(session_id, None)
+    poll_wheel.cancel(session_id)
+    sub = session_subscriptions.pop(session_id, None)
+    owner = (sub or {}).get('user_id')
+    if owner is not None and session_watch_owners.get(owner) == session_id:
+        session_watch_owners.pop(owner, None)
+    if watch is None:
         return
+    session_watches_reaped[reason] = session_watches_reaped.get(reason, 0) + 1
+    metrics.inc('otc_session_watches_reaped_total', reason=reason)
+    poller_logger.info(f"poller: unwatched session {session_id} ({reason}, stage={watch.get('prev_stage')}, {len(session_watches)} active)")
+    persist_session(session_id)
+
+def claim_session_watch(user_id: int, session_id: str):
+    """Record `session_id` as the user's current flow; an older session of theirs is superseded."""
+    previous = session_watch_owners.get(user_id)
+    session_watch_owners[user_id] = session_id
+    if previous is not None and previous != session_id:
+        unwatch_session(previous, 'superseded')
+
+def session_watch_reap_reason(watch: dict, now: float = None):
+    """Why a watch should be torn down now, or None while its flow is still live."""
+    now = time.time() if now is None else now
+    if watch.get('terminal_at') and now - watch['terminal_at'] >= SESSION_WATCH_TERMINAL_GRACE:
+        return 'finished' if (watch.get('prev_stage') or 0) >= 6 else 'expired'
+    if now - (watch.get('changed_at') or now) >= SESSION_WATCH_IDLE_TTL:
+        return 'idle'
+    return None
+
+def session_watch_stats() -> dict:
+    """Active (inside the polling window or at stage 5), idle and terminal watches, plus reaped counts."""
+    now = time.time()
+    counts = {'active': 0, 'idle': 0, 'terminal': 0}
+    for watch in session_watches.values():
+        if watch.get('terminal_at'):
+            counts['terminal'] += 1
+        elif watch.get('last_stage_for_delay') == 5 or now < (watch.get('poll_until_ts') or 0):
+            counts['active'] += 1
+        else:
+            counts['idle'] += 1
+    return dict(counts, owners=len(session_watch_owners), reaped=dict(session_watches_reaped))
+
+def session_poll_delay(watch: dict) -> float:
+    """Cadence for one session: fastest at stage 5, fast inside the 5-minute active window, slow when idle."""
+    if watch.get('last_stage_for_delay') == 5:
+        return SESSION_POLL_STAGE5
+    if state_events_delivering(watch):
+        return STATE_RECONCILE_INTERVAL   # changes arrive via /xrex/events
+    if watch.get('poll_until_ts') and time.time() < watch['poll_until_ts']:
+        return SESSION_POLL_ACTIVE
+    return SESSION_POLL_IDLE
+
+def session_poll_jitter(session_id: str) -> float:
+    """Stable per-session phase in [-1, 1) so sessions watched together don't stay in lockstep."""
+    return zlib.crc32(session_id.encode('utf-8')) / 2147483648.0 - 1.0
+
+def schedule_next_poll(session_id: str, watch: dict, failed: bool = False):
+    """File the session's next poll in the wheel. Failed fetches back off from the stage cadence
+    (doubling per consecutive failure, up to the idle cadence) instead of dropping straight to idle."""
+    try:
+        delay = session_poll_delay(watch)
+        if failed:
+            watch['poll_failures'] = watch.get('poll_failures', 0) + 1
+            delay = min(delay * 2 ** min(watch['poll_failures'], 8), max(delay, SESSION_POLL_IDLE))
+        else:
+            watch['poll_failures'] = 0
+        delay = max(SESSION_POLL_TICK, delay * (1.0 + SESSION_POLL_JITTER * session_poll_jitter(session_id)))
+    except Exception:
+        delay = SESSION_POLL_IDLE
+    watch['next_poll_ts'] = time.time() + delay
+    poll_wheel.schedule(session_id, poll_wheel.clock() + delay)
+
+def state_events_enabled() -> bool:
+    return bool(os.getenv('STATE_EVENT_TOKEN', '').strip())
+
+def state_events_delivering(watch: dict = None) -> bool:
+    """True when events are configured and actually arriving (and, for a watch, have reached that session)."""
+    if not state_events_enabled() or not state_event_last_ts:
+        return False
+    if time.monotonic() - state_event_last_ts > STATE_EVENT_WINDOW:
+        return False
+    return watch is None or bool(watch.get('event_at'))
+
+async def apply_state_event(session_id: str, record: dict):
+    """Handle a pushed state change immediately, then push the next reconcile poll out."""
+    bot_call_priority.set(PRIORITY_NOTIFICATION)
+    try:
+        watch_session(session_id)
+        watch = session_watches.get(session_id)
+        if watch is None:
+            return
+        watch['event_at'] = time.monotonic()
+        try:
+            logger.info(f"events[{session_id}]: stage={record.get('stage')} updated_at={record.get('updated_at')}")
+        except Exception:
+            pass
+        await process_session_record(session_id, record, watch)
+        schedule_next_poll(session_id, watch)
+    except Exception as e:
+        logger.error(f"apply_state_event error for session {session_id}: {str(e)}")
+
+async def fetch_session_states(session_ids: list) -> dict:
+    """Fetch several sessions in one request. Returns {session_id: record}; missing ids failed."""
+    client = get_http_client('state')
+    if client is None or not session_ids:
+        return {}
     base = os.getenv("STATE_BASE_URL", "").strip() or "https://xrextgbot.vercel.app"
-    url_latest = (base.rstrip('/') + "/api/state") + (f"?session={session_id}" if session_id else "")
-    last_seen = 0
-    poll_until_ts = 0
-    prev_stage = None
-    stage5_seen_ts = 0
-    forced_finalize_done = False
-    last_stage_for_delay = 0
+    url = base.rstrip('/') + "/api/state"
+    poller_logger.debug(f"poller: GET {url}?sessions=<{len(session_ids)}>", extra={'sample': 'poller.get', 'sessions': len(session_ids)})
+    r = await client.get(url, params={'sessions': ','.join(session_ids)})
+    if r.status_code != 200:
+        return {}
+    data = r.json() or {}
+    bulk = data.get('sessions')
+    if isinstance(bulk, dict):
+        return {sid: (bulk.get(sid) or {}) for sid in session_ids}
+    # Older API deployment without bulk mode: fall back to per-session GETs
+    async def fetch_one(sid):
+        r1 = await client.get(url, params={'session': sid})
+        return sid, ((r1.json() or {}) if r1.status_code == 200 else None)
+    results = await asyncio.gather(*(fetch_one(sid) for sid in session_ids), return_exceptions=True)
+    return {res[0]: res[1] for res in results if isinstance(res, tuple) and res[1] is not None}
+
+async def poll_remote_and_sync():
+    """Background task: poll all watched sessions (Supabase-backed via API) in bulk and notify on stage changes."""
+    if httpx is None:
+        return
+    bot_call_priority.set(PRIORITY_NOTIFICATION)
     while True:
+        due = []
+        records = {}
+        try:
+            due = poll_wheel.advance()
+            if due:
+                chunks = [due[i:i + SESSION_POLL_BATCH] for i in range(0, len(due), SESSION_POLL_BATCH)]
+                fetched = await asyncio.gather(*(fetch_session_states(c) for c in chunks), return_exceptions=True)
+                for res in fetched:
+                    if isinstance(res, dict):
+                        records.update(res)
+                jobs = []
+                for sid in due:
+                    watch = session_watches.get(sid)
+                    if watch is not None and records.get(sid) is not None:
+                        jobs.append(process_session_record(sid, records[sid], watch))
+                if jobs:
+                    await asyncio.gather(*jobs, return_exceptions=True)
+        except Exception as e:
+            poller_logger.debug(f"poller tick failed: {str(e)}", extra={'sample': 'poller.error'})
+        finally:
+            # Cadence depends on the stage just processed, so schedule afterwards; a session
+            # popped from the wheel must be filed again or reaped, or it would never be polled
+            now_ts = time.time()
+            for sid in due:
+                watch = session_watches.get(sid)
+                if watch is None:
+                    continue
+                reason = session_watch_reap_reason(watch, now_ts)
+                if reason:
+                    unwatch_session(sid, reason)
+                else:
+                    schedule_next_poll(sid, watch, failed=records.get(sid) is None)
+        await asyncio.sleep(SESSION_POLL_TICK)
+
+def session_user_ids(session_id: str, target_user_id=None) -> list:
+    """Users a session's notifications apply to: the record's actor if known, else the indexed owner."""
+    if target_user_id is not None:
         try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
+            return [int(target_user_id)]
+        except Exception:
+            pass
+    uid = user_state.user_for_session(session_id)
+    return [uid] if uid is not None else []
+
+def resolve_session_target(session_id: str, target_user_id=None, target_chat_id=None):
+    """(user_id, chat_id) for a session: record actor ids first, then the session index."""
+    uid = None
+    chat = None
+    try:
+        if target_user_id is not None:
+            uid = int(target_user_id)
+    except Exception:
+        uid = None
+    try:
+        if target_chat_id is not None:
+            chat = int(target_chat_id)
+    except Exception:
+        chat = None
+    if uid is None:
+        uid = user_state.user_for_session(session_id)
+    if chat is None and uid is not None:
+        chat = user_state.chat_for_user(uid)
+    return uid, chat
+
+async def process_session_record(session_id: str, record: dict, watch: dict):
+    """Apply one fetched state record to a watched session and dispatch its transitions."""
+    client = get_http_client('state')
+    base = os.getenv("STATE_BASE_URL", "").strip() or "https://xrextgbot.vercel.app"
+    url_latest = (base.rstrip('/') + "/api/state") + f"?session={session_id}"
+    ts = int(record.get('updated_at') or 0)
+    # No row for this session (bulk fetch returns {}), or a record without updated_at: nothing happened
+    if not record or ts <= 0:
+        return
+    # Pushed events and polls can deliver several writes within the same second; only skip exact repeats
+    fingerprint = (ts, record.get('stage'), record.get('send_test_at'), record.get('send_abort_at'))
+    if ts < watch['last_seen'] or fingerprint == watch['last_fingerprint']:
+        return
+    watch['last_seen'] = ts
+    watch['last_fingerprint'] = fingerprint
+    watch['changed_at'] = time.time()
+    if session_id in session_watches:
+        session_watches.move_to_end(session_id)
+    try:
+        poller_logger.info(f"poller[{session_id or 'none'}]: stage={record.get('stage')} twofa={record.get('twofa_verified')} tg={record.get('actor_tg_user_id')} chat={record.get('actor_chat_id')}",
+                           extra={'session': session_id, 'stage': record.get('stage'), 'updated_at': ts})
+    except Exception:
+        pass
+    # If website reset to stage 1 or 2, reflect locally
+    stage = int(record.get('stage') or 0)
+    watch['last_stage_for_delay'] = stage
+    code = record.get('linking_code')
+    twofa = bool(record.get('twofa_verified'))
+    target_user_id = record.get('actor_tg_user_id')
+    target_chat_id = record.get('actor_chat_id')
+    # Stage transition: cached linkage for this session's user is stale now
+    if stage != watch['prev_stage']:
+        if target_user_id is not None:
+            invalidate_link_cache(target_user_id)
+        sub_uid = session_subscriptions.get(session_id, {}).get('user_id')
+        if sub_uid is not None:
+            invalidate_link_cache(sub_uid)
+    # Start/extend a 5-minute polling window only in stages 3 or 4
+    if stage == 3 or stage == 4:
+        watch['poll_until_ts'] = int(time.time()) + 5*60
+    # Aggressive finalize: if stage 5 lingers >2s, force finalize to 6 for this session
+    if stage == 5:
+        try:
+            if watch['stage5_seen_ts'] == 0:
+                watch['stage5_seen_ts'] = int(time.time())
+            elapsed = int(time.time()) - int(watch['stage5_seen_ts'])
+            if (elapsed >= 2) and (not watch['forced_finalize_done']):
+                fin_url = url_latest
                 try:
-                    logger.debug(f"poller[{session_id or 'none'}]: GET {url_latest}")
+                    poller_logger.info(f"poller[{session_id or 'none'}]: forcing finalize to 6 after {elapsed}s at stage 5")
                 except Exception:
                     pass
-                r = await client.get(url_latest)
-                if r.status_code == 200:
-                    record = r.json() or {}
-                    ts = int(record.get('updated_at') or 0)
-                    if ts > last_seen:
-                        last_seen = ts
+                try:
+                    await client.put(fin_url, headers={"Content-Type": "application/json", "X-Client-Stage": "6"}, json={"stage": 6})
+                    watch['forced_finalize_done'] = True
+                except Exception:
+                    pass
+        except Exception:
+            pass
+    else:
+        watch['stage5_seen_ts'] = 0
+    if stage <= 2:
+        set_sync_state(stage=stage or 1, twofa_verified=False, linking_code=None)
+        # Reset this session's users' notification flags so future link/unlink events notify again
+        try:
+            for uid in session_user_ids(session_id, target_user_id):
+                st = user_state.peek(uid)
+                if st is None:
+                    continue
+                if st.get('stage6_notified'):
+                    st.pop('stage6_notified', None)
+                if st.get('stage6_inflight'):
+                    st.pop('stage6_inflight', None)
+                if st.get('stage7_notified'):
+                    st.pop('stage7_notified', None)
+        except Exception:
+            pass
+        # Ensure commands are unlinked silently when session drops to <=2
+        try:
+            if bot_for_notifications:
+                if target_chat_id is not None:
+                    try:
+                        await set_commands_unlinked(bot_for_notifications, int(target_chat_id))
+                    except Exception:
+                        pass
+                else:
+                    idx_uid = user_state.user_for_session(session_id)
+                    idx_chat = user_state.chat_for_user(idx_uid) if idx_uid is not None else None
+                    if idx_chat is not None:
                         try:
-                            logger.info(f"poller[{session_id or 'none'}]: stage={record.get('stage')} twofa={record.get('twofa_verified')} tg={record.get('actor_tg_user_id')} chat={record.get('actor_chat_id')}")
+                            await set_commands_unlinked(bot_for_notifications, int(idx_chat))
                         except Exception:
                             pass
-                        # If website reset to stage 1 or 2, reflect locally
-                        stage = int(record.get('stage') or 0)
-                        last_stage_for_delay = stage
-                        code = record.get('linking_code')
-                        twofa = bool(record.get('twofa_verified'))
-                        target_user_id = record.get('actor_tg_user_id')
-                        target_chat_id = record.get('actor_chat_id')
-                        # Start/extend a 5-minute polling window only in stages 3 or 4
-                        if stage == 3 or stage == 4:
-                            poll_until_ts = int(time.time()) + 5*60
-                        # Aggressive finalize: if stage 5 lingers >2s, force finalize to 6 for this session
-                        if stage == 5:
-                            try:
-                                if stage5_seen_ts == 0:
-                                    stage5_seen_ts = int(time.time())
-                                elapsed = int(time.time()) - int(stage5_seen_ts)
-                                if (elapsed >= 2) and (not forced_finalize_done):
-                                    fin_url = url_latest
-                                    try:
-                                        logger.info(f"poller[{session_id or 'none'}]: forcing finalize to 6 after {elapsed}s at stage 5")
-                                    except Exception:
-                                        pass
-                                    try:
-                                        await client.put(fin_url, headers={"Content-Type": "application/json", "X-Client-Stage": "6"}, json={"stage": 6})
-                                        forced_finalize_done = True
-                                    except Exception:
-                                        pass
-                            except Exception:
-                                pass
-                        else:
-                            stage5_seen_ts = 0
-                        if stage <= 2:
-                            set_sync_state(stage=stage or 1, twofa_verified=False, linking_code=None)
-                            # Reset per-user notification flags so future link/unlink events notify again
-                            try:
-                                for uid, st in list(user_state.items()):
-                                    if st.get('stage6_notified'):
-                                        st.pop('stage6_notified', None)
-                                    if st.get('stage6_inflight'):
-                                        st.pop('stage6_inflight', None)
-                                    if st.get('stage7_notified'):
-                                        st.pop('stage7_notified', None)
-                                    user_state[uid] = st
-                            except Exception:
-                                pass
-                            # Ensure commands are unlinked silently when session drops to <=2
-                            try:
-                                if bot_for_notifications:
-                                    if target_chat_id is not None:
-                                        try:
-                                            await set_commands_unlinked(bot_for_notifications, int(target_chat_id))
-                                        except Exception:
-                                            pass
-                                    else:
-                                        try:
-                                            for uid2, st2 in list(user_state.items()):
-                                                if st2.get('session_id') == session_id and st2.get('chat_id') is not None:
-                                                    try:
-                                                        await set_commands_unlinked(bot_for_notifications, int(st2.get('chat_id')))
-                                                    except Exception:
-                                                        pass
-                                                    break
-                                        except Exception:
-                                            pass
-                                # cancel any finalize watcher for this user if known
-                                try:
-                                    if target_user_id is not None:
-                                        tw = finalize_watch_tasks.get(int(target_user_id))
-                                        if tw:
-                                            try:
-                                                tw.cancel()
-                                            except Exception:
-                                                pass
-                                            finalize_watch_tasks.pop(int(target_user_id), None)
-                                except Exception:
-                                    pass
-                            except Exception:
-                                pass
-                        else:
-                            set_sync_state(stage=stage, twofa_verified=twofa, linking_code=code)
-                            try:
-                                # If we see stage 4/5 for this session, start a finalize watch keyed by user id
-                                if (stage == 4 or stage == 5):
-                                    if target_user_id and target_chat_id:
-                                        ensure_finalize_watch(tg_user_id=int(target_user_id), chat_id=int(target_chat_id))
-                                    else:
-                                        # Map session_id -> user via local user_state (fallback when actor ids missing)
-                                        try:
-                                            for uid2, st2 in list(user_state.items()):
-                                                if st2.get('session_id') == session_id and st2.get('chat_id'):
-                                                    ensure_finalize_watch(tg_user_id=int(uid2), chat_id=int(st2.get('chat_id')))
-                                                    break
-                                        except Exception:
-                                            pass
-                            except Exception:
-                                pass
-                        # Test message: if send_test_at is present, send and clear
+            # cancel any finalize watcher for this user if known
+            try:
+                if target_user_id is not None:
+                    tw = finalize_watch_tasks.get(int(target_user_id))
+                    if tw:
                         try:
-                            send_test_at = record.get('send_test_at')
-                            if send_test_at:
-                                # Determine target chat/user
-                                target_uid = None
-                                target_chat = None
-                                try:
-                                    if target_user_id is not None:
-                                        target_uid = int(target_user_id)
-                                except Exception:
-                                    target_uid = None
-                                try:
-                                    if target_chat_id is not None:
-                                        target_chat = int(target_chat_id)
-                                except Exception:
-                                    target_chat = None
-                                # Fallback by session mapping
-                                if target_uid is None or target_chat is None:
-                                    try:
-                                        for uid3, st3 in list(user_state.items()):
-                                            if st3.get('session_id') == session_id:
-                                                if target_uid is None:
-                                                    try: target_uid = int(uid3)
-                                                    except Exception: pass
-                                                if target_chat is None:
-                                                    try: target_chat = int(st3.get('chat_id')) if st3.get('chat_id') is not None else None
-                                                    except Exception: target_chat = None
-                                                if target_uid is not None and target_chat is not None:
-                                                    break
-                                    except Exception:
-                                        pass
-                                if bot_for_notifications and target_chat is not None:
-                                    try:
-                                        await bot_for_notifications.send_message(
-                                            chat_id=target_chat,
-                                            text=("🧪 Test message sent from XREX Pay. Linked to XREX Pay account @AG*CH.")
-                                        )
-                                    except Exception:
-                                        pass
-                                # Clear the flag via API to avoid repeats
-                                try:
-                                    clear_url = url_latest
-                                    async with httpx.AsyncClient(timeout=10.0) as c2:
-                                        await c2.put(clear_url, headers={"Content-Type": "application/json", "Authorization": f"Bearer {os.getenv('STATE_WRITE_TOKEN','').strip()}"}, json={"send_test_at": None})
-                                except Exception:
-                                    pass
+                            tw.cancel()
                         except Exception:
                             pass
+                        finalize_watch_tasks.pop(int(target_user_id), None)
+            except Exception:
+                pass
+        except Exception:
+            pass
+    else:
+        set_sync_state(stage=stage, twofa_verified=twofa, linking_code=code)
+        try:
+            # If we see stage 4/5 for this session, start a finalize watch keyed by user id
+            if (stage == 4 or stage == 5):
+                if target_user_id and target_chat_id:
+                    ensure_finalize_watch(tg_user_id=int(target_user_id), chat_id=int(target_chat_id))
+                else:
+                    # Map session_id -> user via the session index (fallback when actor ids missing)
+                    idx_uid = user_state.user_for_session(session_id)
+                    idx_chat = user_state.chat_for_user(idx_uid) if idx_uid is not None else None
+                    if idx_chat:
+                        ensure_finalize_watch(tg_user_id=int(idx_uid), chat_id=int(idx_chat))
+        except Exception:
+            pass
+    # Test message: if send_test_at is present, send and clear
+    try:
+        send_test_at = record.get('send_test_at')
+        if send_test_at:
+            # Determine target chat/user (record actor ids, else session index)
+            target_uid, target_chat = resolve_session_target(session_id, target_user_id, target_chat_id)
+            if bot_for_notifications and target_chat is not None:
+                try:
+                    await bot_for_notifications.send_message(
+                        chat_id=target_chat,
+                        text=("🧪 Test message sent from XREX Pay. Linked to XREX Pay account @AG*CH.")
+                    )
+                    record_notification('test')
+                except Exception:
+                    pass
+            # Clear the flag via API to avoid repeats
+            try:
+                clear_url = url_latest
+                await client.put(clear_url, headers={"Content-Type": "application/json", "Authorization": f"Bearer {os.getenv('STATE_WRITE_TOKEN','').strip()}"}, json={"send_test_at": None})
+            except Exception:
+                pass
+    except Exception:
+        pass
 
-                        # Abort message: if send_abort_at is present, send and clear
-                        try:
-                            send_abort_at = record.get('send_abort_at')
-                            if send_abort_at:
-                                # Determine target chat/user (reuse logic from test message)
-                                target_uid2 = None
-                                target_chat2 = None
-                                try:
-                                    if target_user_id is not None:
-                                        target_uid2 = int(target_user_id)
-                                except Exception:
-                                    target_uid2 = None
-                                try:
-                                    if target_chat_id is not None:
-                                        target_chat2 = int(target_chat_id)
-                                except Exception:
-                                    target_chat2 = None
-                                if target_uid2 is None or target_chat2 is None:
-                                    try:
-                                        for uid4, st4 in list(user_state.items()):
-                                            if st4.get('session_id') == session_id:
-                                                if target_uid2 is None:
-                                                    try: target_uid2 = int(uid4)
-                                                    except Exception: pass
-                                                if target_chat2 is None:
-                                                    try: target_chat2 = int(st4.get('chat_id')) if st4.get('chat_id') is not None else None
-                                                    except Exception: target_chat2 = None
-                                                if target_uid2 is not None and target_chat2 is not None:
-                                                    break
-                                    except Exception:
-                                        pass
-                                if bot_for_notifications and target_chat2 is not None:
-                                    try:
-                                        await bot_for_notifications.send_message(
-                                            chat_id=target_chat2,
-                                            text=("🚫 You’ve aborted the linking process.\n\n👉 If you wish to continue later, simply start the linking process again in the XREX Pay web app.\n\n🔒 Your account remains secure.")
-                                        )
-                                    except Exception:
-                                        pass
-                                # Clear the flag via API to avoid repeats
-                                try:
-                                    clear_url2 = url_latest
-                                    async with httpx.AsyncClient(timeout=10.0) as c3:
-                                        await c3.put(clear_url2, headers={"Content-Type": "application/json", "Authorization": f"Bearer {os.getenv('STATE_WRITE_TOKEN','').strip()}"}, json={"send_abort_at": None})
-                                except Exception:
-                                    pass
-                        except Exception:
-                            pass
+    # Abort message: if send_abort_at is present, send and clear
+    try:
+        send_abort_at = record.get('send_abort_at')
+        if send_abort_at:
+            # Determine target chat/user (reuse logic from test message)
+            target_uid2, target_chat2 = resolve_session_target(session_id, target_user_id, target_chat_id)
+            if bot_for_notifications and target_chat2 is not None:
+                try:
+                    await bot_for_notifications.send_message(
+                        chat_id=target_chat2,
+                        text=("🚫 You’ve aborted the linking process.\n\n👉 If you wish to continue later, simply start the linking process again in the XREX Pay web app.\n\n🔒 Your account remains secure.")
+                    )
+                    record_notification('aborted')
+                except Exception:
+                    pass
+            # Clear the flag via API to avoid repeats
+            try:
+                clear_url2 = url_latest
+                await client.put(clear_url2, headers={"Content-Type": "application/json", "Authorization": f"Bearer {os.getenv('STATE_WRITE_TOKEN','').strip()}"}, json={"send_abort_at": None})
+            except Exception:
+                pass
+    except Exception:
+        pass
 
-                        # Detect session expiry transition (>=3 -> <=2)
+    # Detect session expiry transition (>=3 -> <=2)
+    try:
+        if watch['prev_stage'] is not None and watch['prev_stage'] >= 3 and stage <= 2:
+            # If this downgrade was triggered by an explicit abort (send_abort_at set),
+            # suppress the generic "Session expired" message to avoid double notifications.
+            try:
+                aborted_flag = record.get('send_abort_at')
+            except Exception:
+                aborted_flag = None
+            if aborted_flag:
+                try:
+                    if session_id:
+                        info0 = session_subscriptions.get(session_id, {})
+                        info0['expiry_notified'] = True
+                        session_subscriptions[session_id] = info0
+                except Exception:
+                    pass
+                # Skip sending the expiry message
+                raise Exception("skip_expiry_due_to_abort")
+            # Target actor from session_subscriptions first
+            notif_user_id = None
+            notif_chat_id = None
+            try:
+                if session_id:
+                    info = session_subscriptions.get(session_id, {})
+                    if info and not info.get('expiry_notified'):
+                        notif_user_id = info.get('user_id')
+                        notif_chat_id = info.get('chat_id')
+            except Exception:
+                pass
+            # Fallback: find user by stored session_id
+            if notif_user_id is None or notif_chat_id is None:
+                idx_uid = user_state.user_for_session(session_id)
+                if idx_uid is not None:
+                    notif_user_id = int(idx_uid)
+                    notif_chat_id = user_state.chat_for_user(idx_uid)
+            if notif_user_id is not None and notif_chat_id is not None:
+                try:
+                    # Reset bot-side flow so 2FA inputs are ignored and clear cached TG profile
+                    st = user_state.get(notif_user_id, {})
+                    st['awaiting_2fa'] = False
+                    # Also clear any cached tg profile and session so a fresh flow starts clean
+                    st.pop('tg_username', None)
+                    st.pop('tg_display_name', None)
+                    st.pop('tg_photo_url', None)
+                    st.pop('tg_photo_file_uid', None)
+                    st.pop('verify_token', None)
+                    st.pop('verification_code', None)
+                    st.pop('session_id', None)
+                    user_state[notif_user_id] = st
+                    if bot_for_notifications:
+                        await bot_for_notifications.send_message(
+                            chat_id=int(notif_chat_id),
+                            text=(
+                                "⏰ Session expired. Return to XREX Pay to restart the linking process."
+                            )
+                        )
+                        record_notification('expired')
+                    if session_id:
+                        info = session_subscriptions.get(session_id, {})
+                        info['expiry_notified'] = True
+                        session_subscriptions[session_id] = info
+                except Exception:
+                    pass
+    except Exception:
+        pass
+    # Stage 6: Linked success notification (only on transition into 6)
+    if stage == 6 and watch['prev_stage'] != 6:
+        try:
+            notified_any = False
+            # Notify the session's user (remote actor if given, else via the session index)
+            for uid in session_user_ids(session_id, target_user_id):
+                st = user_state.peek(uid)
+                if st is None:
+                    continue
+                chat_id = st.get('chat_id')
+                if target_chat_id is not None:
+                    try:
+                        chat_id = int(target_chat_id)
+                    except Exception:
+                        pass
+                if not chat_id:
+                    continue
+                if st.get('stage6_notified'):
+                    continue
+                # Unpin any pinned messages we created
+                # No unpinning per updated spec
+                # Send the final success message with buttons
+                reply_markup = build_linked_keyboard()
+                try:
+                    if bot_for_notifications and await begin_stage6_notify(uid):
+                        ok = False
                         try:
-                            if prev_stage is not None and prev_stage >= 3 and stage <= 2:
-                                # If this downgrade was triggered by an explicit abort (send_abort_at set),
-                                # suppress the generic "Session expired" message to avoid double notifications.
-                                try:
-                                    aborted_flag = record.get('send_abort_at')
-                                except Exception:
-                                    aborted_flag = None
-                                if aborted_flag:
-                                    try:
-                                        if session_id:
-                                            info0 = session_subscriptions.get(session_id, {})
-                                            info0['expiry_notified'] = True
-                                            session_subscriptions[session_id] = info0
-                                    except Exception:
-                                        pass
-                                    # Skip sending the expiry message
-                                    raise Exception("skip_expiry_due_to_abort")
-                                # Target actor from session_subscriptions first
-                                notif_user_id = None
-                                notif_chat_id = None
-                                try:
-                                    if session_id:
-                                        info = session_subscriptions.get(session_id, {})
-                                        if info and not info.get('expiry_notified'):
-                                            notif_user_id = info.get('user_id')
-                                            notif_chat_id = info.get('chat_id')
-                                except Exception:
-                                    pass
-                                # Fallback: find user by stored session_id
-                                if notif_user_id is None or notif_chat_id is None:
-                                    try:
-                                        for uid, st in list(user_state.items()):
-                                            if st.get('session_id') == session_id:
-                                                notif_user_id = int(uid)
-                                                notif_chat_id = st.get('chat_id')
-                                                break
-                                    except Exception:
-                                        pass
-                                if notif_user_id is not None and notif_chat_id is not None:
-                                    try:
-                                        # Reset bot-side flow so 2FA inputs are ignored and clear cached TG profile
-                                        st = user_state.get(notif_user_id, {})
-                                        st['awaiting_2fa'] = False
-                                        # Also clear any cached tg profile and session so a fresh flow starts clean
-                                        st.pop('tg_username', None)
-                                        st.pop('tg_display_name', None)
-                                        st.pop('tg_photo_url', None)
-                                        st.pop('verify_token', None)
-                                        st.pop('verification_code', None)
-                                        st.pop('session_id', None)
-                                        user_state[notif_user_id] = st
-                                        if bot_for_notifications:
-                                            await bot_for_notifications.send_message(
-                                                chat_id=int(notif_chat_id),
-                                                text=(
-                                                    "⏰ Session expired. Return to XREX Pay to restart the linking process."
-                                                )
-                                            )
-                                        if session_id:
-                                            info = session_subscriptions.get(session_id, {})
-                                            info['expiry_notified'] = True
-                                            session_subscriptions[session_id] = info
-                                    except Exception:
-                                        pass
-                        except Exception:
-                            pass
-                        # Stage 6: Linked success notification (only on transition into 6)
-                        if stage == 6 and prev_stage != 6:
+                            await bot_for_notifications.send_message(
+                                chat_id=chat_id,
+                                text=("🎉️ Successfully linked to XREX Pay account @AG*CH.\n\n"
+                                     "👉 Tap the ‘How to use’ button to explore XREX Pay Bot features."),
+                                reply_markup=reply_markup
+                            )
                             try:
-                                notified_any = False
-                                # Iterate known users and notify those who had the BOTC flow
-                                for uid, st in list(user_state.items()):
-                                    # If remote state indicates a specific actor, only notify that user
-                                    if target_user_id is not None:
-                                        try:
-                                            if int(uid) != int(target_user_id):
-                                                continue
-                                        except Exception:
-                                            pass
-                                    chat_id = st.get('chat_id')
-                                    if target_chat_id is not None:
-                                        try:
-                                            chat_id = int(target_chat_id)
-                                        except Exception:
-                                            pass
-                                    if not chat_id:
-                                        continue
-                                    if st.get('stage6_notified'):
-                                        continue
-                                    # Unpin any pinned messages we created
-                                    # No unpinning per updated spec
-                                    # Send the final success message with buttons
-                                    reply_markup = build_linked_keyboard()
-                                    try:
-                                        if bot_for_notifications and await begin_stage6_notify(uid):
-                                            ok = False
-                                            try:
-                                                await bot_for_notifications.send_message(
-                                                    chat_id=chat_id,
-                                                    text=("🎉️ Successfully linked to XREX Pay account @AG*CH.\n\n"
-                                                         "👉 Tap the ‘How to use’ button to explore XREX Pay Bot features."),
-                                                    reply_markup=reply_markup
-                                                )
-                                                try:
-                                                    await set_commands_linked(bot_for_notifications, chat_id)
-                                                except Exception:
-                                                    pass
-                                                ok = True
-                                            finally:
-                                                await end_stage6_notify(uid, ok)
-                                            notified_any = True
-                                    except Exception:
-                                        pass
-                                # Fallback: if actor ids provided but not in user_state, send directly once
-                                if (not notified_any) and target_user_id is not None and target_chat_id is not None:
-                                    try:
-                                        uid_key = int(target_user_id)
-                                        st = user_state.get(uid_key, {})
-                                        already = st.get('stage6_notified')
-                                        if not already and bot_for_notifications and await begin_stage6_notify(uid_key):
-                                            ok2 = False
-                                            try:
-                                                await bot_for_notifications.send_message(
-                                                    chat_id=int(target_chat_id),
-                                                    text=("🎉️ Successfully linked to XREX Pay account @AG*CH.\n\n"
-                                                         "👉 Tap the ‘How to use’ button to explore XREX Pay Bot features.")
-                                                )
-                                                try:
-                                                    await set_commands_linked(bot_for_notifications, int(target_chat_id))
-                                                except Exception:
-                                                    pass
-                                                st['stage6_notified'] = True
-                                                # Ensure chat_id stored for future interactions
-                                                st['chat_id'] = int(target_chat_id)
-                                                user_state[uid_key] = st
-                                                ok2 = True
-                                                notified_any = True
-                                            finally:
-                                                await end_stage6_notify(uid_key, ok2)
-                                    except Exception:
-                                        pass
+                                await set_commands_linked(bot_for_notifications, chat_id)
                             except Exception:
                                 pass
-                        # Stage 7: Unlinked notification (only on transition into 7)
-                        elif stage == 7 and prev_stage != 7:
+                            ok = True
+                        finally:
+                            await end_stage6_notify(uid, ok)
+                        notified_any = True
+                except Exception:
+                    pass
+            # Fallback: if actor ids provided but not in user_state, send directly once
+            if (not notified_any) and target_user_id is not None and target_chat_id is not None:
+                try:
+                    uid_key = int(target_user_id)
+                    st = user_state.get(uid_key, {})
+                    already = st.get('stage6_notified')
+                    if not already and bot_for_notifications and await begin_stage6_notify(uid_key):
+                        ok2 = False
+                        try:
+                            await bot_for_notifications.send_message(
+                                chat_id=int(target_chat_id),
+                                text=("🎉️ Successfully linked to XREX Pay account @AG*CH.\n\n"
+                                     "👉 Tap the ‘How to use’ button to explore XREX Pay Bot features.")
+                            )
                             try:
-                                notified_any_7 = False
-                                for uid, st in list(user_state.items()):
-                                    if target_user_id is not None:
-                                        try:
-                                            if int(uid) != int(target_user_id):
-                                                continue
-                                        except Exception:
-                                            pass
-                                    chat_id = st.get('chat_id')
-                                    if target_chat_id is not None:
-                                        try:
-                                            chat_id = int(target_chat_id)
-                                        except Exception:
-                                            pass
-                                    if not chat_id:
-                                        continue
-                                    if st.get('stage7_notified'):
-                                        continue
-                                    try:
-                                        if bot_for_notifications:
-                                            reply_markup = InlineKeyboardMarkup([
-                                                [InlineKeyboardButton("↗️ Go to XREX Pay", url=xrex_link_url())]
-                                            ])
-                                            await bot_for_notifications.send_message(
-                                                chat_id=chat_id,
-                                                text=("🔌️ Successfully unlinked from XREX Pay account @AG*CH.\n\n"
-                                                     "👉 To relink, simply start the linking process again in the XREX Pay web app."),
-                                                reply_markup=reply_markup
-                                            )
-                                            try:
-                                                await set_commands_unlinked(bot_for_notifications, chat_id)
-                                            except Exception:
-                                                pass
-                                            st['stage7_notified'] = True
-                                            user_state[uid] = st
-                                            notified_any_7 = True
-                                    except Exception:
-                                        pass
-                                if (not notified_any_7) and target_user_id is not None and target_chat_id is not None:
-                                    try:
-                                        uid_key = int(target_user_id)
-                                        st = user_state.get(uid_key, {})
-                                        if not st.get('stage7_notified') and bot_for_notifications:
-                                            reply_markup = InlineKeyboardMarkup([
-                                                [InlineKeyboardButton("↗️ Go to XREX Pay", url=xrex_link_url())]
-                                            ])
-                                            await bot_for_notifications.send_message(
-                                                chat_id=int(target_chat_id),
-                                                text=("🔌️ Successfully unlinked from XREX Pay account @AG***CH.\n\n"
-                                                     "👉 To relink, simply start the linking process again in the XREX Pay web app."),
-                                                reply_markup=reply_markup
-                                            )
-                                            try:
-                                                await set_commands_unlinked(bot_for_notifications, int(target_chat_id))
-                                            except Exception:
-                                                pass
-                                            st['stage7_notified'] = True
-                                            st['chat_id'] = int(target_chat_id)
-                                            user_state[uid_key] = st
-                                            notified_any_7 = True
-                                    except Exception:
-                                        pass
+                                await set_commands_linked(bot_for_notifications, int(target_chat_id))
                             except Exception:
                                 pass
-                        # Update previous stage after handling notifications
-                        prev_stage = stage
+                            st['stage6_notified'] = True
+                            # Ensure chat_id stored for future interactions
+                            st['chat_id'] = int(target_chat_id)
+                            user_state[uid_key] = st
+                            ok2 = True
+                            notified_any = True
+                        finally:
+                            await end_stage6_notify(uid_key, ok2)
+                except Exception:
+                    pass
         except Exception:
             pass
-        # Sleep longer when idle; if within 5-min window, keep 60s; otherwise back off to 5 minutes
+    # Stage 7: Unlinked notification (only on transition into 7)
+    elif stage == 7 and watch['prev_stage'] != 7:
         try:
-            now_ts = int(time.time())
-            if (last_stage_for_delay == 5):
-                base_delay = 0.5   # very aggressive during stage 5
-            elif poll_until_ts and now_ts < poll_until_ts:
-                base_delay = 1.0   # active window faster
-            else:
-                base_delay = 4.5   # idle but still reasonably quick
-            # add tiny jitter to avoid sync
-            jitter = 0.3
-            delay = max(0.5, base_delay + (random.random() - 0.5) * jitter)
+            notified_any_7 = False
+            for uid in session_user_ids(session_id, target_user_id):
+                st = user_state.peek(uid)
+                if st is None:
+                    continue
+                chat_id = st.get('chat_id')
+                if target_chat_id is not None:
+                    try:
+                        chat_id = int(target_chat_id)
+                    except Exception:
+                        pass
+                if not chat_id:
+                    continue
+                if st.get('stage7_notified'):
+                    continue
+                try:
+                    if bot_for_notifications:
+                        reply_markup = InlineKeyboardMarkup([
+                            [InlineKeyboardButton("↗️ Go to XREX Pay", url=xrex_link_url())]
+                        ])
+                        await bot_for_notifications.send_message(
+                            chat_id=chat_id,
+                            text=("🔌️ Successfully unlinked from XREX Pay account @AG*CH.\n\n"
+                                 "👉 To relink, simply start the linking process again in the XREX Pay web app."),
+                            reply_markup=reply_markup
+                        )
+                        try:
+                            await set_commands_unlinked(bot_for_notifications, chat_id)
+                        except Exception:
+                            pass
+                        st['stage7_notified'] = True
+                        user_state[uid] = st
+                        notified_any_7 = True
+                except Exception:
+                    pass
+            if (not notified_any_7) and target_user_id is not None and target_chat_id is not None:
+                try:
+                    uid_key = int(target_user_id)
+                    st = user_state.get(uid_key, {})
+                    if not st.get('stage7_notified') and bot_for_notifications:
+                        reply_markup = InlineKeyboardMarkup([
+                            [InlineKeyboardButton("↗️ Go to XREX Pay", url=xrex_link_url())]
+                        ])
+                        await bot_for_notifications.send_message(
+                            chat_id=int(target_chat_id),
+                            text=("🔌️ Successfully unlinked from XREX Pay account @AG***CH.\n\n"
+                                 "👉 To relink, simply start the linking process again in the XREX Pay web app."),
+                            reply_markup=reply_markup
+                        )
+                        try:
+                            await set_commands_unlinked(bot_for_notifications, int(target_chat_id))
+                        except Exception:
+                            pass
+                        st['stage7_notified'] = True
+                        st['chat_id'] = int(target_chat_id)
+                        user_state[uid_key] = st
+                        notified_any_7 = True
+                except Exception:
+                    pass
         except Exception:
-            delay = 4.5
-        await asyncio.sleep(delay)
+            pass
+    # The flow is over once linked/unlinked, or when a started flow (>=3) falls back to <=2
+    if stage >= 6 or (stage <= 2 and (watch['prev_stage'] or 0) >= 3):
+        watch['terminal_at'] = watch.get('terminal_at') or time.time()
+    elif stage >= 3:
+        watch['terminal_at'] = 0
+    # Update previous stage after handling notifications
+    watch['prev_stage'] = stage
+    persist_session(session_id)
+
+async def rehydrate_state(store: StatePersistence):
+    """Load persisted state, resume pollers and finalize watchers for flows still in stages 3-5,
+    then start mirroring changes into the store."""
+    global state_store
+    t0 = time.perf_counter()
+    users, sessions, chats = await asyncio.to_thread(store.load)
+    now = time.time()
+    restored_users = 0
+    for uid, data, ts in sorted(users, key=lambda row: row[2]):
+        idle = max(0.0, now - ts)
+        if idle > user_state.idle_ttl:
+            store.mark_user(uid)
+            continue
+        user_state[uid] = {k: v for k, v in data.items() if k in _USER_SESSION_FIELD_SET}
+        user_state.peek(uid).last_active = time.monotonic() - idle
+        restored_users += 1
+    resumed = 0
+    # Oldest first, so a user's newest flow claims the watch and the registry keeps its change order
+    sessions.sort(key=lambda row: (row[1] or {}).get('changed_at') or 0)
+    for sid, watch, sub in sessions:
+        stage = (watch or {}).get('prev_stage')
+        if watch is None or (stage is not None and not (3 <= int(stage) <= 5)):
+            # Finished, expired or never-watched: drop the row on the next flush
+            store.mark_session(sid)
+            continue
+        if sub:
+            session_subscriptions[sid] = sub
+            if sub.get('user_id') is not None:
+                claim_session_watch(int(sub['user_id']), sid)
+        watch_session(sid)
+        live = session_watches.get(sid)
+        if live is None:
+            continue
+        for key, value in watch.items():
+            # Poll deadlines and event receipt are per-process; events must reach this process again
+            if key in live and key not in ('next_poll_ts', 'event_at'):
+                live[key] = tuple(value) if key == 'last_fingerprint' and value is not None else value
+        resumed += 1
+        if stage in (4, 5):
+            uid, chat = resolve_session_target(sid, (sub or {}).get('user_id'), (sub or {}).get('chat_id'))
+            if uid is not None and chat is not None:
+                ensure_finalize_watch(tg_user_id=uid, chat_id=chat)
+    for chat_id, tag in chats:
+        chat_command_scopes[chat_id] = tag
+    user_state.on_change = store.mark_user
+    state_store = store
+    store.start()
+    logger.info(f"state persistence: rehydrated {restored_users} users, resumed {resumed} sessions, {len(chats)} command menus from {store.path} in {(time.perf_counter() - t0) * 1000:.1f} ms")
+
+async def user_state_housekeeping(interval: float = 60.0):
+    """Periodically expire idle user sessions and stale linkage-cache entries, and log store size."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            user_state.sweep()
+            now = time.monotonic()
+            for uid, entry in list(link_cache.items()):
+                if entry[0] <= now:
+                    link_cache.pop(uid, None)
+            for chat_id, lock in list(command_scope_locks.items()):
+                if not lock.locked():
+                    command_scope_locks.pop(chat_id, None)
+            logger.info(f"avatar cache: {avatar_cache.stats()} jobs: {avatar_jobs.stats()}")
+            logger.info(f"wallet cache: {wallet_cache.stats()} classify: {classify_address.cache_info()}")
+            for index in (label_index, risk_index):
+                if index is not None:
+                    index.maybe_reload()
+                    logger.info(f"{type(index).__name__}: {index.stats()}")
+            logger.info(f"command menus: {dict(command_scope_stats, tracked_chats=len(chat_command_scopes))}")
+            logger.info(f"session watches: {session_watch_stats()} wheel: {poll_wheel.stats()}")
+            logger.info(f"user_state: {user_state.stats()} locks={len(notify_locks)} subscriptions={len(session_subscriptions)} finalize_watchers={len(finalize_watch_tasks)}")
+            if outbound_scheduler is not None:
+                logger.info(f"outbound: {outbound_scheduler.stats()}")
+        except Exception as e:
+            logger.debug(f"user_state housekeeping failed: {str(e)}")
 
 def generate_verification_code():
     """Generate a random 6-digit verification code."""
@@ -1046,24 +2846,814 @@ async def check_webhook(bot):
     except Exception as e:
         logger.error(f"Error checking webhook: {str(e)}")
 
+# Address classification: real checksum validation instead of prefix guesses, so malformed input
+# never reaches downstream lookups. Alphabet tables are built once at import.
+AddressInfo = namedtuple('AddressInfo', 'address chain kind valid explorer error')
+
+_B58_ALPHABET = b'123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+_B58_INDEX = [-1] * 128
+for _i, _c in enumerate(_B58_ALPHABET):
+    _B58_INDEX[_c] = _i
+_BECH32_CHARSET = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+_BECH32_INDEX = [-1] * 128
+for _i, _c in enumerate(_BECH32_CHARSET):
+    _BECH32_INDEX[ord(_c)] = _i
+_BECH32_GEN = (0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3)
+# XOR of the generator terms selected by each possible 5-bit carry, so polymod is one lookup per symbol
+_BECH32_GEN_TABLE = tuple(
+    functools.reduce(lambda acc, i: acc ^ (_BECH32_GEN[i] if (top >> i) & 1 else 0), range(5), 0) for top in range(32)
+)
+_BECH32_CONST = 1
+_BECH32M_CONST = 0x2bc830a3
+_HEX_DIGITS = frozenset('0123456789abcdefABCDEF')
+# Base58Check version byte -> (chain, kind)
+_B58_VERSIONS = {
+    0x00: ('Bitcoin', 'P2PKH'),
+    0x05: ('Bitcoin', 'P2SH'),
+    0x41: ('TRON', 'account'),
+}
+_EXPLORERS = {
+    'Bitcoin': "https://www.blockchain.com/btc/address/{}",
+    'Ethereum': "https://etherscan.io/address/{}",
+    'TRON': "https://tronscan.org/#/address/{}",
+}
+
+def base58_decode(text: str) -> bytes:
+    """Decode base58 (leading '1's are zero bytes); raises ValueError on characters outside the alphabet."""
+    num = 0
+    for ch in text.encode('ascii', 'replace'):
+        value = _B58_INDEX[ch] if ch < 128 else -1
+        if value < 0:
+            raise ValueError('invalid base58 character')
+        num = num * 58 + value
+    pad = len(text) - len(text.lstrip('1'))
+    return b'\x00' * pad + (num.to_bytes((num.bit_length() + 7) // 8, 'big') if num else b'')
+
+def base58check_decode(text: str) -> bytes:
+    """Return the payload (version byte included) if the 4-byte double-SHA256 checksum matches."""
+    raw = base58_decode(text)
+    if len(raw) < 5:
+        raise ValueError('too short')
+    payload, checksum = raw[:-4], raw[-4:]
+    if hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] != checksum:
+        raise ValueError('bad checksum')
+    return payload
+
+def _bech32_polymod(values) -> int:
+    chk = 1
+    table = _BECH32_GEN_TABLE
+    for v in values:
+        chk = ((chk & 0x1ffffff) << 5) ^ v ^ table[chk >> 25]
+    return chk
+
+def bech32_decode(text: str):
+    """Return (hrp, data 5-bit values, constant) for a well-formed bech32/bech32m string; raises ValueError."""
+    if text.lower() != text and text.upper() != text:
+        raise ValueError('mixed case')
+    text = text.lower()
+    pos = text.rfind('1')
+    if pos < 1 or pos + 7 > len(text) or len(text) > 90:
+        raise ValueError('bad separator position')
+    hrp = text[:pos]
+    data = []
+    for ch in text[pos + 1:]:
+        code = ord(ch)
+        value = _BECH32_INDEX[code] if code < 128 else -1
+        if value < 0:
+            raise ValueError('invalid bech32 character')
+        data.append(value)
+    const = _bech32_polymod([ord(c) >> 5 for c in hrp] + [0] + [ord(c) & 31 for c in hrp] + data)
+    if const not in (_BECH32_CONST, _BECH32M_CONST):
+        raise ValueError('bad checksum')
+    return hrp, data[:-6], const
+
+def _convert_bits(data, from_bits: int, to_bits: int) -> bytes:
+    acc = 0
+    bits = 0
+    out = bytearray()
+    maxv = (1 << to_bits) - 1
+    for value in data:
+        acc = (acc << from_bits) | value
+        bits += from_bits
+        while bits >= to_bits:
+            bits -= to_bits
+            out.append((acc >> bits) & maxv)
+    if bits >= from_bits or (acc << (to_bits - bits)) & maxv:
+        raise ValueError('non-zero padding')
+    return bytes(out)
+
+def decode_segwit_address(text: str, hrp: str = 'bc'):
+    """BIP-173/350 segwit address -> (witness_version, program); raises ValueError."""
+    got_hrp, data, const = bech32_decode(text)
+    if got_hrp != hrp or not data:
+        raise ValueError('wrong network')
+    version = data[0]
+    if version > 16:
+        raise ValueError('bad witness version')
+    program = _convert_bits(data[1:], 5, 8)
+    if not 2 <= len(program) <= 40:
+        raise ValueError('bad program length')
+    if version == 0 and len(program) not in (20, 32):
+        raise ValueError('bad program length')
+    # v0 uses bech32, v1+ bech32m
+    if (const == _BECH32_CONST) != (version == 0):
+        raise ValueError('wrong checksum variant')
+    return version, program
+
+# Keccak-256 (pre-NIST padding, as used by Ethereum); hashlib.sha3_256 is not the same function
+try:
+    from Crypto.Hash import keccak as _pycryptodome_keccak
+except Exception:
+    _pycryptodome_keccak = None
+_KECCAK_RC = (
+    0x0000000000000001, 0x0000000000008082, 0x800000000000808A, 0x8000000080008000,
+    0x000000000000808B, 0x0000000080000001, 0x8000000080008081, 0x8000000000008009,
+    0x000000000000008A, 0x0000000000000088, 0x0000000080008009, 0x000000008000000A,
+    0x000000008000808B, 0x800000000000008B, 0x8000000000008089, 0x8000000000008003,
+    0x8000000000008002, 0x8000000000000080, 0x000000000000800A, 0x800000008000000A,
+    0x8000000080008081, 0x8000000000008080, 0x0000000080000001, 0x8000000080008008,
+)
+_MASK64 = (1 << 64) - 1
+
+def _keccak_f(a: list):
+    # Unrolled over the 25 lanes (s<x + 5y>): locals are several times faster than list indexing
+    s0, s1, s2, s3, s4, s5, s6, s7, s8, s9, s10, s11, s12, s13, s14, s15, s16, s17, s18, s19, s20, s21, s22, s23, s24 = a
+    m = _MASK64
+    for rc in _KECCAK_RC:
+        c0 = s0 ^ s5 ^ s10 ^ s15 ^ s20
+        c1 = s1 ^ s6 ^ s11 ^ s16 ^ s21
+        c2 = s2 ^ s7 ^ s12 ^ s17 ^ s22
+        c3 = s3 ^ s8 ^ s13 ^ s18 ^ s23
+        c4 = s4 ^ s9 ^ s14 ^ s19 ^ s24
+        d0 = c4 ^ (((c1 << 1) | (c1 >> 63)) & m)
+        d1 = c0 ^ (((c2 << 1) | (c2 >> 63)) & m)
+        d2 = c1 ^ (((c3 << 1) | (c3 >> 63)) & m)
+        d3 = c2 ^ (((c4 << 1) | (c4 >> 63)) & m)
+        d4 = c3 ^ (((c0 << 1) | (c0 >> 63)) & m)
+        b0 = (s0 ^ d0)
+        t = (s1 ^ d1)
+        b10 = ((t << 1) | (t >> 63)) & m
+        t = (s2 ^ d2)
+        b20 = ((t << 62) | (t >> 2)) & m
+        t = (s3 ^ d3)
+        b5 = ((t << 28) | (t >> 36)) & m
+        t = (s4 ^ d4)
+        b15 = ((t << 27) | (t >> 37)) & m
+        t = (s5 ^ d0)
+        b16 = ((t << 36) | (t >> 28)) & m
+        t = (s6 ^ d1)
+        b1 = ((t << 44) | (t >> 20)) & m
+        t = (s7 ^ d2)
+        b11 = ((t << 6) | (t >> 58)) & m
+        t = (s8 ^ d3)
+        b21 = ((t << 55) | (t >> 9)) & m
+        t = (s9 ^ d4)
+        b6 = ((t << 20) | (t >> 44)) & m
+        t = (s10 ^ d0)
+        b7 = ((t << 3) | (t >> 61)) & m
+        t = (s11 ^ d1)
+        b17 = ((t << 10) | (t >> 54)) & m
+        t = (s12 ^ d2)
+        b2 = ((t << 43) | (t >> 21)) & m
+        t = (s13 ^ d3)
+        b12 = ((t << 25) | (t >> 39)) & m
+        t = (s14 ^ d4)
+        b22 = ((t << 39) | (t >> 25)) & m
+        t = (s15 ^ d0)
+        b23 = ((t << 41) | (t >> 23)) & m
+        t = (s16 ^ d1)
+        b8 = ((t << 45) | (t >> 19)) & m
+        t = (s17 ^ d2)
+        b18 = ((t << 15) | (t >> 49)) & m
+        t = (s18 ^ d3)
+        b3 = ((t << 21) | (t >> 43)) & m
+        t = (s19 ^ d4)
+        b13 = ((t << 8) | (t >> 56)) & m
+        t = (s20 ^ d0)
+        b14 = ((t << 18) | (t >> 46)) & m
+        t = (s21 ^ d1)
+        b24 = ((t << 2) | (t >> 62)) & m
+        t = (s22 ^ d2)
+        b9 = ((t << 61) | (t >> 3)) & m
+        t = (s23 ^ d3)
+        b19 = ((t << 56) | (t >> 8)) & m
+        t = (s24 ^ d4)
+        b4 = ((t << 14) | (t >> 50)) & m
+        s0 = b0 ^ (~b1 & b2)
+        s1 = b1 ^ (~b2 & b3)
+        s2 = b2 ^ (~b3 & b4)
+        s3 = b3 ^ (~b4 & b0)
+        s4 = b4 ^ (~b0 & b1)
+        s5 = b5 ^ (~b6 & b7)
+        s6 = b6 ^ (~b7 & b8)
+        s7 = b7 ^ (~b8 & b9)
+        s8 = b8 ^ (~b9 & b5)
+        s9 = b9 ^ (~b5 & b6)
+        s10 = b10 ^ (~b11 & b12)
+        s11 = b11 ^ (~b12 & b13)
+        s12 = b12 ^ (~b13 & b14)
+        s13 = b13 ^ (~b14 & b10)
+        s14 = b14 ^ (~b10 & b11)
+        s15 = b15 ^ (~b16 & b17)
+        s16 = b16 ^ (~b17 & b18)
+        s17 = b17 ^ (~b18 & b19)
+        s18 = b18 ^ (~b19 & b15)
+        s19 = b19 ^ (~b15 & b16)
+        s20 = b20 ^ (~b21 & b22)
+        s21 = b21 ^ (~b22 & b23)
+        s22 = b22 ^ (~b23 & b24)
+        s23 = b23 ^ (~b24 & b20)
+        s24 = b24 ^ (~b20 & b21)
+        s0 ^= rc
+    a[:] = [s0, s1, s2, s3, s4, s5, s6, s7, s8, s9, s10, s11, s12, s13, s14, s15, s16, s17, s18, s19, s20, s21, s22, s23, s24]
+
+def keccak256(data: bytes) -> bytes:
+    if _pycryptodome_keccak is not None:
+        return _pycryptodome_keccak.new(digest_bits=256, data=data).digest()
+    rate = 136
+    padded = bytearray(data)
+    padded.append(0x01)
+    padded.extend(b'\x00' * (-len(padded) % rate))
+    padded[-1] |= 0x80
+    state = [0] * 25
+    for off in range(0, len(padded), rate):
+        for i in range(rate // 8):
+            state[i] ^= int.from_bytes(padded[off + 8 * i:off + 8 * i + 8], 'little')
+        _keccak_f(state)
+    return b''.join(state[i].to_bytes(8, 'little') for i in range(4))
+
+def eip55_checksum(address: str) -> str:
+    """Mixed-case checksummed form of a 0x-prefixed 20-byte hex address."""
+    hex_addr = address[2:].lower()
+    digest = keccak256(hex_addr.encode('ascii')).hex()
+    return '0x' + ''.join(ch.upper() if int(digest[i], 16) >= 8 else ch for i, ch in enumerate(hex_addr))
+
+@functools.lru_cache(maxsize=8192)
+def classify_address(address: str) -> AddressInfo:
+    """Identify chain and address type, validating the checksum where the format has one.
+
+    valid=False carries the best chain guess (or 'Unknown') and a short error for the user.
+    """
+    addr = (address or '').strip()
+    low = addr.lower()
+    if low.startswith('0x'):
+        body = addr[2:]
+        if len(body) != 40 or not all(ch in _HEX_DIGITS for ch in body):
+            return AddressInfo(addr, 'Ethereum', None, False, '', 'must be 0x followed by 40 hex digits')
+        # All-lower / all-upper carry no checksum (EIP-55); mixed case must match it
+        if body != body.lower() and body != body.upper() and eip55_checksum(addr) != addr:
+            return AddressInfo(addr, 'Ethereum', None, False, '', 'EIP-55 checksum mismatch')
+        norm = '0x' + body.lower()
+        return AddressInfo(norm, 'Ethereum', 'account', True, _EXPLORERS['Ethereum'].format(norm), None)
+    if low.startswith('bc1'):
+        try:
+            version, program = decode_segwit_address(addr)
+        except ValueError as e:
+            return AddressInfo(addr, 'Bitcoin', None, False, '', f"invalid bech32 address ({e})")
+        if version == 0:
+            kind = 'P2WPKH' if len(program) == 20 else 'P2WSH'
+        else:
+            kind = 'P2TR' if version == 1 and len(program) == 32 else f"witness_v{version}"
+        return AddressInfo(low, 'Bitcoin', kind, True, _EXPLORERS['Bitcoin'].format(low), None)
+    if addr[:1] in ('1', '3', 'T') and 25 <= len(addr) <= 35:
+        guess = 'TRON' if addr[0] == 'T' else 'Bitcoin'
+        try:
+            payload = base58check_decode(addr)
+        except ValueError as e:
+            return AddressInfo(addr, guess, None, False, '', f"invalid base58check address ({e})")
+        match = _B58_VERSIONS.get(payload[0]) if len(payload) == 21 else None
+        if match is None:
+            return AddressInfo(addr, guess, None, False, '', 'unsupported address version')
+        chain, kind = match
+        return AddressInfo(addr, chain, kind, True, _EXPLORERS[chain].format(addr), None)
+    return AddressInfo(addr, 'Unknown', None, False, '', 'unrecognized address format')
+
+def classify_addresses(addresses) -> list:
+    """Batch form of classify_address; identical inputs are classified once."""
+    seen = {}
+    out = []
+    for address in addresses:
+        info = seen.get(address)
+        if info is None:
+            info = seen[address] = classify_address(address)
+        out.append(info)
+    return out
+
 def detect_chain_and_explorer(address: str):
     try:
-        addr = (address or '').strip()
-        low = addr.lower()
-        # ETH
-        if low.startswith('0x') and len(low) >= 10:
-            return 'Ethereum', f"https://etherscan.io/address/{addr}"
-        # BTC (basic heuristics)
-        if low.startswith('bc1') or low.startswith('1') or low.startswith('3'):
-            return 'Bitcoin', f"https://www.blockchain.com/btc/address/{addr}"
-        # TRON
-        if addr.startswith('T'):
-            return 'TRON', f"https://tronscan.org/#/address/{addr}"
-        return 'Unknown', ''
+        info = classify_address(address)
+        if not info.valid:
+            return 'Unknown', ''
+        return info.chain, info.explorer
     except Exception:
         return 'Unknown', ''
 
-def render_wallet_details(address: str) -> str:
+class WalletLookupCache:
+    """LRU of wallet lookup results keyed by (facet, chain, normalized address).
+
+    Facets expire on their own TTLs (balances change far more often than labels and risk); a
+    None result, meaning upstream does not know the address, is kept for the negative TTL.
+    Concurrent misses for one key share a single upstream call, and every hit is credited with
+    the latency the original fetch took.
+    """
+
+    def __init__(self, ttls: dict, negative_ttl: float, max_entries: int = 20000):
+        self.ttls = dict(ttls)
+        self.negative_ttl = float(negative_ttl)
+        self.max_entries = int(max_entries)
+        self._items = OrderedDict()
+        self._inflight = {}
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evicted = 0
+        self.upstream_seconds = 0.0
+        self.saved_seconds = 0.0
+
+    async def get(self, facet: str, info: AddressInfo, fetch):
+        key = (facet, info.chain, info.address)
+        entry = self._items.get(key)
+        if entry is not None:
+            expires_at, value, cost = entry
+            if expires_at > time.monotonic():
+                self._items.move_to_end(key)
+                self.hits += 1
+                if value is None:
+                    self.negative_hits += 1
+                self.saved_seconds += cost
+                return value
+            self._items.pop(key, None)
+        fut = self._inflight.get(key)
+        if fut is None:
+            self.misses += 1
+            fut = asyncio.ensure_future(self._fill(key, facet, info, fetch))
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda _f, key=key: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(fut)
+
+    async def _fill(self, key, facet: str, info: AddressInfo, fetch):
+        t0 = time.perf_counter()
+        value = await fetch(info)
+        cost = time.perf_counter() - t0
+        self.upstream_seconds += cost
+        ttl = self.negative_ttl if value is None else self.ttls.get(facet, self.negative_ttl)
+        self._items[key] = (time.monotonic() + ttl, value, cost)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_entries:
+            self._items.popitem(last=False)
+            self.evicted += 1
+        return value
+
+    def invalidate(self, chain: str = None, address: str = None):
+        """Drop every facet for one address, or everything when called without arguments."""
+        if chain is None:
+            self._items.clear()
+            return
+        for key in [k for k in self._items if k[1] == chain and k[2] == address]:
+            self._items.pop(key, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            'entries': len(self._items),
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'evicted': self.evicted,
+            'hit_ratio': round((self.hits + self.coalesced) / lookups, 3) if lookups else 0.0,
+            'upstream_ms': round(self.upstream_seconds * 1000, 1),
+            'saved_ms': round(self.saved_seconds * 1000, 1),
+        }
+
+wallet_cache = WalletLookupCache(
+    ttls={
+        'balance': float(os.getenv('WALLET_BALANCE_TTL', '60')),
+        'profile': float(os.getenv('WALLET_PROFILE_TTL', '3600')),
+    },
+    negative_ttl=float(os.getenv('WALLET_NEGATIVE_TTL', '300')),
+    max_entries=int(os.getenv('WALLET_CACHE_MAX', '20000')),
+)
+
+async def fetch_wallet_balance(info: AddressInfo):
+    """Upstream balance lookup: [(amount, symbol)], or None if the address is unknown upstream."""
+    return [('17.50', 'USDT')]
+
+async def fetch_wallet_profile(info: AddressInfo):
+    """Attribution (offline label index) and risk screening (offline risk lists) for an address."""
+    profile = {
+        'entity': None,
+        'entity_url': None,
+        'label': None,
+        'category': 'Unknown',
+        'risk_level': 'Low',
+        'risk_description': None,
+    }
+    attribution = label_index.lookup(info.address) if label_index is not None else None
+    if attribution:
+        profile['entity'] = attribution.get('entity')
+        profile['entity_url'] = attribution.get('url')
+        profile['label'] = attribution.get('label')
+        profile['category'] = attribution.get('category') or 'Unknown'
+    if risk_index is None:
+        profile['risk_level'] = 'Unknown'
+    else:
+        hit = risk_index.screen(info.address)
+        if hit:
+            profile['risk_level'] = hit['level']
+            profile['risk_description'] = hit['description'] or hit['list']
+    return profile
+
+class MappedIndex:
+    """Base for read-only, memory-mapped lookup files compiled offline.
+
+    The mapping is read-only, so every bot process shares the same page-cache pages. Compilers
+    write beside the target and os.replace() it; maybe_reload() notices the new inode/size/mtime
+    and swaps in the parsed file as one reference, so a lookup never sees half of each.
+    """
+
+    MAGIC = b''
+
+    def __init__(self, path: str, check_interval: float = 5.0, on_reload=None):
+        self.path = path
+        self.check_interval = float(check_interval)
+        self.on_reload = on_reload
+        self._state = None
+        self._signature = None
+        self._next_check = 0.0
+        self.lookups = 0
+        self.found = 0
+        self.reloads = 0
+
+    @staticmethod
+    def key(address: str) -> bytes:
+        addr = (address or '').strip()
+        low = addr.lower()
+        # Same normalization as classify_address: hex and bech32 are case-insensitive
+        if low.startswith(('0x', 'bc1')):
+            addr = low
+        return hashlib.blake2b(addr.encode('utf-8'), digest_size=16).digest()
+
+    @staticmethod
+    def read_string(mm, str_off: int, offset: int):
+        if offset == 0xFFFFFFFF:
+            return None
+        pos = str_off + offset
+        (length,) = struct.unpack_from('<H', mm, pos)
+        return mm[pos + 2:pos + 2 + length].decode('utf-8')
+
+    def _parse(self, mm):
+        """Validate the mapped file and return the subclass's lookup state (mm must be its first item)."""
+        raise NotImplementedError
+
+    def _describe(self, state) -> str:
+        return self.path
+
+    def _load(self):
+        f = open(self.path, 'rb')
+        try:
+            st = os.fstat(f.fileno())
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            f.close()
+            raise
+        try:
+            if mm[:len(self.MAGIC)] != self.MAGIC:
+                raise ValueError(f"{self.path} is not a {type(self).__name__} file")
+            state = self._parse(mm)
+        except Exception:
+            mm.close()
+            f.close()
+            raise
+        old, old_file = self._state, getattr(self, '_file', None)
+        # Lookups never await, so this single assignment is the whole swap for the event loop
+        self._state, self._file = state, f
+        self._signature = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if old is not None:
+            old[0].close()
+            old_file.close()
+            self.reloads += 1
+        if self.on_reload is not None:
+            self.on_reload()
+        logger.info(f"{type(self).__name__}: loaded {self._describe(state)} from {self.path}")
+
+    def maybe_reload(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now < self._next_check:
+            return
+        self._next_check = now + self.check_interval
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if force or (st.st_ino, st.st_size, st.st_mtime_ns) != self._signature:
+            try:
+                self._load()
+            except Exception as e:
+                # Remember the bad file so it is reported once, not on every check
+                self._signature = (st.st_ino, st.st_size, st.st_mtime_ns)
+                logger.error(f"{type(self).__name__} reload failed, keeping the previous one: {str(e)}")
+
+def _string_table():
+    """Interning helper for index compilers: returns (intern(text) -> offset, blob)."""
+    strings = {}
+    blob = bytearray()
+
+    def intern(text):
+        if not text:
+            return 0xFFFFFFFF
+        off = strings.get(text)
+        if off is None:
+            raw = str(text).encode('utf-8')[:0xFFFF]
+            off = strings[text] = len(blob)
+            blob.extend(struct.pack('<H', len(raw)))
+            blob.extend(raw)
+        return off
+
+    return intern, blob
+
+def _write_index_file(path: str, parts) -> int:
+    """Write byte chunks to a temp file beside path, fsync, and atomically move it into place."""
+    tmp = f"{path}.tmp.{os.getpid()}"
+    size = 0
+    with open(tmp, 'wb') as f:
+        for part in parts:
+            f.write(part)
+            size += len(part)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return size
+
+class LabelIndex(MappedIndex):
+    """Address attribution index (address -> entity, category, label, url).
+
+    Built offline by compile_label_index (tools/build_label_index.py). Layout:
+        header    magic, record/entity counts, section offsets
+        records   sorted (blake2b-128(address), entity index, label offset), binary-searched
+        entities  (name, category, url) string offsets, shared by every address of an entity
+        strings   u16 length-prefixed UTF-8
+    """
+
+    MAGIC = b'XLBLIDX1'
+    HEADER = struct.Struct('<8sQQQQQ')
+    RECORD = struct.Struct('<16sII')
+    ENTITY = struct.Struct('<III')
+
+    def _parse(self, mm):
+        _, records, entities, rec_off, ent_off, str_off = self.HEADER.unpack_from(mm, 0)
+        if rec_off + records * self.RECORD.size > len(mm) or ent_off + entities * self.ENTITY.size > len(mm):
+            raise ValueError(f"{self.path} is truncated")
+        return (mm, records, entities, rec_off, ent_off, str_off)
+
+    def _describe(self, state) -> str:
+        return f"{state[1]} addresses, {state[2]} entities"
+
+    def lookup(self, address: str):
+        """Attribution dict for an address, or None if it is not in the index."""
+        self.maybe_reload()
+        state = self._state
+        if state is None:
+            return None
+        mm, records, _, base, ent_off, str_off = state
+        self.lookups += 1
+        key = self.key(address)
+        size = self.RECORD.size
+        lo, hi = 0, records
+        while lo < hi:
+            mid = (lo + hi) // 2
+            probe = mm[base + mid * size:base + mid * size + 16]
+            if probe < key:
+                lo = mid + 1
+            elif probe > key:
+                hi = mid
+            else:
+                _, entity_idx, label_off = self.RECORD.unpack_from(mm, base + mid * size)
+                name_off, category_off, url_off = self.ENTITY.unpack_from(mm, ent_off + entity_idx * self.ENTITY.size)
+                self.found += 1
+                return {
+                    'entity': self.read_string(mm, str_off, name_off),
+                    'category': self.read_string(mm, str_off, category_off),
+                    'url': self.read_string(mm, str_off, url_off),
+                    'label': self.read_string(mm, str_off, label_off),
+                }
+        return None
+
+    def stats(self) -> dict:
+        state = self._state
+        return {
+            'records': state[1] if state else 0,
+            'entities': state[2] if state else 0,
+            'lookups': self.lookups,
+            'found': self.found,
+            'reloads': self.reloads,
+        }
+
+def compile_label_index(rows, path: str) -> dict:
+    """Write a LabelIndex file from (address, entity, category, url, label) rows.
+
+    The file is built next to the target and moved into place with os.replace, so running
+    bots switch to it atomically on their next maybe_reload().
+    """
+    intern, blob = _string_table()
+    entity_ids = {}
+    entity_rows = []
+    records = {}
+    for address, entity, category, url, label in rows:
+        if not address:
+            continue
+        ekey = (entity or '', category or '', url or '')
+        idx = entity_ids.get(ekey)
+        if idx is None:
+            idx = entity_ids[ekey] = len(entity_rows)
+            entity_rows.append((intern(entity), intern(category), intern(url)))
+        # Last row wins for duplicate addresses
+        records[LabelIndex.key(address)] = (idx, intern(label))
+    rec_off = LabelIndex.HEADER.size
+    ent_off = rec_off + len(records) * LabelIndex.RECORD.size
+    str_off = ent_off + len(entity_rows) * LabelIndex.ENTITY.size
+    size = _write_index_file(path, itertools.chain(
+        [LabelIndex.HEADER.pack(LabelIndex.MAGIC, len(records), len(entity_rows), rec_off, ent_off, str_off)],
+        (LabelIndex.RECORD.pack(key, *records[key]) for key in sorted(records)),
+        (LabelIndex.ENTITY.pack(*entity) for entity in entity_rows),
+        [bytes(blob)],
+    ))
+    return {'records': len(records), 'entities': len(entity_rows), 'bytes': size}
+
+class RiskIndex(MappedIndex):
+    """Sanctions / high-risk address screening: in-memory Bloom filter, exact on-disk confirm.
+
+    Built offline by compile_risk_index (tools/build_risk_index.py). Layout:
+        header    magic, record count, Bloom bits and hash count, list count, section offsets
+        bloom     m-bit filter over blake2b-128(address), copied into memory at load
+        records   sorted (blake2b-128(address), list index), only read to confirm Bloom positives
+        lists     (name, risk level, description) string offsets
+        strings   u16 length-prefixed UTF-8
+    A clean address costs k bit tests and never touches the records section.
+    """
+
+    MAGIC = b'XRISKID1'
+    HEADER = struct.Struct('<8sQQIIQQQQ')
+    RECORD = struct.Struct('<16sH')
+    LIST = struct.Struct('<III')
+
+    def __init__(self, path: str, check_interval: float = 5.0, on_reload=None):
+        super().__init__(path, check_interval, on_reload)
+        self.bloom_negatives = 0
+        self.false_positives = 0
+
+    def _parse(self, mm):
+        _, records, bits, hashes, lists, bloom_off, rec_off, lists_off, str_off = self.HEADER.unpack_from(mm, 0)
+        if bits == 0 or bloom_off + (bits + 7) // 8 > len(mm) or rec_off + records * self.RECORD.size > len(mm):
+            raise ValueError(f"{self.path} is truncated")
+        bloom = bytes(mm[bloom_off:bloom_off + (bits + 7) // 8])
+        entries = []
+        for i in range(lists):
+            name_off, level_off, desc_off = self.LIST.unpack_from(mm, lists_off + i * self.LIST.size)
+            entries.append({
+                'list': self.read_string(mm, str_off, name_off),
+                'level': self.read_string(mm, str_off, level_off) or 'High',
+                'description': self.read_string(mm, str_off, desc_off),
+            })
+        return (mm, records, bits, hashes, bloom, rec_off, tuple(entries))
+
+    def _describe(self, state) -> str:
+        return f"{state[1]} addresses on {len(state[6])} lists, {len(state[4]) // 1024} KB filter"
+
+    @staticmethod
+    def bloom_positions(key: bytes, bits: int, hashes: int):
+        # Kirsch-Mitzenmacher double hashing over the two halves of the 128-bit key
+        h1 = int.from_bytes(key[:8], 'little')
+        h2 = int.from_bytes(key[8:], 'little') | 1
+        return [(h1 + i * h2) % bits for i in range(hashes)]
+
+    def _maybe_listed(self, state, key: bytes) -> bool:
+        _, _, bits, hashes, bloom, _, _ = state
+        h1 = int.from_bytes(key[:8], 'little')
+        h2 = int.from_bytes(key[8:], 'little') | 1
+        for i in range(hashes):
+            pos = (h1 + i * h2) % bits
+            if not bloom[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def _confirm(self, state, key: bytes, lo: int = 0):
+        """Binary search for key from position lo; returns (list entry or None, insertion point)."""
+        mm, records, _, _, _, base, entries = state
+        size = self.RECORD.size
+        hi = records
+        while lo < hi:
+            mid = (lo + hi) // 2
+            probe = mm[base + mid * size:base + mid * size + 16]
+            if probe < key:
+                lo = mid + 1
+            elif probe > key:
+                hi = mid
+            else:
+                return entries[self.RECORD.unpack_from(mm, base + mid * size)[1]], mid
+        return None, lo
+
+    def screen(self, address: str):
+        """{'list', 'level', 'description'} if the address is listed, else None."""
+        return self.screen_many([address])[0]
+
+    def screen_many(self, addresses) -> list:
+        """Batch screen: Bloom-test everything, then confirm the survivors in key order in one sweep."""
+        self.maybe_reload()
+        state = self._state
+        results = [None] * len(addresses)
+        if state is None:
+            return results
+        self.lookups += len(addresses)
+        candidates = []
+        for i, address in enumerate(addresses):
+            key = self.key(address)
+            if self._maybe_listed(state, key):
+                candidates.append((key, i))
+            else:
+                self.bloom_negatives += 1
+        lo = 0
+        for key, i in sorted(candidates):
+            entry, lo = self._confirm(state, key, lo)
+            if entry is None:
+                self.false_positives += 1
+            else:
+                self.found += 1
+                results[i] = entry
+        return results
+
+    def stats(self) -> dict:
+        state = self._state
+        return {
+            'records': state[1] if state else 0,
+            'filter_bytes': len(state[4]) if state else 0,
+            'lookups': self.lookups,
+            'bloom_negatives': self.bloom_negatives,
+            'false_positives': self.false_positives,
+            'found': self.found,
+            'reloads': self.reloads,
+        }
+
+def compile_risk_index(lists, path: str, fp_rate: float = 0.001) -> dict:
+    """Write a RiskIndex file from lists of (name, level, description, addresses).
+
+    An address on several lists keeps the first list given, so pass the most severe first.
+    The Bloom filter is sized for fp_rate. Written beside the target and os.replace()d.
+    """
+    intern, blob = _string_table()
+    list_rows = []
+    records = {}
+    for name, level, description, addresses in lists:
+        idx = len(list_rows)
+        list_rows.append((intern(name), intern(level), intern(description)))
+        for address in addresses:
+            if address:
+                records.setdefault(RiskIndex.key(address), idx)
+    count = max(1, len(records))
+    bits = max(64, int(math.ceil(-count * math.log(fp_rate) / (math.log(2) ** 2))))
+    hashes = max(1, int(round(bits / count * math.log(2))))
+    bloom = bytearray((bits + 7) // 8)
+    for key in records:
+        for pos in RiskIndex.bloom_positions(key, bits, hashes):
+            bloom[pos >> 3] |= 1 << (pos & 7)
+    bloom_off = RiskIndex.HEADER.size
+    rec_off = bloom_off + len(bloom)
+    lists_off = rec_off + len(records) * RiskIndex.RECORD.size
+    str_off = lists_off + len(list_rows) * RiskIndex.LIST.size
+    size = _write_index_file(path, itertools.chain(
+        [RiskIndex.HEADER.pack(RiskIndex.MAGIC, len(records), bits, hashes, len(list_rows), bloom_off, rec_off, lists_off, str_off)],
+        [bytes(bloom)],
+        (RiskIndex.RECORD.pack(key, records[key]) for key in sorted(records)),
+        (RiskIndex.LIST.pack(*row) for row in list_rows),
+        [bytes(blob)],
+    ))
+    return {'records': len(records), 'lists': len(list_rows), 'bloom_bits': bits, 'hashes': hashes,
+            'filter_bytes': len(bloom), 'bytes': size}
+
+# Optional offline datasets. Without a label index addresses have no exchange attribution;
+# without a risk index the risk level is reported as Unknown rather than guessed.
+label_index = None
+if os.getenv('LABEL_INDEX_PATH', '').strip():
+    label_index = LabelIndex(
+        os.getenv('LABEL_INDEX_PATH').strip(),
+        check_interval=float(os.getenv('LABEL_INDEX_CHECK_INTERVAL', '5')),
+        on_reload=lambda: wallet_cache.invalidate(),
+    )
+risk_index = None
+if os.getenv('RISK_INDEX_PATH', '').strip():
+    risk_index = RiskIndex(
+        os.getenv('RISK_INDEX_PATH').strip(),
+        check_interval=float(os.getenv('RISK_INDEX_CHECK_INTERVAL', '5')),
+        on_reload=lambda: wallet_cache.invalidate(),
+    )
+
+RISK_LEVEL_ICONS = {'Low': '🟢', 'Medium': '🟡', 'High': '🔴', 'Severe': '⛔'}
+
+def render_wallet_details(address: str, balance=None, profile=None) -> str:
+    """Report for one address; balance/profile are the fetch_wallet_* results (None = unknown)."""
     chain, explorer = detect_chain_and_explorer(address)
     # Derive explorer base (up to 'address/' if present)
     try:
@@ -1076,25 +3666,166 @@ def render_wallet_details(address: str) -> str:
         base = explorer
     lines = []
     lines.append("📎 Your queried wallet address:")
-    lines.append(f"<b>{address}" + "69zkqmk6ee3ewf0j77s3h</b>")
+    lines.append(f"<b>{html.escape(address)}" + "69zkqmk6ee3ewf0j77s3h</b>")
     # Show only one explorer reference (prefer full link if available)
     if explorer:
         lines.append(explorer)
     elif base:
         lines.append(base)
     lines.append(f"Blockchain: <b>{chain}</b>")
-    lines.append("📌 Exchange: <b>XREX</b>")
-    lines.append("https://xrex.io/xray/app/entity/6")
-    lines.append("On-chain Label: <b>None</b>")
-    lines.append("Address Category: <b>Unknown</b>")
+    profile = profile or {}
+    if profile.get('entity'):
+        lines.append(f"📌 Exchange: <b>{html.escape(str(profile['entity']))}</b>")
+        if profile.get('entity_url'):
+            lines.append(str(profile['entity_url']))
+    lines.append(f"On-chain Label: <b>{html.escape(str(profile.get('label') or 'None'))}</b>")
+    lines.append(f"Address Category: <b>{html.escape(str(profile.get('category') or 'Unknown'))}</b>")
     lines.append("On-chain Wallet Balance:")
     lines.append("(Note: Due to different accounting logic among exchanges, the balance shown here does not equal")
     lines.append("'user assets in the exchange account')")
-    lines.append("• <b>17.50 USDT</b>")
-    lines.append("Risk Level: <b>Low 🟢</b>")
-    lines.append("Risk Description: <b>None</b>")
+    if balance:
+        for amount, symbol in balance:
+            lines.append(f"• <b>{html.escape(str(amount))} {html.escape(str(symbol))}</b>")
+    else:
+        lines.append("• <b>No balance found</b>")
+    level = profile.get('risk_level') or 'Unknown'
+    lines.append(f"Risk Level: <b>{html.escape(str(level))} {RISK_LEVEL_ICONS.get(level, '⚪')}</b>")
+    lines.append(f"Risk Description: <b>{html.escape(str(profile.get('risk_description') or 'None'))}</b>")
     return "\n".join(lines)
 
+# Batch /check_wallet: up to WALLET_CHECK_MAX unique addresses per request, looked up concurrently.
+# One placeholder reply is edited (at most every WALLET_EDIT_INTERVAL seconds) as results arrive,
+# spilling into further messages when Telegram's 4096-character limit is reached.
+WALLET_CHECK_MAX = int(os.getenv('WALLET_CHECK_MAX', '10'))
+WALLET_LOOKUP_CONCURRENCY = int(os.getenv('WALLET_LOOKUP_CONCURRENCY', '4'))
+WALLET_EDIT_INTERVAL = float(os.getenv('WALLET_EDIT_INTERVAL', '1.0'))
+TELEGRAM_TEXT_LIMIT = 4096
+_WALLET_SPLIT_RE = re.compile(r'[\s,;，、]+')
+_WALLET_RESULT_SEPARATOR = "\n\n━━━━━━━━━━\n\n"
+
+def parse_wallet_addresses(text: str, limit: int = WALLET_CHECK_MAX):
+    """Split comma/space separated input into unique addresses in input order; returns (addresses, extra_count)."""
+    seen = set()
+    addresses = []
+    extra = 0
+    for token in _WALLET_SPLIT_RE.split(text or ''):
+        addr = token.strip().strip('\'"`<>()[]{}.')
+        if not addr:
+            continue
+        low = addr.lower()
+        # Hex and bech32 addresses are case-insensitive; base58 is not
+        if low.startswith('bc1'):
+            addr = low
+        key = low if low.startswith(('0x', 'bc1')) else addr
+        if key in seen:
+            continue
+        seen.add(key)
+        if len(addresses) >= limit:
+            extra += 1
+            continue
+        addresses.append(addr)
+    return addresses, extra
+
+def render_invalid_address(info: AddressInfo) -> str:
+    chain = f"{info.chain} " if info.chain != 'Unknown' else ''
+    return (
+        "📎 Your queried wallet address:\n"
+        f"<b>{html.escape(info.address)}</b>\n"
+        f"❌ Not a valid {chain}address: {info.error}.\n"
+        "Supported: Bitcoin (BTC), Ethereum (ETH), TRON (TRX)."
+    )
+
+async def lookup_wallet_details(address: str) -> str:
+    """Look up one address and render its report; malformed addresses stop here."""
+    info = classify_address(address)
+    if not info.valid:
+        return render_invalid_address(info)
+    # Cached profiles would hide a newly dropped dataset; a swap flushes them
+    for index in (label_index, risk_index):
+        if index is not None:
+            index.maybe_reload()
+    balance, profile = await asyncio.gather(
+        wallet_cache.get('balance', info, fetch_wallet_balance),
+        wallet_cache.get('profile', info, fetch_wallet_profile),
+    )
+    return render_wallet_details(address, balance=balance, profile=profile)
+
+async def reply_wallet_details(message, text: str) -> bool:
+    """Answer a /check_wallet request for one or more addresses; returns False if none were found."""
+    addresses, extra = parse_wallet_addresses(text)
+    if not addresses:
+        return False
+    if len(addresses) == 1 and not extra:
+        await message.reply_text(await lookup_wallet_details(addresses[0]), parse_mode='HTML', disable_web_page_preview=True)
+        return True
+    total = len(addresses)
+    notice = f"⚠️ Only the first {WALLET_CHECK_MAX} addresses are checked." if extra else ''
+    placeholder = f"🔎 Checking {total} wallet addresses…" + (f"\n{notice}" if notice else '')
+    first = await message.reply_text(placeholder, disable_web_page_preview=True)
+    # [message, rendered results, text last sent]
+    pages = [[first, [], placeholder]]
+    progress = {'done': 0, 'finished': False}
+    dirty = asyncio.Event()
+    sem = asyncio.Semaphore(max(1, WALLET_LOOKUP_CONCURRENCY))
+
+    def page_text(index: int) -> str:
+        blocks = pages[index][1]
+        if not blocks:
+            return pages[index][2]
+        parts = [_WALLET_RESULT_SEPARATOR.join(blocks)]
+        if index == 0 and notice:
+            parts.insert(0, notice)
+        if index == len(pages) - 1 and not progress['finished']:
+            parts.append(f"⏳ {progress['done']}/{total} checked…")
+        return "\n\n".join(parts)
+
+    async def editor():
+        # Sole writer of edits, so a page is never edited concurrently
+        while True:
+            await dirty.wait()
+            dirty.clear()
+            finished = progress['finished']
+            for index in range(len(pages)):
+                text = page_text(index)
+                if text != pages[index][2]:
+                    try:
+                        await pages[index][0].edit_text(text, parse_mode='HTML', disable_web_page_preview=True)
+                        pages[index][2] = text
+                    except Exception as e:
+                        logger.debug(f"check_wallet progress edit failed: {str(e)}")
+            if finished:
+                return
+            await asyncio.sleep(WALLET_EDIT_INTERVAL)
+
+    async def one(addr):
+        async with sem:
+            try:
+                return await lookup_wallet_details(addr)
+            except Exception as e:
+                logger.warning(f"wallet lookup failed for {addr}: {str(e)}")
+                return f"📎 <b>{html.escape(addr)}</b>\n❌ Lookup failed, please try again later."
+
+    editor_task = asyncio.create_task(editor())
+    try:
+        for fut in asyncio.as_completed([one(a) for a in addresses]):
+            block = await fut
+            progress['done'] += 1
+            current = pages[-1][1]
+            # Room for the progress footer and the overflow notice
+            if current and len(_WALLET_RESULT_SEPARATOR.join(current + [block])) + 200 > TELEGRAM_TEXT_LIMIT:
+                more = await message.reply_text(f"🔎 Checking {total - progress['done'] + 1} more…", disable_web_page_preview=True)
+                pages.append([more, [], more.text])
+            pages[-1][1].append(block)
+            dirty.set()
+    finally:
+        progress['finished'] = True
+        dirty.set()
+        try:
+            await editor_task
+        except Exception:
+            pass
+    return True
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.debug(f"Entering start for user {update.effective_user.id}")
     user_name = update.effective_user.first_name
@@ -1103,7 +3834,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     is_group = update.message.chat.type in ['group', 'supergroup']
     # Opportunistically capture profile and upload avatar in the background
     try:
-        asyncio.create_task(capture_and_cache_tg_profile(update, context))
+        avatar_jobs.submit(update, context)
     except Exception:
         pass
     # Allow /start always; but if Telegram fires a second plain /start right
@@ -1436,10 +4167,11 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                base = os.getenv("STATE_BASE_URL", "").strip() or "https://xrextgbot.vercel.app"
-                url = base.rstrip('/') + f"/api/state?session={sess}"
-                await client.put(url, headers={"Content-Type": "application/json", "X-Client-Stage": "7"}, json={"stage": 7})
+            client = get_http_client('state')
+            base = os.getenv("STATE_BASE_URL", "").strip() or "https://xrextgbot.vercel.app"
+            url = base.rstrip('/') + f"/api/state?session={sess}"
+            await client.put(url, headers={"Content-Type": "application/json", "X-Client-Stage": "7"}, json={"stage": 7})
+            invalidate_link_cache(user_id)
             await context.bot.send_message(chat_id=query.message.chat_id, text="Unlinked successfully.")
             try:
                 await set_commands_unlinked(context.bot, query.message.chat_id)
@@ -2022,12 +4754,12 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # Handle awaiting wallet address for /check_wallet
         if state.get('awaiting_wallet_address'):
-            addr = update.message.text.strip()
             # Clear flag
             state['awaiting_wallet_address'] = False
             user_state[user_id] = state
-            # Render response
-            await update.message.reply_text(render_wallet_details(addr), parse_mode='HTML', disable_web_page_preview=True)
+            # Render response (one or more comma-separated addresses)
+            if not await reply_wallet_details(update.message, update.message.text):
+                await update.message.reply_text("🔎 Please provide wallet address.")
             return
 
         # Normal OTC flow handling
@@ -2114,8 +4846,8 @@ async def check_wallet_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     # Parse argument after /check_wallet
     args = context.args if hasattr(context, 'args') else []
-    addr = (args[0].strip() if args and isinstance(args[0], str) else '')
-    if not addr:
+    addr_text = ' '.join(a for a in (args or []) if isinstance(a, str)).strip()
+    if not parse_wallet_addresses(addr_text)[0]:
         msg = (
             "🔎 Please provide wallet address.\n\n"
             "Supported blockchains:\n"
@@ -2135,7 +4867,7 @@ async def check_wallet_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         st['awaiting_wallet_address'] = True
         user_state[update.effective_user.id] = st
         return
-    await update.message.reply_text(render_wallet_details(addr), parse_mode='HTML', disable_web_page_preview=True)
+    await reply_wallet_details(update.message, addr_text)
 
 async def otc_quote_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Guard linking in progress
@@ -2162,68 +4894,166 @@ async def otc_quote_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     await update.message.reply_text("Coming soon!")
 
-async def main():
+# One record per update with its shape only (kind, command, lengths): never the message text,
+# which can hold 2FA digits, linking codes or wallet addresses
+UPDATE_LOG_SPLIT_RE = re.compile(r'[\s,;]+')
+UPDATE_LOG_CALLBACK_RE = re.compile(r'^[A-Za-z_]{1,40}$')
+
+def describe_update(update: Update) -> dict:
+    query = update.callback_query
+    if query is not None:
+        data = str(query.data or '')
+        return {'kind': 'callback', 'data': data if UPDATE_LOG_CALLBACK_RE.match(data) else 'other'}
+    message = update.effective_message
+    if message is None:
+        return {'kind': 'other'}
+    if getattr(message, 'web_app_data', None):
+        return {'kind': 'web_app_data'}
+    text = (message.text or '').strip()
+    if text.startswith('/'):
+        command, _, rest = text.partition(' ')
+        command = command[1:].split('@', 1)[0][:32]
+        rest = rest.strip()
+        if command == 'start' and rest:
+            prefix, sep, sid = rest.partition('_s')
+            fields = {'kind': 'deeplink', 'prefix': prefix[:12]}
+            if sep and SESSION_ID_RE.match(sid):
+                fields['session'] = sid
+            return fields
+        if command == 'start':
+            return {'kind': 'start'}
+        if command == 'check_wallet':
+            return {'kind': 'check_wallet', 'count': len([a for a in UPDATE_LOG_SPLIT_RE.split(rest) if a])}
+        return {'kind': 'command', 'command': command}
+    return {'kind': 'digits' if text.isdigit() else 'text', 'length': len(text)}
+
+async def log_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not updates_logger.isEnabledFor(logging.INFO):
+        return
+    try:
+        fields = describe_update(update)
+        updates_logger.info(
+            f"update {update.update_id}: {fields['kind']}",
+            extra=dict(fields, update_id=update.update_id, user_id=update.effective_user.id if update.effective_user else None),
+        )
+    except Exception:
+        pass
+
+def register_handlers(application):
+    """Register the bot's update handlers: the update log first, then web app data, commands/callbacks/text."""
+    application.add_handler(TypeHandler(Update, log_update), group=-1)
+    application.add_handler(MessageHandler(filters.StatusUpdate.WEB_APP_DATA, timed_handler('message', 'web_app_data', handle_web_app_data)), group=0)
+    application.add_handler(CommandHandler("start", timed_handler('command', 'start', start)), group=1)
+    application.add_handler(CommandHandler("link_account", timed_handler('command', 'link_account', link_account_cmd)), group=1)
+    application.add_handler(CommandHandler("help", timed_handler('command', 'help', help_cmd)), group=1)
+    application.add_handler(CommandHandler("check_wallet", timed_handler('command', 'check_wallet', check_wallet_cmd)), group=1)
+    # application.add_handler(CommandHandler("otc_quote", timed_handler('command', 'otc_quote', otc_quote_cmd)), group=1)
+    application.add_handler(CommandHandler("unlink_account", timed_handler('command', 'unlink_account', unlink_cmd)), group=1)
+    application.add_handler(CallbackQueryHandler(timed_handler('callback', None, handle_callback)), group=2)
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler('message', 'text', handle_text)), group=3)
+
+def build_application(token: str = None, base_url: str = None, base_file_url: str = None):
+    """The bot's Application (outbound scheduler as rate limiter, handlers registered).
+
+    base_url/base_file_url point the Bot API at a stand-in (tools/replay_bench.py).
+    """
+    global outbound_scheduler
+    outbound_scheduler = OutboundScheduler(
+        global_rate=float(os.getenv('BOT_GLOBAL_RATE', '30')),
+        chat_rate=float(os.getenv('BOT_CHAT_RATE', '1')),
+        chat_burst=float(os.getenv('BOT_CHAT_BURST', '3')),
+        max_retries=int(os.getenv('BOT_MAX_RETRIES', '3')),
+    )
+    builder = ApplicationBuilder().token(token or BOT_TOKEN).rate_limiter(outbound_scheduler)
+    if base_url:
+        builder = builder.base_url(base_url)
+    if base_file_url:
+        builder = builder.base_file_url(base_file_url)
+    application = builder.build()
+    register_handlers(application)
+    return application
+
+async def main(mode: str = 'polling'):
     application = None
     runner = None
+    housekeeping_task = None
+    resync_task = None
+    lag_task = None
     try:
-        logger.info("Starting bot...")
-        application = ApplicationBuilder().token(BOT_TOKEN).build()
+        logger.info(f"Starting bot ({mode} mode)...")
+        if _pycryptodome_keccak is None:
+            logger.warning("pycryptodome not installed: EIP-55 checksums use the pure-Python Keccak-256 "
+                           "(~250 us per mixed-case ETH address, ~10x other formats); pip install pycryptodome")
+        if mode == 'webhook' and not (os.getenv('WEBHOOK_URL', '').strip() and os.getenv('WEBHOOK_SECRET', '').strip()):
+            raise RuntimeError("webhook mode requires WEBHOOK_URL and WEBHOOK_SECRET")
+        application = build_application()
         await application.initialize()
-        await check_webhook(application.bot)
+        if mode == 'polling':
+            await check_webhook(application.bot)
+        open_http_clients()
         # Set global bot reference
         global bot_for_notifications
         bot_for_notifications = application.bot
 
-        # Start local sync HTTP server (127.0.0.1:8787) if aiohttp is available
+        # Optional durable state (SQLite WAL): rehydrate before handlers start
+        db_path = os.getenv('STATE_DB_PATH', '').strip()
+        if db_path:
+            try:
+                await rehydrate_state(StatePersistence(db_path, flush_interval=float(os.getenv('STATE_DB_FLUSH_INTERVAL', '0.5'))))
+            except Exception as e:
+                logger.error(f"Failed to load persisted state from {db_path}: {str(e)}")
+
+        # Start local sync HTTP server (127.0.0.1:8787 by default) if aiohttp is available.
+        # Bind SYNC_SERVER_HOST=0.0.0.0 so api/state.js (/xrex/events) and Telegram (webhook) can reach it.
         try:
-            app = await make_sync_app()
+            app = await make_sync_app(application if mode == 'webhook' else None)
             if app is not None:
                 runner = web.AppRunner(app)
                 await runner.setup()
-                site = web.TCPSite(runner, '127.0.0.1', 8787)
+                sync_host = os.getenv('SYNC_SERVER_HOST', '127.0.0.1').strip() or '127.0.0.1'
+                sync_port = int(os.getenv('SYNC_SERVER_PORT', '') or os.getenv('PORT', '') or 8787)
+                site = web.TCPSite(runner, sync_host, sync_port)
                 await site.start()
-                logger.info("Local sync server running at http://127.0.0.1:8787/xrex/state")
+                logger.info(f"Local sync server running at http://{sync_host}:{sync_port}/xrex/state (events: {'on' if state_events_enabled() else 'off'})")
+                if state_events_enabled() and sync_host in ('127.0.0.1', 'localhost', '::1'):
+                    logger.warning("STATE_EVENT_TOKEN is set but the sync server only listens on loopback; "
+                                   "api/state.js cannot deliver /xrex/events, sessions keep the polling cadence")
             else:
                 logger.warning("aiohttp not installed; local sync server disabled")
         except Exception as e:
             logger.error(f"Failed to start local sync server: {str(e)}")
-        
-        # Register handlers in correct order: web app data first, then others, debug last
-        application.add_handler(MessageHandler(filters.StatusUpdate.WEB_APP_DATA, handle_web_app_data), group=0)
-        application.add_handler(CommandHandler("start", start), group=1)
-        application.add_handler(CommandHandler("link_account", link_account_cmd), group=1)
-        application.add_handler(CommandHandler("help", help_cmd), group=1)
-        application.add_handler(CommandHandler("check_wallet", check_wallet_cmd), group=1)
-        # application.add_handler(CommandHandler("otc_quote", otc_quote_cmd), group=1)
-        application.add_handler(CommandHandler("unlink_account", unlink_cmd), group=1)
-        application.add_handler(CallbackQueryHandler(handle_callback), group=2)
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text), group=3)
-        
-        # Add debug handler to catch ALL messages for logging only
-        async def debug_all_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
-            logger.info(f"=== DEBUG: Received update type: {type(update.message).__name__ if update.message else 'No message'}")
-            if update.message:
-                logger.info(f"=== DEBUG: Message content_type: {getattr(update.message, 'content_type', 'Unknown')}")
-                logger.info(f"=== DEBUG: Message text: {getattr(update.message, 'text', 'No text')}")
-                logger.info(f"=== DEBUG: Has web_app_data: {hasattr(update.message, 'web_app_data') and update.message.web_app_data}")
-                if hasattr(update.message, 'web_app_data') and update.message.web_app_data:
-                    logger.info(f"=== DEBUG: Web app data: {update.message.web_app_data.data}")
-
-        application.add_handler(MessageHandler(filters.ALL, debug_all_updates), group=4)
-
-        logger.info("Bot handlers registered, starting polling...")
+            if mode == 'webhook':
+                raise
+
+        logger.info(f"Bot handlers registered, starting {mode}...")
         await application.start()  # Start the application explicitly
+        housekeeping_task = asyncio.create_task(user_state_housekeeping())
+        resync_task = asyncio.create_task(resync_chat_commands(application.bot))
+        lag_task = asyncio.create_task(monitor_event_loop_lag(float(os.getenv('EVENT_LOOP_LAG_INTERVAL', '0.5'))))
+        avatar_jobs.start()
         # Optionally start polling remote state for a demo session if provided via env
         try:
             demo_session = os.getenv('DEMO_SESSION_ID', '').strip() or None
             if demo_session:
-                asyncio.create_task(poll_remote_and_sync(session_id=demo_session))
+                watch_session(demo_session)
         except Exception:
             pass
-        await application.updater.start_polling(
-            allowed_updates=["message", "callback_query"],
-            drop_pending_updates=True
-        )
+        if mode == 'webhook':
+            webhook_url = os.getenv('WEBHOOK_URL', '').strip().rstrip('/') + WEBHOOK_PATH
+            await application.bot.set_webhook(
+                url=webhook_url,
+                secret_token=os.getenv('WEBHOOK_SECRET', '').strip(),
+                allowed_updates=ALLOWED_UPDATES,
+                max_connections=int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40')),
+                drop_pending_updates=True
+            )
+            logger.info(f"Webhook set: {webhook_url}")
+        else:
+            await application.updater.start_polling(
+                allowed_updates=ALLOWED_UPDATES,
+                drop_pending_updates=True
+            )
+        logger.info(f"Bot ready {(time.perf_counter() - PROCESS_START) * 1000:.0f} ms after process start")
         # Keep the application running
         await asyncio.Event().wait()  # Wait indefinitely
     except Exception as e:
@@ -2233,21 +5063,41 @@ async def main():
         if application:
             logger.info("Shutting down application...")
             try:
-                await application.updater.stop()
+                if application.updater and application.updater.running:
+                    await application.updater.stop()
                 await application.stop()
                 await application.shutdown()
                 logger.info("Application shut down successfully.")
             except Exception as shutdown_e:
                 logger.error(f"Error during shutdown: {str(shutdown_e)}")
+        if session_poller_task and not session_poller_task.done():
+            session_poller_task.cancel()
+        if housekeeping_task and not housekeeping_task.done():
+            housekeeping_task.cancel()
+        if resync_task and not resync_task.done():
+            resync_task.cancel()
+        if lag_task and not lag_task.done():
+            lag_task.cancel()
+        await avatar_jobs.stop()
+        shutdown_avatar_pool()
+        if state_store is not None:
+            await state_store.close()
         if runner:
             try:
                 await runner.cleanup()
             except Exception:
                 pass
+        await close_http_clients()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="XREX Pay Telegram bot")
+    parser.add_argument('--mode', choices=('polling', 'webhook'), default=os.getenv('BOT_MODE', 'polling'),
+                        help="polling: getUpdates long-polling; webhook: Telegram POSTs to the sync server")
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        asyncio.run(main(mode=parse_args().mode))
     except KeyboardInterrupt:
         logger.info("Bot stopped by user (KeyboardInterrupt).")
     except Exception as e:
@@ -0,0 +1,59 @@
+import asyncio
+import copy
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import otc_bot  # noqa: E402
+
+
+class RecordingBot:
+    """Stands in for bot_for_notifications; records every Bot API method called on it."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, method):
+        async def call(*args, **kwargs):
+            self.calls.append(method)
+            return True
+        return call
+
+
+def new_watch():
+    return {
+        'last_seen': 0,
+        'last_fingerprint': None,
+        'poll_until_ts': 0,
+        'prev_stage': None,
+        'stage5_seen_ts': 0,
+        'forced_finalize_done': False,
+        'last_stage_for_delay': 0,
+        'next_poll_ts': 0.0,
+        'changed_at': 0,
+        'terminal_at': 0,
+    }
+
+
+def test_missing_row_is_ignored_for_linked_session(monkeypatch):
+    uid, chat_id, sid = 424242, 424242, 'S2'
+    bot = RecordingBot()
+    monkeypatch.setattr(otc_bot, 'bot_for_notifications', bot)
+    otc_bot.user_state[uid] = {'chat_id': chat_id, 'session_id': sid, 'stage6_notified': True}
+    otc_bot.set_sync_state(stage=6, twofa_verified=True, linking_code='NDG341F')
+    sync_before = dict(otc_bot.sync_state)
+    user_before = otc_bot.user_state.peek(uid).to_dict()
+    watch = new_watch()
+    watch_before = copy.deepcopy(watch)
+    try:
+        assert otc_bot.user_state.user_for_session(sid) == uid
+        # What fetch_session_states returns for a watched session that has no row
+        asyncio.run(otc_bot.process_session_record(sid, {}, watch))
+        asyncio.run(otc_bot.process_session_record(sid, {'stage': 1}, watch))
+        assert bot.calls == []
+        assert watch == watch_before
+        assert otc_bot.user_state.peek(uid).to_dict() == user_before
+        assert otc_bot.sync_state == sync_before
+    finally:
+        otc_bot.user_state.pop(uid, None)
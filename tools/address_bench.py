@@ -0,0 +1,131 @@
+"""Micro-benchmark and self-check for otc_bot.classify_address / classify_addresses.
+
+Generates random valid BTC (P2PKH, P2SH, P2WPKH, P2WSH, P2TR), TRON and Ethereum (lower-case and
+EIP-55 checksummed) addresses plus corrupted copies, checks every verdict, and reports the
+per-address cost of each format and of the batch API. classify_address is lru_cached, so the
+cache is cleared before every timed pass: the figures are uncached validation cost.
+
+Example:
+    python tools/address_bench.py --count 20000
+"""
+import argparse
+import hashlib
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logging  # noqa: E402
+import otc_bot  # noqa: E402
+
+logging.disable(logging.WARNING)
+
+B58 = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+BECH32 = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+
+
+def b58check(version: int, payload: bytes) -> str:
+    raw = bytes([version]) + payload
+    raw += hashlib.sha256(hashlib.sha256(raw).digest()).digest()[:4]
+    num = int.from_bytes(raw, 'big')
+    out = ''
+    while num:
+        num, rem = divmod(num, 58)
+        out = B58[rem] + out
+    return '1' * (len(raw) - len(raw.lstrip(b'\x00'))) + out
+
+
+def segwit(version: int, program: bytes) -> str:
+    data = [version]
+    acc = bits = 0
+    for byte in program:
+        acc = (acc << 8) | byte
+        bits += 8
+        while bits >= 5:
+            bits -= 5
+            data.append((acc >> bits) & 31)
+    if bits:
+        data.append((acc << (5 - bits)) & 31)
+    const = 1 if version == 0 else 0x2bc830a3
+    hrp = 'bc'
+    values = [ord(c) >> 5 for c in hrp] + [0] + [ord(c) & 31 for c in hrp] + data
+    polymod = otc_bot._bech32_polymod(values + [0] * 6) ^ const
+    checksum = [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+    return hrp + '1' + ''.join(BECH32[d] for d in data + checksum)
+
+
+def generators():
+    return {
+        'btc_p2pkh': lambda: b58check(0x00, os.urandom(20)),
+        'btc_p2sh': lambda: b58check(0x05, os.urandom(20)),
+        'btc_p2wpkh': lambda: segwit(0, os.urandom(20)),
+        'btc_p2wsh': lambda: segwit(0, os.urandom(32)),
+        'btc_p2tr': lambda: segwit(1, os.urandom(32)),
+        'tron': lambda: b58check(0x41, os.urandom(20)),
+        'eth_lower': lambda: '0x' + os.urandom(20).hex(),
+        'eth_eip55': lambda: otc_bot.eip55_checksum('0x' + os.urandom(20).hex()),
+    }
+
+
+def corrupt(address: str) -> str:
+    # Swap one character for another from the same alphabet, so only the checksum can catch it
+    alphabet = '0123456789abcdef' if address.startswith('0x') else (BECH32 if address.startswith('bc1') else B58)
+    i = random.randrange(4 if not address.startswith('0x') else 2, len(address))
+    ch = address[i]
+    repl = random.choice([c for c in alphabet if c != ch.lower() and c != ch])
+    if address.startswith('0x') and ch.isupper():
+        repl = repl.upper()
+    return address[:i] + repl + address[i + 1:]
+
+
+def bench(fn, items):
+    # Earlier passes over the same addresses would otherwise be timed as cache hits
+    otc_bot.classify_address.cache_clear()
+    t0 = time.perf_counter()
+    fn(items)
+    return (time.perf_counter() - t0) / max(1, len(items)) * 1e6
+
+
+def bench_cached(items):
+    t0 = time.perf_counter()
+    otc_bot.classify_addresses(items)
+    return (time.perf_counter() - t0) / max(1, len(items)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=5000, help="addresses generated per format")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    if otc_bot._pycryptodome_keccak:
+        print("keccak backend: pycryptodome")
+    else:
+        print("keccak backend: pure python (pycryptodome not installed): eth_eip55 pays for a pure-Python "
+              "Keccak-256 per address, roughly 10x the other formats")
+    print(f"{'format':<12} {'valid us':>9} {'corrupt us':>11} {'rejected':>9}   (uncached)")
+    everything = []
+    for name, gen in generators().items():
+        valid = [gen() for _ in range(args.count)]
+        broken = [corrupt(a) for a in valid]
+        wrong = [a for a in valid if not otc_bot.classify_address(a).valid]
+        if wrong:
+            raise SystemExit(f"{name}: {len(wrong)} valid addresses rejected, e.g. {wrong[0]}")
+        # eth_lower corruptions are still well-formed lower-case hex: nothing to detect
+        rejected = sum(1 for a in broken if not otc_bot.classify_address(a).valid)
+        us_valid = bench(lambda xs: [otc_bot.classify_address(a) for a in xs], valid)
+        us_broken = bench(lambda xs: [otc_bot.classify_address(a) for a in xs], broken)
+        print(f"{name:<12} {us_valid:>9.1f} {us_broken:>11.1f} {rejected / len(broken):>8.1%}")
+        everything.extend(valid)
+        everything.extend(broken)
+    random.shuffle(everything)
+    print(f"batch classify_addresses over {len(everything)} mixed addresses: {bench(otc_bot.classify_addresses, everything):.1f} us/address (uncached)")
+    otc_bot.classify_address.cache_clear()
+    otc_bot.classify_addresses(everything[:8192])
+    print(f"cached repeat of {min(8192, len(everything))} addresses: {bench_cached(everything[:8192]):.2f} us/address")
+
+
+if __name__ == '__main__':
+    main()
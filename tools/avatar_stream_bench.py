@@ -0,0 +1,143 @@
+"""Measure peak memory of the avatar transfer path against local stand-ins for Telegram and Supabase.
+
+Serves generated JPEGs as a fake Bot API file endpoint and accepts uploads as a fake Supabase
+storage bucket, then runs each avatar job in a fresh subprocess so peak figures are not shared:
+
+    buffered  old path: download into memory, then upload_avatar_to_supabase(bytes)
+    streamed  stream_avatar_to_supabase: download hashed into a bounded spool, then uploaded in chunks
+
+Reports traced Python allocation peak and max RSS growth per job.
+
+Example:
+    python tools/avatar_stream_bench.py --sizes 640,1280,2560,4096
+    AVATAR_THUMB_SIZES= python tools/avatar_stream_bench.py   # without the thumbnail pass
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_jpeg(side: int) -> bytes:
+    from PIL import Image
+    # Noise compresses badly, so the file grows with the pixel count like a real large photo
+    img = Image.frombytes('RGB', (side, side), os.urandom(side * side * 3))
+    bio = BytesIO()
+    img.save(bio, format='JPEG', quality=92)
+    return bio.getvalue()
+
+
+async def run_worker(args):
+    sys.path.insert(0, ROOT)
+    import logging
+    import otc_bot
+    logging.disable(logging.WARNING)
+    # Client and pool setup are one-off costs, keep them out of the per-job figures
+    otc_bot.open_http_clients()
+    await asyncio.get_running_loop().run_in_executor(otc_bot.get_avatar_pool(), otc_bot.render_avatar, make_jpeg(64), 'jpg', (32,), False)
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tg_file = SimpleNamespace(file_path=args.file_url, file_size=args.file_size)
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    if args.worker == 'buffered':
+        resp = await otc_bot.get_http_client('telegram').get(args.file_url)
+        bio = BytesIO(resp.content)
+        data = bio.getvalue()
+        digest = hashlib.sha256(data).hexdigest()
+        url = await otc_bot.upload_avatar_to_supabase(data, args.file_url, 1, content_key=digest[:32])
+    else:
+        url, digest, _ = await otc_bot.stream_avatar_to_supabase(tg_file, 1, 'bench')
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    await otc_bot.close_http_clients()
+    otc_bot.shutdown_avatar_pool()
+    print(json.dumps({
+        'ok': bool(url),
+        'sha256': digest,
+        'ms': round(elapsed * 1000, 1),
+        'py_peak_kb': peak // 1024,
+        'rss_growth_kb': max(0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline_rss),
+    }))
+
+
+async def run(args):
+    from aiohttp import web
+    files = {}
+    received = {}
+
+    async def get_file(request):
+        body = files[request.match_info['name']]
+        resp = web.StreamResponse(headers={'Content-Length': str(len(body)), 'Content-Type': 'image/jpeg'})
+        await resp.prepare(request)
+        view = memoryview(body)
+        for i in range(0, len(view), 64 * 1024):
+            await resp.write(view[i:i + 64 * 1024])
+        await resp.write_eof()
+        return resp
+
+    async def put_object(request):
+        hasher = hashlib.sha256()
+        size = 0
+        async for chunk in request.content.iter_chunked(64 * 1024):
+            hasher.update(chunk)
+            size += len(chunk)
+        received[request.match_info['key']] = (size, hasher.hexdigest())
+        return web.json_response({'Key': request.match_info['key']})
+
+    app = web.Application(client_max_size=1024 ** 3)
+    app.router.add_get('/file/{name}', get_file)
+    app.router.add_put('/storage/v1/object/{bucket}/{key:.*}', put_object)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', args.port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    base = f"http://127.0.0.1:{port}"
+    env = dict(os.environ, SUPABASE_URL=base, SUPABASE_SERVICE_ROLE_KEY='bench')
+
+    print(f"{'side':>6} {'file KB':>8} {'mode':>9} {'ms':>8} {'py peak KB':>11} {'RSS +KB':>9}  upload")
+    try:
+        for side in [int(x) for x in args.sizes.split(',') if x.strip()]:
+            name = f"photo_{side}.jpg"
+            files[name] = make_jpeg(side)
+            expected = hashlib.sha256(files[name]).hexdigest()
+            for mode in ('buffered', 'streamed'):
+                received.clear()
+                proc = await asyncio.create_subprocess_exec(
+                    sys.executable, os.path.abspath(__file__), '--worker', mode,
+                    '--file-url', f"{base}/file/{name}", '--file-size', str(len(files[name])),
+                    env=env, stdout=asyncio.subprocess.PIPE,
+                )
+                out, _ = await proc.communicate()
+                res = json.loads(out.decode().strip().splitlines()[-1])
+                full = [v for k, v in received.items() if k.endswith('.jpg') and not k.rsplit('/', 1)[-1].split('.')[0].endswith(('_64', '_160', '_320'))]
+                intact = bool(full) and full[0] == (len(files[name]), expected) and res['sha256'] == expected
+                print(f"{side:>6} {len(files[name]) // 1024:>8} {mode:>9} {res['ms']:>8} {res['py_peak_kb']:>11} {res['rss_growth_kb']:>9}  "
+                      f"{'ok' if res['ok'] and intact else 'FAILED'} ({len(received)} objects)")
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='640,1280,2560', help="comma-separated square image sides in pixels")
+    parser.add_argument('--port', type=int, default=0, help="stand-in server port (0 = any free port)")
+    parser.add_argument('--worker', choices=('buffered', 'streamed'), help=argparse.SUPPRESS)
+    parser.add_argument('--file-url', help=argparse.SUPPRESS)
+    parser.add_argument('--file-size', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    asyncio.run(run_worker(args) if args.worker else run(args))
+
+
+if __name__ == '__main__':
+    main()
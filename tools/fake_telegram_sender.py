@@ -0,0 +1,86 @@
+"""Local stand-in for Telegram's webhook delivery: POST synthetic updates to the bot's webhook route.
+
+Measures ingest throughput and acknowledge latency of `otc_bot.py --mode webhook`.
+
+Example:
+    WEBHOOK_SECRET=dev python tools/fake_telegram_sender.py --updates 2000 --concurrency 40
+"""
+import argparse
+import asyncio
+import os
+import time
+
+import httpx
+
+COMMANDS = ['/start', '/help', '/check_wallet', '/link_account']
+
+
+def make_update(update_id: int, users: int) -> dict:
+    uid = 100000 + (update_id % max(1, users))
+    text = COMMANDS[update_id % len(COMMANDS)]
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': uid, 'type': 'private'},
+            'from': {'id': uid, 'is_bot': False, 'first_name': 'Load'},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}],
+        },
+    }
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100.0))]
+
+
+async def run(args):
+    headers = {'X-Telegram-Bot-Api-Secret-Token': args.secret}
+    queue = asyncio.Queue()
+    for i in range(1, args.updates + 1):
+        queue.put_nowait(i)
+    latencies = []
+    errors = 0
+
+    async def worker(client):
+        nonlocal errors
+        while True:
+            try:
+                i = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            t0 = time.perf_counter()
+            try:
+                resp = await client.post(args.url, json=make_update(i, args.users), headers=headers)
+                if resp.status_code != 200:
+                    errors += 1
+            except Exception:
+                errors += 1
+            latencies.append((time.perf_counter() - t0) * 1000.0)
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(timeout=10.0, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+    latencies.sort()
+    print(f"updates={args.updates} concurrency={args.concurrency} errors={errors}")
+    print(f"throughput={args.updates / elapsed:.0f} updates/s  ack p50={percentile(latencies, 50):.2f}ms "
+          f"p99={percentile(latencies, 99):.2f}ms max={latencies[-1] if latencies else 0:.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default=os.getenv('FAKE_WEBHOOK_URL', 'http://127.0.0.1:8787/telegram/webhook'))
+    parser.add_argument('--secret', default=os.getenv('WEBHOOK_SECRET', ''))
+    parser.add_argument('--updates', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--users', type=int, default=200, help='distinct synthetic user ids')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
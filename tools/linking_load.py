@@ -0,0 +1,187 @@
+"""Concurrent BOTC linking-flow load generator: stage-6 notification latency, duplicates and misses.
+
+Drives --users virtual users through the whole linking lifecycle against the in-process
+stand-ins (tools/standins.py) and the bot's real Application:
+
+    1. /start BOTC158_s<session>        bot pushes stage 3 and starts watching the session
+    2. 2FA digits (handle_text)         bot pushes stage 4
+    3. the website (simulated here)     moves the session to 5, then 6 after --finalize-delay
+    4. the bot's pollers                poll_remote_and_sync / watch_finalize_for_user (or, with
+                                        --events, pushed /xrex/events) send "Successfully linked"
+
+For every user it measures the time from the stage-6 write to the success message reaching
+the fake Bot API, and counts users notified more than once or not within --timeout.
+
+Example:
+    python tools/linking_load.py --users 200 --ramp 10
+    python tools/linking_load.py --users 200 --ramp 10 --events
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logging  # noqa: E402
+import httpx  # noqa: E402
+import otc_bot  # noqa: E402
+from aiohttp import web  # noqa: E402
+from replay_bench import USER_BASE, message_update, percentile  # noqa: E402
+from standins import StandIns, STATE_WRITE_TOKEN  # noqa: E402
+from telegram import Update  # noqa: E402
+
+logging.disable(logging.WARNING)
+
+SUCCESS_PREFIX = '🎉️ Successfully linked'
+EVENT_TOKEN = 'standin-event-token'
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    standins = await StandIns(bot_latency=args.bot_latency_ms / 1000.0, state_latency=args.state_latency_ms / 1000.0).start()
+    os.environ['STATE_BASE_URL'] = standins.state_base_url
+    os.environ['STATE_WRITE_TOKEN'] = STATE_WRITE_TOKEN
+    os.environ.setdefault('BOT_GLOBAL_RATE', '100000')
+    os.environ.setdefault('BOT_CHAT_RATE', '100000')
+    os.environ.setdefault('BOT_CHAT_BURST', '100000')
+    if args.watch_grace is not None:
+        otc_bot.SESSION_WATCH_TERMINAL_GRACE = args.watch_grace
+    sync_runner = None
+    if args.events:
+        os.environ['STATE_EVENT_TOKEN'] = EVENT_TOKEN
+        sync_runner = web.AppRunner(await otc_bot.make_sync_app(), access_log=None)
+        await sync_runner.setup()
+        await web.TCPSite(sync_runner, '127.0.0.1', 0).start()
+        events_url = f"http://127.0.0.1:{sync_runner.addresses[0][1]}/xrex/events"
+    application = otc_bot.build_application(token=standins.token, base_url=standins.bot_base_url)
+    await application.initialize()
+    await application.start()
+    otc_bot.open_http_clients()
+    otc_bot.bot_for_notifications = application.bot
+
+    stage6_at = {}
+    notified = defaultdict(list)
+    reached = defaultdict(asyncio.Event)
+    pushes = set()
+    push_client = httpx.AsyncClient(timeout=5.0)
+
+    def on_change(session_id, row, t):
+        stage = row.get('stage')
+        if stage == 6 and session_id not in stage6_at:
+            stage6_at[session_id] = t
+        reached[(session_id, stage)].set()
+        if args.events:
+            # What api/state.js notifyBot() does after every successful write
+            record = standins.state.body(row)
+            task = asyncio.ensure_future(push_client.post(events_url, json={'session_id': session_id, 'record': record},
+                                                          headers={'Authorization': f"Bearer {EVENT_TOKEN}"}))
+            pushes.add(task)
+            task.add_done_callback(pushes.discard)
+
+    def on_call(method, params, t):
+        if method == 'sendMessage' and str(params.get('text', '')).startswith(SUCCESS_PREFIX):
+            notified[int(params.get('chat_id') or 0)].append(t)
+
+    standins.state.changes.append(on_change)
+    standins.bot.listeners.append(on_call)
+
+    dispatch = asyncio.Semaphore(args.concurrency)
+    update_ids = iter(range(1, 10 ** 9))
+
+    async def send(uid, text):
+        async with dispatch:
+            await application.process_update(Update.de_json(message_update(next(update_ids), uid, text), application.bot))
+
+    async def user(i):
+        uid = USER_BASE + i
+        sid = f"load{args.seed}x{i}"
+        await asyncio.sleep(rng.uniform(0, args.ramp))
+        await send(uid, f"/start BOTC158_s{sid}")
+        await asyncio.sleep(args.think)
+        await send(uid, str(100000 + i))
+        # Website: the user enters the linking code, then the account is linked
+        try:
+            await asyncio.wait_for(reached[(sid, 4)].wait(), args.timeout)
+        except asyncio.TimeoutError:
+            return sid, uid, 'stuck before stage 4'
+        await asyncio.sleep(args.enter_delay * rng.uniform(0.5, 1.5))
+        standins.state.update(sid, {'stage': 5})
+        await asyncio.sleep(args.finalize_delay)
+        standins.state.update(sid, {'stage': 6})
+        deadline = time.perf_counter() + args.timeout
+        while not notified.get(uid) and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        return sid, uid, None
+
+    print(f"{args.users} users over {args.ramp:.0f}s ramp, dispatch concurrency {args.concurrency}, "
+          f"{'pushed events + ' if args.events else ''}polling, Bot API +{args.bot_latency_ms:.0f}ms, state API +{args.state_latency_ms:.0f}ms")
+    t0 = time.perf_counter()
+    results = await asyncio.gather(*(user(i) for i in range(args.users)))
+    # Keep watching for late duplicates
+    await asyncio.sleep(args.settle)
+    elapsed = time.perf_counter() - t0
+
+    latencies, missed, duplicates, stuck = [], [], [], []
+    for sid, uid, error in results:
+        if error:
+            stuck.append((uid, error))
+            continue
+        sends = notified.get(uid, [])
+        if not sends or sends[0] - stage6_at[sid] > args.timeout:
+            missed.append(uid)
+            continue
+        latencies.append(sends[0] - stage6_at[sid])
+        if len(sends) > 1:
+            duplicates.append((uid, len(sends)))
+    latencies.sort()
+    print(f"\nnotified {len(latencies)}/{args.users} in {elapsed:.1f}s; missed {len(missed)}, duplicated {len(duplicates)}, "
+          f"stuck before stage 4 {len(stuck)}")
+    if latencies:
+        print(f"stage 6 -> 'Successfully linked': p50 {percentile(latencies, 50) * 1000:.0f}ms  "
+              f"p90 {percentile(latencies, 90) * 1000:.0f}ms  p99 {percentile(latencies, 99) * 1000:.0f}ms  "
+              f"max {latencies[-1] * 1000:.0f}ms")
+    for uid, count in duplicates[:5]:
+        print(f"  duplicate: user {uid} notified {count} times")
+    print("state API calls: " + ', '.join(f"{m}={n} ({n / elapsed:.1f}/s)" for m, n in standins.state.calls.most_common()))
+    print("Bot API calls: " + ', '.join(f"{m}={n}" for m, n in standins.bot.calls.most_common()))
+    print(f"session watches: {otc_bot.session_watch_stats()}")
+
+    if otc_bot.session_poller_task and not otc_bot.session_poller_task.done():
+        otc_bot.session_poller_task.cancel()
+    for task in list(otc_bot.finalize_watch_tasks.values()):
+        task.cancel()
+    await application.stop()
+    await application.shutdown()
+    await push_client.aclose()
+    await otc_bot.close_http_clients()
+    if sync_runner is not None:
+        await sync_runner.cleanup()
+    await standins.stop()
+    return 1 if (missed or duplicates or stuck) else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50, help="virtual users, each with its own session")
+    parser.add_argument('--ramp', type=float, default=5.0, help="seconds over which users start")
+    parser.add_argument('--think', type=float, default=1.0, help="seconds between the deep link and the 2FA digits")
+    parser.add_argument('--enter-delay', type=float, default=2.0, help="mean seconds from stage 4 to the website's stage 5")
+    parser.add_argument('--finalize-delay', type=float, default=1.0, help="seconds from stage 5 to stage 6")
+    parser.add_argument('--concurrency', type=int, default=16, help="updates processed at once")
+    parser.add_argument('--events', action='store_true', help="also push every write to /xrex/events like api/state.js")
+    parser.add_argument('--timeout', type=float, default=30.0, help="seconds after stage 6 before a user counts as missed")
+    parser.add_argument('--settle', type=float, default=5.0, help="seconds to keep watching for duplicates")
+    parser.add_argument('--watch-grace', type=float, default=None,
+                        help="override SESSION_WATCH_TERMINAL_GRACE to see finished watches reaped within --settle")
+    parser.add_argument('--bot-latency-ms', type=float, default=30.0)
+    parser.add_argument('--state-latency-ms', type=float, default=20.0)
+    parser.add_argument('--seed', type=int, default=1)
+    sys.exit(asyncio.run(run(parser.parse_args())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+"""End-to-end replay benchmark: the real Application and handlers against in-process stand-ins.
+
+Builds the bot with otc_bot.build_application (the same handler registrations main() uses),
+points its Bot API at FakeBotApi and STATE_BASE_URL at FakeStateApi (tools/standins.py), then
+replays a synthetic stream of user scenarios arriving open-loop at --rate per second:
+
+    start     plain /start
+    deeplink  /start BOTC158_s<session>, then the 2FA digits after --think seconds
+    wallet    /check_wallet <address>
+    callback  an inline button press (how_to_use, what_is_2fa, more, customer_support)
+
+Updates are dispatched through Application.process_update by --concurrency workers; 1 matches
+production, where updates are processed one at a time. Reports updates/s, per-update-kind
+p50/p99 (service time and end-to-end including queueing) and outbound call counts.
+
+Example:
+    python tools/replay_bench.py --rate 20 --duration 15 --mix start=1,deeplink=2,wallet=2,callback=3
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logging  # noqa: E402
+import otc_bot  # noqa: E402
+from standins import StandIns, STATE_WRITE_TOKEN  # noqa: E402
+from telegram import Update  # noqa: E402
+
+logging.disable(logging.WARNING)
+
+CALLBACKS = ['how_to_use', 'what_is_2fa', 'more', 'customer_support']
+USER_BASE = 700000000
+
+
+def message_update(update_id: int, uid: int, text: str) -> dict:
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': uid, 'type': 'private'},
+        'from': {'id': uid, 'is_bot': False, 'first_name': 'Replay', 'username': f"replay{uid}"},
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split(' ', 1)[0])}]
+    return {'update_id': update_id, 'message': message}
+
+
+def callback_update(update_id: int, uid: int, data: str) -> dict:
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'chat_instance': str(uid),
+            'from': {'id': uid, 'is_bot': False, 'first_name': 'Replay'},
+            'data': data,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': uid, 'type': 'private'},
+                'from': {'id': 123456, 'is_bot': True, 'first_name': 'XREX Pay Bot'},
+                'text': 'menu',
+            },
+        },
+    }
+
+
+def parse_mix(spec: str) -> dict:
+    mix = {}
+    for item in spec.split(','):
+        name, _, weight = item.partition('=')
+        if name.strip():
+            mix[name.strip()] = float(weight or 1)
+    unknown = set(mix) - {'start', 'deeplink', 'wallet', 'callback'}
+    if unknown:
+        raise SystemExit(f"unknown scenario(s) in --mix: {', '.join(sorted(unknown))}")
+    return mix
+
+
+def build_schedule(args) -> list:
+    """[(offset_s, kind, update_dict)] for Poisson scenario arrivals over --duration seconds."""
+    rng = random.Random(args.seed)
+    mix = parse_mix(args.mix)
+    names, weights = list(mix), list(mix.values())
+    events = []
+    update_ids = iter(range(1, 10 ** 9))
+    t = 0.0
+    scenario = 0
+    while True:
+        t += rng.expovariate(args.rate)
+        if t >= args.duration:
+            break
+        scenario += 1
+        uid = USER_BASE + rng.randrange(args.users)
+        kind = rng.choices(names, weights)[0]
+        if kind == 'start':
+            events.append((t, 'start', message_update(next(update_ids), uid, '/start')))
+        elif kind == 'deeplink':
+            events.append((t, 'deeplink', message_update(next(update_ids), uid, f"/start BOTC158_sreplay{scenario}")))
+            events.append((t + args.think, 'twofa', message_update(next(update_ids), uid, str(rng.randrange(100000, 999999)))))
+        elif kind == 'wallet':
+            address = '0x' + rng.getrandbits(160).to_bytes(20, 'big').hex()
+            events.append((t, 'check_wallet', message_update(next(update_ids), uid, f"/check_wallet {address}")))
+        else:
+            data = rng.choice(CALLBACKS)
+            events.append((t, f"callback:{data}", callback_update(next(update_ids), uid, data)))
+    events.sort(key=lambda e: e[0])
+    return events
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100.0))]
+
+
+async def run(args):
+    standins = await StandIns(bot_latency=args.bot_latency_ms / 1000.0, state_latency=args.state_latency_ms / 1000.0).start()
+    os.environ['STATE_BASE_URL'] = standins.state_base_url
+    os.environ['STATE_WRITE_TOKEN'] = STATE_WRITE_TOKEN
+    if not args.production_limits:
+        # Measure the bot, not Telegram's flood limits
+        os.environ.setdefault('BOT_GLOBAL_RATE', '100000')
+        os.environ.setdefault('BOT_CHAT_RATE', '100000')
+        os.environ.setdefault('BOT_CHAT_BURST', '100000')
+    application = otc_bot.build_application(token=standins.token, base_url=standins.bot_base_url)
+    await application.initialize()
+    await application.start()
+    otc_bot.open_http_clients()
+    otc_bot.bot_for_notifications = application.bot
+    otc_bot.avatar_jobs.start()
+
+    schedule = build_schedule(args)
+    queue = asyncio.Queue()
+    samples = defaultdict(list)
+    failures = defaultdict(int)
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                queue.task_done()
+                return
+            arrival, kind, update = item
+            started = time.perf_counter()
+            try:
+                await application.process_update(update)
+            except Exception:
+                failures[kind] += 1
+            done = time.perf_counter()
+            samples[kind].append((done - started, done - arrival))
+            queue.task_done()
+
+    workers = [asyncio.create_task(worker()) for _ in range(args.concurrency)]
+    print(f"replaying {len(schedule)} updates over {args.duration:.0f}s (scenario rate {args.rate}/s, "
+          f"concurrency {args.concurrency}, Bot API +{args.bot_latency_ms:.0f}ms, state API +{args.state_latency_ms:.0f}ms)")
+    t0 = time.perf_counter()
+    for offset, kind, data in schedule:
+        delay = t0 + offset - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        queue.put_nowait((t0 + offset, kind, Update.de_json(data, application.bot)))
+    await queue.join()
+    elapsed = time.perf_counter() - t0
+    for _ in workers:
+        queue.put_nowait(None)
+    await asyncio.gather(*workers)
+    # Let background work (poller ticks, avatar jobs, progress edits) settle before counting calls
+    await asyncio.sleep(args.drain)
+
+    total = sum(len(v) for v in samples.values())
+    print(f"\n{total} updates in {elapsed:.1f}s: {total / elapsed:.1f} updates/s")
+    print(f"{'update kind':<26}{'n':>6}{'svc p50':>10}{'svc p99':>10}{'e2e p50':>10}{'e2e p99':>10}{'errors':>8}")
+    for kind in sorted(samples):
+        service = sorted(s for s, _ in samples[kind])
+        e2e = sorted(e for _, e in samples[kind])
+        print(f"{kind:<26}{len(service):>6}{percentile(service, 50) * 1000:>8.1f}ms{percentile(service, 99) * 1000:>8.1f}ms"
+              f"{percentile(e2e, 50) * 1000:>8.1f}ms{percentile(e2e, 99) * 1000:>8.1f}ms{failures[kind]:>8}")
+    print("\nBot API calls: " + ', '.join(f"{m}={n}" for m, n in standins.bot.calls.most_common()))
+    print("state API calls: " + ', '.join(f"{m}={n}" for m, n in standins.state.calls.most_common()))
+    print(f"outbound scheduler: {otc_bot.outbound_scheduler.stats()}")
+
+    await otc_bot.avatar_jobs.stop()
+    if otc_bot.session_poller_task and not otc_bot.session_poller_task.done():
+        otc_bot.session_poller_task.cancel()
+    await application.stop()
+    await application.shutdown()
+    await otc_bot.close_http_clients()
+    otc_bot.shutdown_avatar_pool()
+    await standins.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rate', type=float, default=20.0, help="scenario arrivals per second")
+    parser.add_argument('--duration', type=float, default=15.0, help="seconds of arrivals to generate")
+    parser.add_argument('--users', type=int, default=500, help="distinct synthetic user ids")
+    parser.add_argument('--mix', default='start=1,deeplink=2,wallet=2,callback=3', help="scenario weights")
+    parser.add_argument('--think', type=float, default=1.0, help="seconds between a deep link and its 2FA digits")
+    parser.add_argument('--concurrency', type=int, default=1, help="updates processed at once (1 = production)")
+    parser.add_argument('--bot-latency-ms', type=float, default=30.0, help="added latency per Bot API call")
+    parser.add_argument('--state-latency-ms', type=float, default=20.0, help="added latency per state API call")
+    parser.add_argument('--production-limits', action='store_true', help="keep BOT_GLOBAL_RATE/BOT_CHAT_RATE limits")
+    parser.add_argument('--drain', type=float, default=2.0, help="seconds to let background work finish")
+    parser.add_argument('--seed', type=int, default=1)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
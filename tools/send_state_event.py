@@ -0,0 +1,60 @@
+"""Local stand-in for api/state.js: push a session state event to the bot's /xrex/events route.
+
+Example:
+    STATE_EVENT_TOKEN=dev python tools/send_state_event.py --session abc123 --stage 6 --uid 42 --chat 42
+"""
+import argparse
+import os
+import time
+
+import httpx
+
+
+def build_record(args) -> dict:
+    now_iso = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    return {
+        'stage': int(args.stage),
+        'twofa_verified': int(args.stage) >= 4,
+        'linking_code': args.code,
+        'updated_at': int(time.time()),
+        'actor_tg_user_id': args.uid,
+        'actor_chat_id': args.chat,
+        'tg_username': None,
+        'tg_display_name': None,
+        'tg_photo_url': None,
+        'send_test_at': now_iso if args.test else None,
+        'send_abort_at': now_iso if args.abort else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default=os.getenv('BOT_EVENTS_URL', 'http://127.0.0.1:8787/xrex/events'))
+    parser.add_argument('--token', default=os.getenv('STATE_EVENT_TOKEN', ''))
+    parser.add_argument('--session', required=True)
+    parser.add_argument('--stage', type=int, required=True)
+    parser.add_argument('--uid', type=int, default=None)
+    parser.add_argument('--chat', type=int, default=None)
+    parser.add_argument('--code', default=None)
+    parser.add_argument('--test', action='store_true', help='set send_test_at')
+    parser.add_argument('--abort', action='store_true', help='set send_abort_at')
+    parser.add_argument('--repeat', type=int, default=1, help='send N events and report ack latency')
+    args = parser.parse_args()
+
+    headers = {'Authorization': f"Bearer {args.token}"}
+    latencies = []
+    with httpx.Client(timeout=5.0) as client:
+        for _ in range(max(1, args.repeat)):
+            body = {'session_id': args.session, 'record': build_record(args)}
+            t0 = time.perf_counter()
+            resp = client.post(args.url, json=body, headers=headers)
+            latencies.append((time.perf_counter() - t0) * 1000.0)
+            if resp.status_code != 200:
+                print(f"{resp.status_code} {resp.text}")
+                return
+    latencies.sort()
+    print(f"sent {len(latencies)} event(s); ack p50={latencies[len(latencies) // 2]:.2f}ms max={latencies[-1]:.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""In-process stand-ins for the Telegram Bot API and api/state.js, shared by the load tools.
+
+FakeBotApi answers /bot<token>/<method> with plausible results and records every call;
+FakeStateApi keeps session rows in memory and speaks the same GET/PUT contract as
+api/state.js (?session=, ?sessions=a,b,c, ?tg=). Both run on one aiohttp server:
+
+    standins = StandIns(bot_latency=0.03, state_latency=0.02)
+    await standins.start()
+    application = otc_bot.build_application(token=standins.token, base_url=standins.bot_base_url)
+    os.environ['STATE_BASE_URL'] = standins.state_base_url
+"""
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+
+from aiohttp import web
+
+STATE_WRITE_TOKEN = 'standin-write-token'
+BOT_TOKEN = '123456:STANDIN'
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'XREX Pay Bot', 'username': 'xrex_standin_bot'}
+# Columns api/state.js returns for a session (sessionBody)
+SESSION_FIELDS = ('stage', 'twofa_verified', 'linking_code', 'updated_at', 'actor_tg_user_id', 'actor_chat_id',
+                  'tg_username', 'tg_display_name', 'tg_photo_url', 'send_test_at', 'send_abort_at')
+
+
+class FakeBotApi:
+    """Records Bot API calls; `listeners` are called as fn(method, params, t) for every call."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = float(latency)
+        self.calls = Counter()
+        self.listeners = []
+        self._message_ids = itertools.count(1000)
+
+    @staticmethod
+    def _params(raw) -> dict:
+        # python-telegram-bot sends form fields whose non-string values are JSON-encoded
+        params = {}
+        for key, value in raw.items():
+            if isinstance(value, str) and key not in ('text', 'caption'):
+                try:
+                    value = json.loads(value)
+                except ValueError:
+                    pass
+            params[key] = value
+        return params
+
+    def _message(self, params: dict) -> dict:
+        chat_id = params.get('chat_id') or 0
+        return {
+            'message_id': params.get('message_id') or next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+            'text': params.get('text') or '',
+        }
+
+    def result(self, method: str, params: dict):
+        if method == 'getMe':
+            return BOT_USER
+        if method in ('sendMessage', 'editMessageText', 'editMessageReplyMarkup', 'sendPhoto', 'sendDocument', 'copyMessage'):
+            return self._message(params)
+        if method == 'getWebhookInfo':
+            return {'url': '', 'has_custom_certificate': False, 'pending_update_count': 0}
+        if method == 'getUserProfilePhotos':
+            return {'total_count': 0, 'photos': []}
+        if method == 'getChat':
+            return {'id': params.get('chat_id') or 0, 'type': 'private'}
+        if method == 'getUpdates':
+            return []
+        return True
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        raw = await request.post() if request.can_read_body else {}
+        params = self._params(raw)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        now = time.perf_counter()
+        self.calls[method] += 1
+        for listener in self.listeners:
+            listener(method, params, now)
+        return web.json_response({'ok': True, 'result': self.result(method, params)})
+
+
+class FakeStateApi:
+    """Session rows in memory behind GET/PUT /api/state; `changes` are called as fn(session_id, record, t)."""
+
+    def __init__(self, latency: float = 0.0, write_token: str = STATE_WRITE_TOKEN):
+        self.latency = float(latency)
+        self.write_token = write_token
+        self.sessions = {}
+        self.calls = Counter()
+        self.changes = []
+
+    @staticmethod
+    def body(row: dict) -> dict:
+        return {field: row.get(field) for field in SESSION_FIELDS}
+
+    def update(self, session_id: str, fields: dict) -> dict:
+        """Apply a write the way the website or the bot would; bumps updated_at."""
+        row = self.sessions.setdefault(session_id, {'stage': 1, 'twofa_verified': False})
+        row.update(fields)
+        row['updated_at'] = int(time.time())
+        now = time.perf_counter()
+        for listener in self.changes:
+            listener(session_id, row, now)
+        return row
+
+    async def handle(self, request):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        q = request.query
+        if request.method == 'GET':
+            if 'sessions' in q:
+                self.calls['GET sessions'] += 1
+                ids = [s for s in q['sessions'].split(',') if s][:100]
+                return web.json_response({'sessions': {sid: (self.body(self.sessions[sid]) if sid in self.sessions else {}) for sid in ids}})
+            if 'tg' in q:
+                self.calls['GET tg'] += 1
+                try:
+                    uid = int(q['tg'])
+                except ValueError:
+                    return web.json_response({})
+                rows = [(row.get('updated_at') or 0, sid, row) for sid, row in self.sessions.items() if row.get('actor_tg_user_id') == uid]
+                if not rows:
+                    return web.json_response({})
+                _, sid, row = max(rows, key=lambda r: r[0])
+                return web.json_response(dict(self.body(row), session_id=sid))
+            self.calls['GET session'] += 1
+            row = self.sessions.get(q.get('session') or 'default')
+            return web.json_response(self.body(row) if row else {})
+        if request.method == 'PUT':
+            self.calls['PUT'] += 1
+            try:
+                payload = await request.json()
+            except Exception:
+                payload = {}
+            auth = request.headers.get('Authorization', '')
+            client_stage = request.headers.get('X-Client-Stage', '')
+            if auth != f"Bearer {self.write_token}" and not (client_stage in ('6', '7') and str(payload.get('stage')) == client_stage):
+                return web.json_response({'error': 'Unauthorized'}, status=401)
+            fields = {k: v for k, v in payload.items() if k in SESSION_FIELDS and k != 'updated_at'}
+            self.update(q.get('session') or 'default', fields)
+            return web.json_response({'ok': True})
+        return web.Response(status=405)
+
+
+class StandIns:
+    """Runs FakeBotApi and FakeStateApi on one local aiohttp server."""
+
+    def __init__(self, bot_latency: float = 0.0, state_latency: float = 0.0, host: str = '127.0.0.1'):
+        self.bot = FakeBotApi(bot_latency)
+        self.state = FakeStateApi(state_latency)
+        self.host = host
+        self.port = None
+        self.token = BOT_TOKEN
+        self._runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.bot.handle)
+        app.router.add_route('*', '/api/state', self.state.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, 0)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    @property
+    def bot_base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/bot"
+
+    @property
+    def state_base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
@@ -0,0 +1,418 @@
+"""Extract a compact workload trace from bot logs and replay it against the in-process stand-ins.
+
+    extract  Parse bot.out-style logs (the old "asctime - name - level - message" lines or the
+             JSON lines written since LOG_FORMAT=json) into a trace file. Sources:
+               - updates: otc_bot.updates records (INFO, on by default), or ExtBot getUpdates
+                 return values in old logs (telegram.ext.ExtBot=DEBUG)
+               - poller GETs: httpx request lines or otc_bot.poller records (DEBUG, sampled)
+               - session stages: poller[...] stage= records
+               - Bot API calls: otc_bot.outbound records (INFO), or ExtBot "Calling Bot API
+                 endpoint" lines in old logs
+             User ids, session ids, tokens, codes and addresses are replaced by indices or
+             lengths, so a trace can be shared.
+    replay   Feed the trace's updates, and the website's stage writes, into the real Application
+             at --speed (1, 10, 100, ...) with tools/standins.py as Telegram and api/state.js.
+             Gaps longer than --max-gap trace seconds are shortened first. Reports per-kind
+             latency, schedule lag, and outbound calls next to the trace's own counts.
+
+Trace format: JSON lines. The first line is a header object; every following line is an event:
+    [t, "u", user, kind, arg]   update; kind is start|deeplink|digits|check_wallet|command|text|callback|web_app_data
+    [t, "s", session, stage]    session stage observed by the bot's poller
+    [t, "p", session]           poller GET for a session ("" when the log only has a count)
+    [t, "b", method]            outbound Bot API call (getUpdates excluded)
+t is seconds since the first event.
+
+Examples:
+    python tools/workload_trace.py extract bot.out -o /tmp/bot.trace
+    python tools/workload_trace.py replay /tmp/bot.trace --speed 10
+"""
+import argparse
+import ast
+import asyncio
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logging  # noqa: E402
+
+TEXT_LINE_RE = re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(\d{3}) - (\S+) - (\w+) - (.*)$')
+GET_UPDATES_RE = re.compile(r'^Call to Bot API endpoint `getUpdates` finished with return value `(.*)`$', re.S)
+BOT_CALL_RE = re.compile(r'^Calling Bot API endpoint `(\w+)`')
+HTTPX_STATE_RE = re.compile(r'^HTTP Request: (GET|PUT) \S+/api/state\?(\w+)=([^ "&]*)')
+POLLER_STAGE_RE = re.compile(r'^poller\[([^\]]+)\]: stage=(\d+)')
+POLLER_BULK_RE = re.compile(r'^poller: GET \S+\?sessions=<(\d+)>')
+CALLBACK_DATA_RE = re.compile(r'^[A-Za-z_]{1,40}$')
+WALLET_SPLIT_RE = re.compile(r'[\s,;]+')
+
+
+def log_records(path: str):
+    """(unix_ts, logger, level, message, json_record_or_None) for every record in a text or JSON-lines log."""
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line.startswith('{'):
+                try:
+                    rec = json.loads(line)
+                    ts = datetime.strptime(rec['ts'], '%Y-%m-%dT%H:%M:%S.%fZ').timestamp()
+                except (ValueError, KeyError):
+                    continue
+                yield ts, rec.get('logger', ''), rec.get('level', ''), rec.get('msg', ''), rec
+                continue
+            m = TEXT_LINE_RE.match(line)
+            if m:
+                ts = datetime.strptime(m.group(1), '%Y-%m-%d %H:%M:%S').timestamp() + int(m.group(2)) / 1000.0
+                yield ts, m.group(3), m.group(4), m.group(5), None
+
+
+class Anonymizer:
+    def __init__(self):
+        self.users = {}
+        self.sessions = {}
+
+    def user(self, uid) -> int:
+        return self.users.setdefault(str(uid), len(self.users))
+
+    def session(self, sid) -> str:
+        return f"s{self.sessions.setdefault(str(sid), len(self.sessions))}"
+
+    def classify(self, text: str):
+        """(kind, arg) for a message text, without its private content."""
+        text = (text or '').strip()
+        if text.startswith('/'):
+            command, _, rest = text.partition(' ')
+            command = command[1:].split('@', 1)[0]
+            if command == 'start' and rest:
+                token = rest.strip()
+                prefix, sep, sid = token.partition('_s')
+                if sep and sid:
+                    return 'deeplink', f"{prefix[:12]}_s{self.session(sid)}"
+                return 'deeplink', prefix[:12]
+            if command == 'start':
+                return 'start', None
+            if command == 'check_wallet':
+                return 'check_wallet', len([a for a in WALLET_SPLIT_RE.split(rest) if a])
+            return 'command', command[:32]
+        if text.isdigit():
+            return 'digits', len(text)
+        return 'text', len(text)
+
+
+def update_event(t: float, update: dict, anon: Anonymizer):
+    query = update.get('callback_query')
+    if query:
+        data = str(query.get('data') or '')
+        return [t, 'u', anon.user((query.get('from') or {}).get('id')), 'callback', data if CALLBACK_DATA_RE.match(data) else 'other']
+    message = update.get('message') or update.get('edited_message')
+    if not message:
+        return None
+    uid = anon.user((message.get('from') or {}).get('id'))
+    if message.get('web_app_data'):
+        return [t, 'u', uid, 'web_app_data', None]
+    kind, arg = anon.classify(message.get('text'))
+    return [t, 'u', uid, kind, arg]
+
+
+def logged_update_event(t: float, rec: dict, anon: Anonymizer):
+    """Trace event for an otc_bot.updates JSON record (its kind/shape fields; older records carry text)."""
+    uid = anon.user(rec.get('user_id'))
+    kind = rec.get('kind')
+    if kind is None:
+        if rec.get('web_app_data'):
+            return [t, 'u', uid, 'web_app_data', None]
+        kind, arg = anon.classify(rec.get('text'))
+        return [t, 'u', uid, kind, arg]
+    if kind == 'other':
+        return None
+    if kind == 'deeplink':
+        prefix = rec.get('prefix') or ''
+        arg = f"{prefix}_s{anon.session(rec['session'])}" if rec.get('session') else prefix
+    elif kind in ('digits', 'text'):
+        arg = rec.get('length')
+    elif kind == 'check_wallet':
+        arg = rec.get('count')
+    elif kind == 'command':
+        arg = rec.get('command')
+    elif kind == 'callback':
+        arg = rec.get('data')
+    else:
+        arg = None
+    return [t, 'u', uid, kind, arg]
+
+
+def extract(args):
+    anon = Anonymizer()
+    events = []
+    seen_updates = set()
+    for path in args.logs:
+        for ts, name, level, msg, rec in log_records(path):
+            if name == 'telegram.ext.ExtBot':
+                m = GET_UPDATES_RE.match(msg)
+                if m:
+                    try:
+                        updates = ast.literal_eval(m.group(1))
+                    except (ValueError, SyntaxError):
+                        updates = []
+                    for update in updates if isinstance(updates, (list, tuple)) else ():
+                        if update.get('update_id') in seen_updates:
+                            continue
+                        seen_updates.add(update.get('update_id'))
+                        event = update_event(ts, update, anon)
+                        if event:
+                            events.append(event)
+                    continue
+                m = BOT_CALL_RE.match(msg)
+                if m and m.group(1) != 'getUpdates':
+                    events.append([ts, 'b', m.group(1)])
+            elif name == 'httpx':
+                m = HTTPX_STATE_RE.match(msg)
+                if m and m.group(1) == 'GET':
+                    if m.group(2) == 'session':
+                        events.append([ts, 'p', anon.session(m.group(3))])
+                    elif m.group(2) == 'sessions':
+                        for sid in m.group(3).replace('%2C', ',').split(','):
+                            events.append([ts, 'p', anon.session(sid)])
+            elif name.endswith('.updates') and rec is not None and rec.get('update_id') is not None:
+                if rec['update_id'] in seen_updates:
+                    continue
+                seen_updates.add(rec['update_id'])
+                event = logged_update_event(ts, rec, anon)
+                if event:
+                    events.append(event)
+            elif name.endswith('.outbound') and rec is not None and rec.get('endpoint'):
+                events.append([ts, 'b', rec['endpoint']])
+            elif name.endswith('.poller') or name in ('__main__', 'otc_bot'):
+                m = POLLER_STAGE_RE.match(msg)
+                if m:
+                    events.append([ts, 's', anon.session(m.group(1)), int(m.group(2))])
+                    continue
+                m = POLLER_BULK_RE.match(msg)
+                if m:
+                    events.extend([ts, 'p', ''] for _ in range(int(m.group(1))))
+    if not events:
+        raise SystemExit("no workload found (is otc_bot.updates turned down in LOG_LEVELS?)")
+    events.sort(key=lambda e: e[0])
+    t0 = events[0][0]
+    for event in events:
+        event[0] = round(event[0] - t0, 3)
+    kinds = Counter(e[3] for e in events if e[1] == 'u')
+    header = {
+        'version': 1,
+        'sources': [os.path.basename(p) for p in args.logs],
+        'started_at': datetime.fromtimestamp(t0).isoformat(timespec='seconds'),
+        'duration': events[-1][0],
+        'users': len(anon.users),
+        'sessions': len(anon.sessions),
+        'updates': dict(kinds),
+        'bot_api_calls': dict(Counter(e[2] for e in events if e[1] == 'b')),
+        'poller_gets': sum(1 for e in events if e[1] == 'p'),
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(header, separators=(',', ':')) + '\n')
+        for event in events:
+            f.write(json.dumps(event, separators=(',', ':')) + '\n')
+    print(f"wrote {args.output}: {len(events)} events, {os.path.getsize(args.output) / 1024:.1f} KB "
+          f"(from {sum(os.path.getsize(p) for p in args.logs) / 1024:.0f} KB of logs)")
+    summarize(header, events)
+
+
+def load_trace(path: str):
+    with open(path, encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        events = [json.loads(line) for line in f if line.strip()]
+    return header, events
+
+
+def summarize(header: dict, events: list):
+    print(f"duration {header['duration']:.0f}s, {header['users']} users, {header['sessions']} sessions")
+    print("updates: " + (', '.join(f"{k}={n}" for k, n in sorted(header['updates'].items())) or 'none'))
+    sequences = defaultdict(list)
+    for e in events:
+        if e[1] == 'u':
+            sequences[e[2]].append(e[3])
+    for uid, seq in list(sequences.items())[:5]:
+        print(f"  user {uid}: {' -> '.join(seq[:12])}{' ...' if len(seq) > 12 else ''}")
+    last_get = {}
+    intervals = []
+    for e in events:
+        if e[1] == 'p' and e[2]:
+            if e[2] in last_get:
+                intervals.append(e[0] - last_get[e[2]])
+            last_get[e[2]] = e[0]
+    if intervals:
+        intervals.sort()
+        print(f"poller interval per session: p50 {statistics.median(intervals):.2f}s  "
+              f"p90 {intervals[int(len(intervals) * 0.9)]:.2f}s  over {len(intervals)} GETs")
+    print("Bot API calls: " + (', '.join(f"{m}={n}" for m, n in sorted(header['bot_api_calls'].items())) or 'none'))
+
+
+def replay_schedule(events: list, speed: float, max_gap: float) -> list:
+    """[(replay_offset_s, event)] with gaps capped at max_gap trace seconds, then divided by speed."""
+    out = []
+    clock = 0.0
+    prev = None
+    for e in events:
+        if e[1] not in ('u', 's'):
+            continue
+        if prev is not None:
+            clock += min(e[0] - prev, max_gap)
+        prev = e[0]
+        out.append((clock / speed, e))
+    return out
+
+
+def build_update(update_id: int, event: list, rng: random.Random, message_update, callback_update):
+    _, _, user, kind, arg = event
+    uid = 800000000 + int(user)
+    if kind == 'callback':
+        return callback_update(update_id, uid, arg)
+    if kind == 'start':
+        return message_update(update_id, uid, '/start')
+    if kind == 'deeplink':
+        return message_update(update_id, uid, f"/start {arg}")
+    if kind == 'digits':
+        return message_update(update_id, uid, ''.join(rng.choice('0123456789') for _ in range(max(1, int(arg)))))
+    if kind == 'check_wallet':
+        addresses = ['0x' + rng.getrandbits(160).to_bytes(20, 'big').hex() for _ in range(max(1, int(arg)))]
+        return message_update(update_id, uid, '/check_wallet ' + ' '.join(addresses))
+    if kind == 'command':
+        return message_update(update_id, uid, f"/{arg}")
+    if kind == 'text':
+        return message_update(update_id, uid, 'x' * max(1, int(arg)))
+    return None
+
+
+async def replay(args):
+    import otc_bot
+    from replay_bench import callback_update, message_update, percentile
+    from standins import StandIns, STATE_WRITE_TOKEN
+    from telegram import Update
+
+    logging.disable(logging.WARNING)
+    header, events = load_trace(args.trace)
+    schedule = replay_schedule(events, args.speed, args.max_gap)
+    rng = random.Random(args.seed)
+    standins = await StandIns(bot_latency=args.bot_latency_ms / 1000.0, state_latency=args.state_latency_ms / 1000.0).start()
+    os.environ['STATE_BASE_URL'] = standins.state_base_url
+    os.environ['STATE_WRITE_TOKEN'] = STATE_WRITE_TOKEN
+    if not args.production_limits:
+        os.environ.setdefault('BOT_GLOBAL_RATE', '100000')
+        os.environ.setdefault('BOT_CHAT_RATE', '100000')
+        os.environ.setdefault('BOT_CHAT_BURST', '100000')
+    application = otc_bot.build_application(token=standins.token, base_url=standins.bot_base_url)
+    await application.initialize()
+    await application.start()
+    otc_bot.open_http_clients()
+    otc_bot.bot_for_notifications = application.bot
+
+    queue = asyncio.Queue()
+    samples = defaultdict(list)
+    skipped = Counter()
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                queue.task_done()
+                return
+            due, kind, update = item
+            started = time.perf_counter()
+            try:
+                await application.process_update(update)
+            except Exception:
+                pass
+            done = time.perf_counter()
+            samples[kind].append((done - started, done - due))
+            queue.task_done()
+
+    workers = [asyncio.create_task(worker()) for _ in range(args.concurrency)]
+    span = schedule[-1][0] if schedule else 0.0
+    print(f"replaying {args.trace} at {args.speed:g}x: {len(schedule)} events over {span:.1f}s "
+          f"(trace {header['duration']:.0f}s, gaps capped at {args.max_gap:g}s)")
+    t0 = time.perf_counter()
+    for update_id, (offset, event) in enumerate(schedule, 1):
+        delay = t0 + offset - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if event[1] == 's':
+            stage = int(event[3])
+            # Stages 3 and 4 are the bot's own writes and happen again during replay
+            if stage not in (3, 4):
+                standins.state.update(event[2], {'stage': stage})
+            continue
+        data = build_update(update_id, event, rng, message_update, callback_update)
+        if data is None:
+            skipped[event[3]] += 1
+            continue
+        queue.put_nowait((t0 + offset, event[3], Update.de_json(data, application.bot)))
+    await queue.join()
+    elapsed = time.perf_counter() - t0
+    for _ in workers:
+        queue.put_nowait(None)
+    await asyncio.gather(*workers)
+    await asyncio.sleep(args.drain)
+
+    total = sum(len(v) for v in samples.values())
+    print(f"\n{total} updates in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.1f} updates/s)"
+          + (f"; skipped {dict(skipped)}" if skipped else ''))
+    print(f"{'update kind':<16}{'n':>6}{'svc p50':>10}{'svc p99':>10}{'lag p50':>10}{'lag p99':>10}")
+    for kind in sorted(samples):
+        service = sorted(s for s, _ in samples[kind])
+        lag = sorted(e for _, e in samples[kind])
+        print(f"{kind:<16}{len(service):>6}{percentile(service, 50) * 1000:>8.1f}ms{percentile(service, 99) * 1000:>8.1f}ms"
+              f"{percentile(lag, 50) * 1000:>8.1f}ms{percentile(lag, 99) * 1000:>8.1f}ms")
+    replay_calls = standins.bot.calls
+    methods = sorted(set(header['bot_api_calls']) | set(replay_calls))
+    print(f"\n{'Bot API method':<24}{'trace':>8}{'replay':>8}")
+    for method in methods:
+        print(f"{method:<24}{header['bot_api_calls'].get(method, 0):>8}{replay_calls.get(method, 0):>8}")
+    gets = sum(n for m, n in standins.state.calls.items() if m.startswith('GET'))
+    print(f"state API GETs: trace {header['poller_gets']} in {header['duration']:.0f}s, replay {gets} in {elapsed:.0f}s "
+          f"({dict(standins.state.calls)})")
+
+    if otc_bot.session_poller_task and not otc_bot.session_poller_task.done():
+        otc_bot.session_poller_task.cancel()
+    for task in list(otc_bot.finalize_watch_tasks.values()):
+        task.cancel()
+    await application.stop()
+    await application.shutdown()
+    await otc_bot.close_http_clients()
+    await standins.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_extract = sub.add_parser('extract', help="parse logs into a trace file")
+    p_extract.add_argument('logs', nargs='+', help="bot log files (text or JSON lines)")
+    p_extract.add_argument('-o', '--output', required=True, help="trace file to write")
+    p_show = sub.add_parser('show', help="summarize a trace file")
+    p_show.add_argument('trace')
+    p_replay = sub.add_parser('replay', help="replay a trace against the stand-ins")
+    p_replay.add_argument('trace')
+    p_replay.add_argument('--speed', type=float, default=1.0, help="time compression: 1, 10, 100, ...")
+    p_replay.add_argument('--max-gap', type=float, default=30.0, help="cap idle gaps to this many trace seconds")
+    p_replay.add_argument('--concurrency', type=int, default=1, help="updates processed at once (1 = production)")
+    p_replay.add_argument('--bot-latency-ms', type=float, default=30.0)
+    p_replay.add_argument('--state-latency-ms', type=float, default=20.0)
+    p_replay.add_argument('--production-limits', action='store_true', help="keep BOT_GLOBAL_RATE/BOT_CHAT_RATE limits")
+    p_replay.add_argument('--drain', type=float, default=2.0, help="seconds to let background work finish")
+    p_replay.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    if args.command == 'extract':
+        extract(args)
+    elif args.command == 'show':
+        summarize(*load_trace(args.trace))
+    else:
+        asyncio.run(replay(args))
+
+
+if __name__ == '__main__':
+    main()